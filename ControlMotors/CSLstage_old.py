@@ -82,8 +82,9 @@ class ControlStage:
 
     def handle_set_homing(self, a=2, b=-1, c=-1):
         """configure the homing order. x:0, y:1, z:2, skip:-1. 
-        Example: set y, then x: handle_set_homing(link, 1, 0, -1)"""
-        self.link.send_command("h[%d,%d,%d]" % (a,b,c))
+        Example: set y, then x: handle_set_homing(link, 1, 0, -1)
+    The homing speeds are left as they are (0 keeps the current value)."""
+        self.link.send_command("h[%d,%d,%d,0,0,0,0,0,0,0,0,0]" % (a,b,c))
 
 
     def handle_homing(self):
@@ -23,21 +23,123 @@
 """
 from ControlSerial.ControlSerial import ControlSerial
 
+import functools
+import itertools
+import math
+import threading
 import time
 import json
-import traceback
-import numpy as np
+from collections import deque, namedtuple
+
+from .config import (INTERRUPTS_PER_MILLISECOND, MAX_STEP_RATE,
+                     default_homing, default_profiles,
+                     load_config, save_config)
+from .lookahead import Lookahead
+from .planner import MAX_BLOCK_DT, MAX_BLOCK_STEPS, MotionPlanner
+
+AXES = "xyz"
+
+# Number of blocks carried by one B frame (MAX_BATCH_BLOCKS in Oquam.ino)
+BATCH_SIZE = 3
+
+# Records of a plan for ControlStage.execute: Move and MoveTo in stage
+# steps, Block a ready-made M block in motor steps.
+Move = namedtuple("Move", ["dx", "dy", "dz", "dt"], defaults=(0, 0, 0, -1))
+MoveTo = namedtuple("MoveTo", ["x", "y", "z", "speed"],
+                    defaults=(None, None, None, None))
+Block = namedtuple("Block", ["dt", "dx", "dy", "dz"])
+
+
+def _locked(method):
+    # Run the method under the stage lock: a stage shared between
+    # threads (e.g. HybridZ re-centring Z while the caller moves XY)
+    # must not interleave its frames or its position updates.
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def _block_speed(n, speed):
+    # The firmware turns the speed of an m block of longest displacement
+    # n into a duration of 1000*n//speed ms and makes at most 10 steps
+    # per ms: lower the speed until that duration is at least 1 ms and
+    # long enough for the n steps.
+    if n == 0:
+        return speed
+    ms = -(-n // INTERRUPTS_PER_MILLISECOND)
+    return min(speed, 1000 * n // ms)
 
         
 class ControlStage:
-    def __init__(self, arduino_port, gears):
+    def __init__(self, arduino_port, gears, planner=None, profiles=None,
+                 lookahead=None, batch=False, batch_timeout=60,
+                 homing=None, pixel_to_step=None):
         
         self.x = 0
         self.y = 0
         self.z = 0
+        # Motor steps left over when the firmware counters are not a
+        # whole number of stage steps (see get_position).
+        self.remainder = [0, 0, 0]
+        # Set when x, y, z may no longer match the firmware: after an
+        # error, a reset, a homing or with the motors disabled.
+        self.stale = False
         self.gears = gears
         self.arduino_port = arduino_port
 
+        # Speed limits of the X, Y and Z motors (AxisProfile), used to
+        # compute the shortest safe dt of every block.
+        self.profiles = list(profiles) if profiles else default_profiles()
+
+        # Homing speeds of the X, Y and Z motors (HomingProfile), sent
+        # to the firmware with the homing order.
+        self.homing = list(homing) if homing else default_homing()
+
+        # Camera calibration: 2x2 matrix that turns an image shift in
+        # pixels into X and Y stage steps (calibration.calibrate_camera),
+        # or None when the camera was not calibrated.
+        self.pixel_to_step = pixel_to_step
+
+        # Optional MotionPlanner: when set, moves without an explicit dt
+        # are sent as a series of blocks following a velocity ramp. By
+        # default one is created when every axis has an acceleration.
+        if planner is None and all(p.acceleration for p in self.profiles):
+            planner = MotionPlanner.from_profiles(self.profiles)
+        self.planner = planner
+
+        # Optional Lookahead: when set, moves without an explicit dt are
+        # held back and consecutive collinear ones merged before sending.
+        # Any other command first sends what is held back (see flush).
+        if lookahead is True:
+            lookahead = Lookahead()
+        self.lookahead = lookahead
+
+        # Batching: when set, motion blocks are sent BATCH_SIZE at a time
+        # in B frames instead of one M frame each. Blocks wait in
+        # _batch until a frame is full or another command is sent.
+        self.batch = batch
+        self.batch_timeout = batch_timeout
+        self._batch = []
+
+        # Callables run with (command, reply, sent, received) after every
+        # frame the firmware accepted; sent and received are the
+        # time.monotonic() before and after the exchange (see Trajectory).
+        self.frame_listeners = []
+
+        # Set by execute(): M and m frames turned down because the
+        # firmware buffer is full are sent again until this
+        # time.monotonic() deadline instead of failing.
+        self._again_deadline = None
+        self._again_timeout = 0
+        # Number of plan records handed over by execute()
+        self.executed = 0
+
+        # Taken by the methods that send frames or track the position
+        # (see _locked)
+        self._lock = threading.RLock()
+
         self.link = ControlSerial(self.arduino_port)
 
         self.backlash_pos = 1#300
@@ -46,121 +148,488 @@ class ControlStage:
 
 
 
+    @classmethod
+    def from_config(cls, arduino_port, path, **kwargs):
+        """Open a stage with the gears and profiles of a config file."""
+        config = load_config(path)
+        return cls(arduino_port, config["gears"],
+                   profiles=config["profiles"], homing=config["homing"],
+                   pixel_to_step=config["pixel_to_step"], **kwargs)
+
+    def get_config(self):
+        """Return the machine-specific settings as a config dict."""
+        pixel_to_step = self.pixel_to_step
+        if pixel_to_step is not None:
+            pixel_to_step = [[float(v) for v in row] for row in pixel_to_step]
+        return {"gears": list(self.gears),
+                "profiles": list(self.profiles),
+                "homing": list(self.homing),
+                "pixel_to_step": pixel_to_step}
+
+    def save_config(self, path):
+        """Store the gears, speed profiles, homing speeds and camera
+        calibration in a config file."""
+        save_config(path, self.get_config())
+
+
+    def block_dt(self, motor_dx, motor_dy, motor_dz):
+        """Return the shortest safe duration (ms) of a block, i.e. the
+        time the slowest moving axis needs given its profile."""
+        durations = [p.duration(d) for p, d in
+                     zip(self.profiles, (motor_dx, motor_dy, motor_dz))]
+        dt = max(durations)
+        if dt == 0:
+            dt = max(p.min_dt for p in self.profiles)
+        return dt
+
+
     def handle_enable(self, enable):
         # Enable or diable to allow automatic or manual command
         # respectively
-        self.link.send_command("E[%d]"%int(enable))
+        self._send("E[%d]"%int(enable))
+        if not enable:
+            # The stage can now be moved by hand
+            self.invalidate_position()
 
 
 
     def handle_moveto(self, t, x, y, z=0):
-        """move the motor to absolute position"""
-        self.link.send_command("m[%d,%d,%d,%d]" % (t, x, y, z))
+        """move the motor to absolute position (motor steps) at a speed
+        of ``t`` steps/s on the longest axis"""
+        self._send("m[%d,%d,%d,%d]" % (t, x, y, z))
 
 
     def handle_move(self, dt, dx, dy, dz=0):
         """move the motor by relative displacement"""
-        self.link.send_command("M[%d,%d,%d,%d]" % (dt, dx, dy, dz))
+        self._send("M[%d,%d,%d,%d]" % (dt, dx, dy, dz))
+
+
+    def handle_move_batch(self, blocks):
+        """queue up to BATCH_SIZE relative moves, given as (dt, dx, dy, dz),
+        in one frame. Returns the number of moves the firmware accepted;
+        the others did not fit in its buffer."""
+        return self._send(self._batch_frame(blocks))[1]
 
 
     def handle_pause(self):
         """pause after the ongoing moving task"""
-        self.link.send_command("p")
+        self._send("p")
 
 
     def handle_continue(self):
         """restart after pause"""
-        self.link.send_command("c")
+        self._send("c")
 
 
     def send_idle(self):
         """assert the connection is correctly established"""
-        reply = self.link.send_command("I")
+        reply = self._send("I")
         return reply[1]
 
+    def send_status(self):
+        """idle flag and controller state: "r" running, "p" paused,
+        "h" homing or "e" error"""
+        reply = self._send("I")
+        return reply[1], reply[2]
+
     def handle_set_homing(self, a=2, b=-1, c=-1):
         """configure the homing order. x:0, y:1, z:2, skip:-1. 
-        Example: set y, then x: handle_set_homing(link, 1, 0, -1)"""
-        self.link.send_command("h[%d,%d,%d]" % (a,b,c))
+        Example: set y, then x: handle_set_homing(link, 1, 0, -1)
+        The homing speeds of self.homing are sent along."""
+        speeds = [v for h in self.homing for v in (h.fast, h.slow, h.backoff)]
+        self._send("h[%s]" % ",".join("%d" % v for v in [a, b, c] + speeds))
 
 
     def handle_homing(self):
         """perform homing in the order set by "handle_set_homing"""
-        self.link.send_command("H")
-
-    def close(self):
-        self.link.driver.close()
+        self.invalidate_position()
+        self._send("H")
 
 
-    # X displacement
-    def move_dx(self, dx, dt=-1) :
-        """Move the X axis by ``dx`` stage steps.
+    def handle_reset(self):
+        """drop the moves queued in the firmware and stop"""
+        self.invalidate_position()
+        self._send("r")
 
-        ``gears[0]`` is the motor-steps-per-stage-step ratio for X.
-        The Arduino always receives motor steps; we convert here.
-        """
 
-        motor_dx = dx * self.gears[0]
-
-        if dt == -1:
-            # Adjust displacement speed according to the displacement
-            # length (in motor steps)
-            dt = motor_dx
-            if np.abs(dt) < 10:
-                dt = 10
+    def handle_zero(self):
+        """set the firmware step counters to zero (when idle or paused)"""
+        self.invalidate_position()
+        self._send("z")
 
-        # Send command to the Arduino in motor steps
-        self.handle_move(np.abs(dt), motor_dx, 0, 0)
 
-        # Track logical X position in stage steps
-        self.x += dx
+    def send_position(self):
+        """step counters of the firmware (motor steps)"""
+        reply = self._send("P")
+        return reply[1:4]
 
+    def send_homing_offset(self):
+        """step counters of the last homing just before they were zeroed
+        (motor steps). On a homed axis this is the number of steps lost
+        since the previous homing."""
+        reply = self._send("O")
+        return reply[1:4]
 
-        
-    # Y displacement
-    def move_dy(self, dy, dt = -1) :
-            """Move the Y axis by ``dy`` stage steps.
-
-            ``gears[1]`` is the motor-steps-per-stage-step ratio for Y.
-            """
+    def close(self):
+        self.flush()
+        self.link.driver.close()
 
-            motor_dy = dy * self.gears[1]
 
+    @_locked
+    def reconnect(self):
+        """open the serial link again, after it failed. The moves held
+        back are dropped and the position is marked stale."""
+        try:
+            self.link.driver.close()
+        except Exception:
+            pass
+        self._batch = []
+        if self.lookahead is not None:
+            self.lookahead.flush()
+        self.link = ControlSerial(self.arduino_port)
+        self.invalidate_position()
+
+
+    @_locked
+    def flush(self):
+        """send the moves held back by the lookahead or the batching, if any"""
+        self._flush_lookahead()
+        if self._batch:
+            blocks, self._batch = self._batch, []
+            self._send_batch(blocks)
+
+
+    def _flush_lookahead(self):
+        if self.lookahead is not None:
+            segment = self.lookahead.flush()
+            if segment is not None:
+                self._send_motion(*segment)
+
+
+    @_locked
+    def _send(self, command):
+        # Keep the command order: queued moves go out first.
+        self.flush()
+        return self._command(command)
+
+
+    @_locked
+    def _command(self, command):
+        # Every frame goes through here: after a failure we cannot tell
+        # which blocks the firmware has.
+        while True:
+            sent = time.monotonic()
+            try:
+                reply = self.link.send_command(command)
+                break
+            except Exception as e:
+                if self._again(command, e):
+                    continue
+                self.invalidate_position()
+                raise
+        if self._again_deadline is not None:
+            self._again_deadline = time.monotonic() + self._again_timeout
+        if self.frame_listeners:
+            received = time.monotonic()
+            for listener in self.frame_listeners:
+                listener(command, reply, sent, received)
+        return reply
+
+
+    def _again(self, command, error):
+        # Wait for a free block in the firmware buffer (execute only)
+        if (self._again_deadline is None or command[0] not in "Mm"
+                or str(error) != "Again"
+                or time.monotonic() > self._again_deadline):
+            return False
+        time.sleep(0.005)
+        return True
+
+
+    def execute(self, plan, window=16, timeout=60):
+        """Run the Move, MoveTo and Block records of ``plan``, any
+        iterable, generator included.
+
+        Records are read from ``plan`` as the firmware accepts blocks,
+        at most ``window`` ahead of the one being sent, so memory does
+        not grow with the length of the plan and the first move starts
+        at once. When the firmware buffer is full the block is sent
+        again until it fits; RuntimeError("Again") is raised if no
+        block is accepted for ``timeout`` seconds. ``executed`` counts
+        the records handed over so far (read it from another thread to
+        follow the progress). Returns that count when the last record is
+        sent, without waiting for the end of the motion.
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        records = iter(plan)
+        # Only the first record is needed to start moving
+        ahead = deque(itertools.islice(records, 1))
+        self.executed = 0
+        self._again_timeout = timeout
+        self._again_deadline = time.monotonic() + timeout
+        try:
+            while ahead:
+                self._execute_record(ahead.popleft())
+                self.executed += 1
+                ahead.extend(itertools.islice(records, window - len(ahead)))
+            self.flush()
+        finally:
+            self._again_deadline = None
+        return self.executed
+
+
+    def _execute_record(self, record):
+        if isinstance(record, MoveTo):
+            self.moveto(*record)
+        elif isinstance(record, Move):
+            self.move(*record)
+        elif isinstance(record, Block):
+            self._flush_lookahead()
+            self._send_motion(record.dx, record.dy, record.dz, record.dt)
+            self._track_motor_steps(record[1:])
+        else:
+            raise TypeError("Expected a Move, MoveTo or Block record, got %r"
+                            % (record,))
+
+
+    def _track_motor_steps(self, deltas):
+        # Update x, y, z and the remainder after a move in motor steps
+        position = [self.x, self.y, self.z]
+        for i, (d, g) in enumerate(zip(deltas, self.gears)):
+            position[i], self.remainder[i] = divmod(
+                position[i] * g + self.remainder[i] + d, g)
+        self.x, self.y, self.z = position
+
+
+    def _send_motion(self, motor_dx, motor_dy, motor_dz, dt=-1):
+        # Send a relative move in motor steps, without flushing.
+        if dt == -1 and self.planner is not None:
+            # Accelerate and decelerate over several blocks
+            blocks = self.planner.plan(motor_dx, motor_dy, motor_dz)
+        else:
             if dt == -1:
-                # Adjust displacement speed according to the displacement
-                # length (in motor steps, considering the gearbox ratio)
-                dt = motor_dy
-                if np.abs(dt) < 10:
-                    dt = 10
-
-            # Send command to the Arduino
-            self.handle_move(np.abs(dt), 0, motor_dy, 0)
+                # Run at the speed limit of the slowest moving axis
+                dt = self.block_dt(motor_dx, motor_dy, motor_dz)
+            blocks = [(abs(dt), motor_dx, motor_dy, motor_dz)]
+        if self.batch:
+            self._batch.extend(blocks)
+            while len(self._batch) >= BATCH_SIZE:
+                self._send_batch(self._batch[:BATCH_SIZE])
+                del self._batch[:BATCH_SIZE]
+        else:
+            for block in blocks:
+                self._command("M[%d,%d,%d,%d]" % block)
+
+
+    def _batch_frame(self, blocks):
+        if not 0 < len(blocks) <= BATCH_SIZE:
+            raise ValueError("A batch holds 1 to %d blocks" % BATCH_SIZE)
+        # A block with dt = 0 ends the list
+        padding = [(0, 0, 0, 0)] * (BATCH_SIZE - len(blocks))
+        args = [int(v) for block in list(blocks) + padding for v in block]
+        return "B[%s]" % ",".join("%d" % v for v in args)
+
+
+    def _send_batch(self, blocks):
+        # Send the blocks, resending those the full buffer turned down.
+        start = time.monotonic()
+        while blocks:
+            accepted = self._command(self._batch_frame(blocks))[1]
+            blocks = blocks[accepted:]
+            if accepted:
+                start = time.monotonic()
+            elif time.monotonic() - start > self.batch_timeout:
+                raise RuntimeError("Again")
+            if blocks:
+                time.sleep(0.01)
+
+
+    def invalidate_position(self):
+        """mark x, y, z as unreliable: the next get_position(exact=True)
+        reads the step counters back from the firmware"""
+        self.stale = True
+
+
+    @_locked
+    def get_position(self, exact=False, timeout=None):
+        """Return the position (x, y, z) in stage steps.
+
+        Normally this is the tracked position, which costs no command.
+        With ``exact`` set and the tracked position stale, wait until the
+        queued moves are done, read the firmware step counters (P) and
+        convert them to stage steps; the motor steps that do not make a
+        whole stage step are kept in ``remainder``.
+        """
+        if exact and self.stale:
+            self.wait_idle(timeout)
+            counters = self.send_position()
+            position = [divmod(c, g) for c, g in zip(counters, self.gears)]
+            (self.x, self.y, self.z) = [q for q, r in position]
+            self.remainder = [r for q, r in position]
+            self.stale = False
+        return (self.x, self.y, self.z)
+
+
+    def wait_idle(self, timeout=None, interval=0.05):
+        """block until the firmware has executed all the queued moves.
+        Raises TimeoutError if this takes longer than ``timeout`` seconds
+        and RuntimeError if the firmware is in the error state."""
+        start = time.monotonic()
+        while True:
+            idle, state = self.send_status()
+            if state == "e":
+                self.invalidate_position()
+                raise RuntimeError("Stage on %s is in the error state"
+                                   % self.arduino_port)
+            if idle:
+                return
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Stage on %s still busy after %.1f s"
+                                   % (self.arduino_port, timeout))
+            time.sleep(interval)
+
+
+    def home(self, axes="xyz", timeout=60, interval=0.01, max_interval=0.25):
+        """Home ``axes`` in the given order and return when it is done.
+
+        ``axes`` is a string such as "zxy" or a sequence of axis indices.
+        The firmware answers H at once and homes in the background; the
+        controller state is polled with I until it is back to "r" and
+        idle. Polling starts every ``interval`` seconds, slows down to
+        ``max_interval`` while the state stays the same, and speeds up
+        again on each change. Raises RuntimeError if the firmware ends in
+        the error state and TimeoutError after ``timeout`` seconds.
+        """
+        order = [AXES.index(a.lower()) if isinstance(a, str) else int(a)
+                 for a in axes]
+        if len(order) > 3 or len(set(order)) != len(order):
+            raise ValueError("Invalid homing order: %r" % (axes,))
+        self.handle_set_homing(*(order + [-1] * (3 - len(order))))
+        self.handle_homing()
+
+        start = time.monotonic()
+        delay = interval
+        previous = None
+        while True:
+            idle, state = self.send_status()
+            if state == "e":
+                raise RuntimeError("Homing failed on %s" % self.arduino_port)
+            if idle and state == "r":
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Homing on %s not done after %.1f s"
+                                   % (self.arduino_port, timeout))
+            delay = interval if state != previous else min(2 * delay,
+                                                           max_interval)
+            previous = state
+            time.sleep(delay)
+
+        # The firmware zeroes its step counters at the end of the homing
+        self.x = self.y = self.z = 0
+        self.remainder = [0, 0, 0]
+        self.stale = False
+
+
+    # Coordinated displacement
+    @_locked
+    def move(self, dx=0, dy=0, dz=0, dt=-1):
+        """Move X, Y and Z together by ``dx``, ``dy``, ``dz`` stage steps.
+
+        ``gears`` hold the motor-steps-per-stage-step ratio of each axis.
+        The Arduino always receives motor steps; we convert here.
+        """
 
-            # Track logical Y position in stage steps
-            self.y += dy
+        motor_dx = dx * self.gears[0]
+        motor_dy = dy * self.gears[1]
+        motor_dz = dz * self.gears[2]
+
+        if dt == -1 and self.lookahead is not None:
+            # Merge with the neighbouring moves where possible
+            for segment in self.lookahead.push(motor_dx, motor_dy, motor_dz):
+                self._send_motion(*segment)
+        else:
+            # Send command to the Arduino in motor steps
+            self._flush_lookahead()
+            self._send_motion(motor_dx, motor_dy, motor_dz, dt)
+
+        # Track logical position in stage steps
+        self.x += dx
+        self.y += dy
+        self.z += dz
+
+
+    # Absolute displacement
+    @_locked
+    def moveto(self, x=None, y=None, z=None, speed=None):
+        """Move to the absolute position ``x``, ``y``, ``z`` in stage steps.
+        An axis left to None keeps its position.
+
+        The positions are counted from the firmware's origin (power-up
+        or the last homing). The firmware computes the duration of the
+        move from ``speed``: the rate (motor steps/s) of the axis with the
+        longest displacement. It defaults to the lowest max_rate of the
+        moving axes, so no axis exceeds its profile, and is capped at
+        MAX_STEP_RATE. A stale position is read back from the firmware
+        first.
+        """
+        if self.stale:
+            self.get_position(exact=True)
+        current = (self.x, self.y, self.z)
+        target = [c if t is None else t for c, t in zip(current, (x, y, z))]
+        motor_current = [int(c * g) + r for c, g, r
+                         in zip(current, self.gears, self.remainder)]
+        motor_target = [int(t * g) for t, g in zip(target, self.gears)]
+        if any(abs(m) > MAX_BLOCK_STEPS for m in motor_target):
+            raise ValueError("Target %s is out of the firmware's range "
+                             "(+/-%d motor steps)" % (target, MAX_BLOCK_STEPS))
+        deltas = [t - c for t, c in zip(motor_target, motor_current)]
+
+        if speed is None:
+            rates = [p.max_rate for p, d in zip(self.profiles, deltas) if d]
+            speed = min(rates or [p.max_rate for p in self.profiles])
+        speed = int(speed)
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        # The firmware makes at most one step per interrupt
+        speed = min(speed, MAX_STEP_RATE)
+
+        # The firmware stores the duration of a block in 16 bits: split
+        # long moves into several m blocks along the line.
+        longest = max(abs(d) for d in deltas)
+        count = max(1, int(math.ceil(longest * 1000.0
+                                     / (speed * MAX_BLOCK_DT))))
+        previous = motor_current
+        for i in range(1, count + 1):
+            point = [c + d * i // count for c, d in zip(motor_current, deltas)]
+            n = max(abs(p - q) for p, q in zip(point, previous))
+            self.handle_moveto(_block_speed(n, speed), *point)
+            previous = point
+
+        # Track logical position in stage steps
+        self.x, self.y, self.z = target
+        self.remainder = [0, 0, 0]
 
-        
-    # Z displacement
-    def move_dz(self, dz, dt=-1) :
-            """Move the Z axis by ``dz`` stage steps.
 
-            ``gears[2]`` is the motor-steps-per-stage-step ratio for Z.
-            """
+    # X displacement
+    def move_dx(self, dx, dt=-1) :
+        """Move the X axis by ``dx`` stage steps (``gears[0]`` motor
+        steps per stage step)."""
+        self.move(dx, 0, 0, dt)
 
-            motor_dz = dz * self.gears[2]
 
-            if dt == -1:
-                # Adjust displacement speed according to the displacement
-                # length (in motor steps)
-                dt = motor_dz
-                if np.abs(dt) < 10:
-                    dt = 10
+    # Y displacement
+    def move_dy(self, dy, dt=-1) :
+        """Move the Y axis by ``dy`` stage steps (``gears[1]`` motor
+        steps per stage step)."""
+        self.move(0, dy, 0, dt)
 
-            # Send command to the Arduino
-            self.handle_move(np.abs(dt), 0, 0, motor_dz)
 
-            # Track logical Z position in stage steps
-            self.z += dz
+    # Z displacement
+    def move_dz(self, dz, dt=-1) :
+        """Move the Z axis by ``dz`` stage steps (``gears[2]`` motor
+        steps per stage step)."""
+        self.move(0, 0, dz, dt)
 
     def reset(self):
         self.link.close()
@@ -1,2 +1,43 @@
-from .ControlMotors import ControlStage
-from .interface_motors import interface_motors
\ No newline at end of file
+from .ControlMotors import Block, ControlStage, Move, MoveTo
+from .config import AxisProfile, HomingProfile
+
+# Everything beyond the core ControlStage is loaded on first access so
+# that `import ControlMotors` does not pull in NumPy, Tk or the pyserial
+# port-listing tools. Maps the exported name to the submodule that
+# defines it.
+_LAZY_EXPORTS = {
+    "interface_motors": ".interface_motors",
+    "StageServer": ".server",
+    "StageClient": ".server",
+    "StageGroup": ".group",
+    "MotionPlanner": ".planner",
+    "Lookahead": ".lookahead",
+    "OquamModel": ".firmware_model",
+    "Autofocus": ".autofocus",
+    "FocusMap": ".focusmap",
+    "DriftCorrector": ".drift",
+    "Pipeline": ".pipeline",
+    "Trajectory": ".trajectory",
+    "TimeLapse": ".timelapse",
+    "AdaptiveScan": ".adaptive",
+    "Layout": ".labware",
+    "FocusCache": ".labware",
+    "HybridZ": ".piezo",
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    module = importlib.import_module(module_name, __name__)
+    value = getattr(module, name)
+    # Importing a submodule binds it on the package; replace it with
+    # the exported object so later lookups skip this hook.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_EXPORTS))
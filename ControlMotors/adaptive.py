@@ -0,0 +1,199 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Adaptive coarse-to-fine scan.
+#
+# The region is divided into coarse cells of `coarse_step` stage steps,
+# each divided into fine tiles of `fine_step` (coarse_step must be a
+# multiple of fine_step). The coarse pass takes one frame at the centre
+# of every cell, in serpentine order, and scores all the frames at once:
+# a score function takes a stack of frames (n, h, w) and returns n
+# scores, computed with array operations over the whole stack. Only the
+# cells scoring at least `threshold` (and, with `grow`, their
+# neighbours, for objects that straddle a cell border) are scanned at
+# the fine step, in one pass over all their tiles ordered by
+# routing.order_tiles. Every move is one coordinated moveto.
+import time
+
+import numpy as np
+
+from .config import default_profiles
+from .routing import order_tiles, path_time
+
+
+def _stack(frames):
+    frames = np.asarray(frames, dtype=np.float64)
+    if frames.ndim == 4:
+        # Colour frames: average the channels
+        frames = frames.mean(axis=3)
+    if frames.ndim != 3:
+        raise ValueError("Expected a stack of 2-D frames")
+    return frames
+
+
+def standard_deviation(frames):
+    """Standard deviation of the pixels of each frame: empty areas are
+    flat."""
+    return _stack(frames).std(axis=(1, 2))
+
+
+def gradient(frames):
+    """Mean squared difference between pixels two apart, horizontally
+    and vertically, of each frame: high where there are edges, low on
+    flat areas and smooth illumination gradients."""
+    f = _stack(frames)
+    dx = f[:, :, 2:] - f[:, :, :-2]
+    dy = f[:, 2:, :] - f[:, :-2, :]
+    return (np.square(dx).sum(axis=(1, 2))
+            + np.square(dy).sum(axis=(1, 2))) / f[0].size
+
+
+SCORES = {
+    "std": standard_deviation,
+    "gradient": gradient,
+}
+
+
+def _centres(origin, count, step):
+    return origin + (np.arange(count) + 0.5) * step
+
+
+class AdaptiveResult:
+    """Outcome of an adaptive scan.
+
+    ``coarse`` holds the (x, y) centres of the coarse cells in the order
+    they were visited and ``scores`` their scores; ``selected`` flags
+    the cells scanned at the fine step and ``fine`` the fine tiles in
+    the order they were visited. ``full`` is the number of tiles a full
+    scan at the fine step would take, ``travel`` the predicted moving
+    time (s) of the two passes and ``elapsed`` the duration of the scan.
+    """
+
+    def __init__(self, coarse, scores, selected, fine, full, travel,
+                 elapsed):
+        self.coarse = coarse
+        self.scores = scores
+        self.selected = selected
+        self.fine = fine
+        self.full = full
+        self.travel = travel
+        self.elapsed = elapsed
+
+    @property
+    def tiles(self):
+        return len(self.coarse) + len(self.fine)
+
+    def __repr__(self):
+        return ("AdaptiveResult(coarse=%d, fine=%d, full=%d, "
+                "elapsed=%.1f)" % (len(self.coarse), len(self.fine),
+                                   self.full, self.elapsed))
+
+
+class AdaptiveScan:
+    """Coarse-to-fine scan with ``stage`` (a ControlStage or
+    StageClient).
+
+    ``acquire()`` returns a frame at the current position; ``score`` is
+    the name of one of SCORES or a function of a stack of frames that
+    returns one score per frame. Cells scoring at least ``threshold``
+    are scanned at the fine step. ``settle`` is a pause (s) before each
+    capture. ``profiles`` are the speed profiles used to order the fine
+    tiles, by default those of the stage (a StageClient has none: the
+    default profiles then).
+    """
+
+    def __init__(self, stage, acquire, threshold, score="std", grow=False,
+                 settle=0.0, timeout=60, profiles=None):
+        self.stage = stage
+        if profiles is None:
+            profiles = getattr(stage, "profiles", None) or default_profiles()
+        self.profiles = profiles
+        self.acquire = acquire
+        self.threshold = threshold
+        self.score = SCORES[score] if isinstance(score, str) else score
+        self.grow = grow
+        self.settle = settle
+        self.timeout = timeout
+
+    def _capture(self, x, y):
+        self.stage.moveto(int(x), int(y))
+        self.stage.wait_idle(self.timeout)
+        if self.settle:
+            time.sleep(self.settle)
+        return self.acquire()
+
+    def run(self, x0, y0, width, height, coarse_step, fine_step,
+            visit=None):
+        """Scan the rectangle of corner (``x0``, ``y0``) and size
+        ``width`` x ``height`` (stage steps). ``visit(x, y, frame)`` is
+        called for each fine tile. Returns an AdaptiveResult."""
+        if coarse_step <= 0 or fine_step <= 0:
+            raise ValueError("The steps must be positive")
+        ratio = coarse_step // fine_step
+        if ratio < 1 or ratio * fine_step != coarse_step:
+            raise ValueError("coarse_step must be a multiple of fine_step")
+        start = time.monotonic()
+        columns = max(1, int(np.ceil(width / coarse_step)))
+        rows = max(1, int(np.ceil(height / coarse_step)))
+
+        # Coarse pass, serpentine
+        cx = _centres(x0, columns, coarse_step)
+        cy = _centres(y0, rows, coarse_step)
+        cells = [(i, j) for j in range(rows)
+                 for i in (range(columns) if j % 2 == 0
+                           else reversed(range(columns)))]
+        coarse = np.rint([(cx[i], cy[j]) for i, j in cells]).astype(int)
+        frames = [self._capture(x, y) for x, y in coarse]
+        scores = np.asarray(self.score(frames), dtype=np.float64)
+
+        interesting = np.zeros((rows, columns), dtype=bool)
+        for (i, j), score in zip(cells, scores):
+            interesting[j, i] = score >= self.threshold
+        if self.grow:
+            grown = interesting.copy()
+            grown[1:, :] |= interesting[:-1, :]
+            grown[:-1, :] |= interesting[1:, :]
+            grown[:, 1:] |= interesting[:, :-1]
+            grown[:, :-1] |= interesting[:, 1:]
+            interesting = grown
+        selected = np.array([interesting[j, i] for i, j in cells], dtype=bool)
+
+        # Fine pass over the tiles of all the selected cells at once
+        fx = _centres(x0, columns * ratio, fine_step)
+        fy = _centres(y0, rows * ratio, fine_step)
+        rows_fine, columns_fine = np.nonzero(
+            np.repeat(np.repeat(interesting, ratio, axis=0), ratio, axis=1))
+        fine = np.rint(np.column_stack([fx[columns_fine],
+                                        fy[rows_fine]])).astype(int)
+        here = self.stage.get_position()[:2]
+        fine = fine[order_tiles(fine, self.stage.gears, self.profiles, here)]
+        for x, y in fine:
+            frame = self._capture(x, y)
+            if visit is not None:
+                visit(int(x), int(y), frame)
+
+        travel = path_time(np.vstack([coarse, fine]), self.stage.gears,
+                           self.profiles)
+        return AdaptiveResult(coarse, scores, selected, fine,
+                              rows * columns * ratio * ratio, travel,
+                              time.monotonic() - start)
@@ -0,0 +1,211 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Autofocus over the Z axis.
+#
+# A focus metric turns a camera frame into a sharpness score; the
+# search moves Z to maximise it with as few captures as possible:
+#
+# 1. a coarse pass samples a few evenly spaced Z positions over the
+#    search span. The positions are known in advance, so the metric of
+#    one frame is computed in a worker thread while Z moves to the next
+#    position and settles.
+# 2. the best coarse sample and its two neighbours bracket the peak. A
+#    parabola through the three best points gives the next position,
+#    with a golden-section step when the fit is unusable, until the
+#    bracket is narrower than the tolerance.
+#
+# Positions are absolute Z coordinates in stage steps (ControlStage.moveto).
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+GOLDEN = (3 - math.sqrt(5)) / 2
+
+
+def _gray(frame):
+    frame = np.asarray(frame, dtype=np.float64)
+    if frame.ndim == 3:
+        # Colour frame: average the channels
+        frame = frame.mean(axis=2)
+    if frame.ndim != 2 or min(frame.shape) < 3:
+        raise ValueError("Expected a 2-D frame of at least 3x3 pixels")
+    return frame
+
+
+def variance_of_laplacian(frame):
+    """Variance of the 4-neighbour Laplacian of the frame."""
+    f = _gray(frame)
+    laplacian = (f[:-2, 1:-1] + f[2:, 1:-1] + f[1:-1, :-2] + f[1:-1, 2:]
+                 - 4 * f[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def brenner(frame):
+    """Brenner gradient: mean squared difference between pixels two
+    apart, horizontally and vertically."""
+    f = _gray(frame)
+    dx = f[:, 2:] - f[:, :-2]
+    dy = f[2:, :] - f[:-2, :]
+    return float((np.square(dx).sum() + np.square(dy).sum()) / f.size)
+
+
+def tenengrad(frame, threshold=0.0):
+    """Mean squared Sobel gradient magnitude, over the pixels whose
+    gradient magnitude exceeds ``threshold``."""
+    f = _gray(frame)
+    gx = ((f[:-2, 2:] + 2 * f[1:-1, 2:] + f[2:, 2:])
+          - (f[:-2, :-2] + 2 * f[1:-1, :-2] + f[2:, :-2]))
+    gy = ((f[2:, :-2] + 2 * f[2:, 1:-1] + f[2:, 2:])
+          - (f[:-2, :-2] + 2 * f[:-2, 1:-1] + f[:-2, 2:]))
+    magnitude = np.square(gx) + np.square(gy)
+    if threshold:
+        magnitude = magnitude[magnitude > threshold * threshold]
+        if magnitude.size == 0:
+            return 0.0
+    return float(magnitude.mean())
+
+
+METRICS = {
+    "laplacian": variance_of_laplacian,
+    "brenner": brenner,
+    "tenengrad": tenengrad,
+}
+
+
+class FocusResult:
+    """Outcome of an autofocus run: the best ``z`` (stage steps), its
+    ``score``, the number of ``captures`` and all the ``samples`` as a
+    sorted list of (z, score)."""
+
+    def __init__(self, z, score, samples):
+        self.z = z
+        self.score = score
+        self.samples = sorted(samples.items())
+        self.captures = len(samples)
+
+    def __repr__(self):
+        return "FocusResult(z=%r, score=%r, captures=%r)" % (
+            self.z, self.score, self.captures)
+
+
+class Autofocus:
+    """Find the Z position where ``acquire()`` returns the sharpest frame.
+
+    ``stage`` is a ControlStage (or StageClient); ``acquire`` a callable
+    returning the current camera frame as a 2-D (or colour 3-D) array.
+    ``metric`` is one of "laplacian", "brenner", "tenengrad" or a
+    callable frame -> score. ``settle`` is a pause (s) between the end of
+    a move and the capture.
+    """
+
+    def __init__(self, stage, acquire, metric="laplacian", settle=0.0,
+                 timeout=30):
+        self.stage = stage
+        self.acquire = acquire
+        self.metric = METRICS[metric] if isinstance(metric, str) else metric
+        self.settle = settle
+        self.timeout = timeout
+
+    def run(self, span, coarse=5, tolerance=1, max_captures=10, center=None):
+        """Search ``span`` stage steps of Z around ``center`` (default:
+        the current Z), leave Z at the sharpest position and return a
+        FocusResult.
+
+        ``coarse`` positions are sampled first; the refinement stops when
+        the peak is bracketed within ``tolerance`` steps or after
+        ``max_captures`` captures in total.
+        """
+        if coarse < 3:
+            raise ValueError("The coarse pass needs at least 3 positions")
+        center = self.stage.z if center is None else center
+        low = int(round(center - span / 2.0))
+        grid = sorted(set(int(round(low + i * span / (coarse - 1.0)))
+                          for i in range(coarse)))
+
+        samples = self._coarse_pass(grid)
+        self._refine(samples, tolerance, max_captures)
+
+        best = max(samples, key=samples.get)
+        self._goto(best)
+        return FocusResult(best, samples[best], samples)
+
+    def _goto(self, z):
+        self.stage.moveto(z=z)
+        self.stage.wait_idle(self.timeout)
+        if self.settle:
+            time.sleep(self.settle)
+
+    def _measure(self, z):
+        self._goto(z)
+        return self.metric(self.acquire())
+
+    def _coarse_pass(self, grid):
+        # Score frame i while Z moves to position i + 1.
+        futures = {}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            for z in grid:
+                self._goto(z)
+                futures[z] = pool.submit(self.metric, self.acquire())
+            return {z: f.result() for z, f in futures.items()}
+
+    def _refine(self, samples, tolerance, max_captures):
+        while len(samples) < max_captures:
+            zs = sorted(samples)
+            i = max(range(len(zs)), key=lambda k: samples[zs[k]])
+            a = zs[max(i - 1, 0)]
+            x = zs[i]
+            b = zs[min(i + 1, len(zs) - 1)]
+            if b - a <= 2 * tolerance:
+                return
+            u = _parabola_vertex((a, samples[a]), (x, samples[x]),
+                                 (b, samples[b]))
+            if u is None or not a < u < b or abs(u - x) < tolerance:
+                # Golden-section step into the larger side of the bracket
+                if b - x > x - a:
+                    u = x + GOLDEN * (b - x)
+                else:
+                    u = x - GOLDEN * (x - a)
+            u = int(round(u))
+            if u in samples:
+                u = x + (tolerance if b - x > x - a else -tolerance)
+                if u in samples:
+                    return
+            samples[u] = self._measure(u)
+
+
+def _parabola_vertex(p, q, r):
+    """Abscissa of the vertex of the parabola through three points, or
+    None if they are collinear or the parabola opens upwards."""
+    (x1, y1), (x2, y2), (x3, y3) = p, q, r
+    denominator = (x1 - x2) * (x1 - x3) * (x2 - x3)
+    if denominator == 0:
+        return None
+    a = (x3 * (y2 - y1) + x2 * (y1 - y3) + x1 * (y3 - y2)) / denominator
+    b = (x3 * x3 * (y1 - y2) + x2 * x2 * (y3 - y1)
+         + x1 * x1 * (y2 - y3)) / denominator
+    if a >= 0:
+        return None
+    return -b / (2 * a)
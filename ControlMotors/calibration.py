@@ -0,0 +1,211 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Calibration routines.
+#
+# Speed calibration: for one axis, run an out-and-back move at a trial
+# step rate, re-home against the limit switch and read the homing
+# offset (O) that the firmware keeps before zeroing its counters. With
+# no lost steps the axis comes back exactly where the previous homing
+# left it and the offset is (close to) zero. A binary search finds the
+# highest rate without loss and stores it in the axis's AxisProfile.
+#
+# Camera calibration: capture a frame at each point of a small grid of
+# X/Y displacements, measure the image shifts against the first frame
+# by phase correlation and fit the displacements d = P s + t by least
+# squares. The 2x2 matrix P (pixel_to_step) holds the scale, rotation
+# and shear between the camera and the X and Y axes; t absorbs a
+# constant offset such as the backlash of the first moves.
+import argparse
+import math
+import time
+
+from .config import MAX_STEP_RATE
+from .planner import MAX_BLOCK_DT, MAX_BLOCK_STEPS
+
+AXES = "xyz"
+
+
+def home_axis(stage, axis, timeout=60):
+    """Home a single axis and wait until the firmware is done."""
+    stage.home([axis], timeout)
+
+
+def lost_steps(stage, axis, rate, distance, homing_timeout=60):
+    """Move ``axis`` out by ``distance`` motor steps and back at ``rate``
+    steps/s, re-home and return the number of steps lost."""
+    dt = int(math.ceil(1000.0 * distance / rate))
+    if dt > MAX_BLOCK_DT:
+        raise ValueError("Trial move too slow for one block; "
+                         "reduce the distance or raise the rate")
+    for sign in (1, -1):
+        delta = [0, 0, 0]
+        delta[axis] = sign * distance
+        stage.handle_move(dt, *delta)
+    stage.wait_idle(homing_timeout)
+    home_axis(stage, axis, homing_timeout)
+    return stage.send_homing_offset()[axis]
+
+
+def calibrate_speed(stage, axis, distance=2000, low=None, high=None,
+                    resolution=50, tolerance=2, margin=1.0,
+                    homing_timeout=60, verbose=False):
+    """Find the highest step rate of ``axis`` that loses no steps.
+
+    ``axis`` is 0, 1, 2 or "x", "y", "z". The search runs between
+    ``low`` (default: the current profile rate, which must be reliable)
+    and ``high`` (default: 8 times ``low``), both capped at the
+    firmware's MAX_STEP_RATE, until the bracket is narrower than
+    ``resolution`` steps/s. Up to ``tolerance`` steps of homing offset
+    are accepted as switch repeatability. The result times ``margin``
+    is written into ``stage.profiles[axis].max_rate`` and returned. The
+    axis is homed first and after every trial, so the travel must have
+    room for ``distance`` motor steps. With ``verbose`` set, the outcome
+    of every trial is printed.
+    """
+    if isinstance(axis, str):
+        axis = AXES.index(axis.lower())
+    if not 0 < distance <= MAX_BLOCK_STEPS:
+        raise ValueError("distance must be between 1 and %d motor steps"
+                         % MAX_BLOCK_STEPS)
+    profile = stage.profiles[axis]
+    # The firmware cannot step faster than MAX_STEP_RATE
+    low = min(low or profile.max_rate, MAX_STEP_RATE)
+    high = min(high or 8 * low, MAX_STEP_RATE)
+
+    def reliable(rate):
+        error = lost_steps(stage, axis, rate, distance, homing_timeout)
+        if verbose:
+            print("[calibration] %s at %d steps/s: %d steps lost"
+                  % (AXES[axis].upper(), rate, error))
+        return abs(error) <= tolerance
+
+    home_axis(stage, axis, homing_timeout)
+    if not reliable(low):
+        raise RuntimeError("Axis %s already loses steps at %d steps/s"
+                           % (AXES[axis].upper(), low))
+    if reliable(high):
+        low = high
+    else:
+        while high - low > resolution:
+            middle = (low + high) // 2
+            if reliable(middle):
+                low = middle
+            else:
+                high = middle
+
+    profile.max_rate = min(int(low * margin), MAX_STEP_RATE)
+    return profile.max_rate
+
+
+def _camera_pattern(distance):
+    # 3x3 grid around the start, visited so that each step moves one
+    # axis by ``distance``
+    d = distance
+    return [(0, 0), (d, 0), (d, d), (0, d), (-d, d), (-d, 0), (-d, -d),
+            (0, -d), (d, -d)]
+
+
+def calibrate_camera(stage, acquire, distance=20, pattern=None, settle=0.0,
+                     timeout=60, window=True):
+    """Measure the pixel-to-step matrix of the camera.
+
+    The stage is moved with move_dx/move_dy through ``pattern``, a list
+    of (dx, dy) displacements in stage steps from the current position
+    (default: a 3x3 grid of pitch ``distance``), and ``acquire()`` is
+    called at each point. The displacements must keep most of the field
+    of view in common: a fraction of the frame size, not more. The stage
+    returns to its starting point; the matrix is stored in
+    ``stage.pixel_to_step`` (see save_config) and returned as a 2x2
+    array.
+    """
+    import numpy as np
+    from .drift import phase_correlation, reference_spectrum
+
+    pattern = list(pattern or _camera_pattern(distance))
+    frames = []
+    x = y = 0
+    try:
+        for dx, dy in pattern:
+            if dx != x:
+                stage.move_dx(dx - x)
+            if dy != y:
+                stage.move_dy(dy - y)
+            x, y = dx, dy
+            stage.wait_idle(timeout)
+            if settle:
+                time.sleep(settle)
+            frames.append(acquire())
+    finally:
+        if x:
+            stage.move_dx(-x)
+        if y:
+            stage.move_dy(-y)
+        stage.wait_idle(timeout)
+
+    spectrum = reference_spectrum(frames[0], window)
+    shifts = phase_correlation(spectrum, np.stack(frames), window)
+    a = np.column_stack([shifts, np.ones(len(shifts))])
+    if np.linalg.matrix_rank(a) < 3:
+        raise RuntimeError("The image shifts do not span two directions; "
+                           "check the pattern and the camera")
+    solution = np.linalg.lstsq(a, np.array(pattern, dtype=np.float64),
+                               rcond=None)[0]
+    pixel_to_step = solution[:2].T
+    stage.pixel_to_step = pixel_to_step.tolist()
+    return pixel_to_step
+
+
+def main(argv=None):
+    from .ControlMotors import ControlStage
+
+    parser = argparse.ArgumentParser(
+        prog="ControlMotors.calibration",
+        description="Find the highest reliable step rate of each axis and "
+        "store it in the stage configuration file. The stage homes "
+        "repeatedly: make sure the axes are free to move.")
+    parser.add_argument("--port", required=True, help="Serial port (e.g. COM6)")
+    parser.add_argument("--config", required=True,
+                        help="Configuration file to read and update")
+    parser.add_argument("--axes", default="xyz", help="Axes to calibrate")
+    parser.add_argument("--distance", type=int, default=2000,
+                        help="Length of the trial moves in motor steps")
+    parser.add_argument("--margin", type=float, default=0.9,
+                        help="Fraction of the measured rate to keep")
+    args = parser.parse_args(argv)
+
+    stage = ControlStage.from_config(args.port, args.config)
+    try:
+        stage.handle_enable(1)
+        for axis in args.axes.lower():
+            rate = calibrate_speed(stage, axis, args.distance,
+                                   margin=args.margin, verbose=True)
+            print("[calibration] %s: max_rate = %d steps/s" % (axis.upper(), rate))
+        stage.save_config(args.config)
+    finally:
+        stage.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,144 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Resumable scans.
+#
+# scan() visits the steps of a scan one by one and, after each
+# completed step, writes a small checkpoint file with the index of the
+# step and the stage position read back from the firmware. The file is
+# replaced atomically, so a crash leaves either the previous checkpoint
+# or the new one.
+#
+# After a fault (serial link lost, firmware in the error state, ...),
+# resume() gets the stage back into a known state, moves it to the
+# checkpoint position and continues with the next step:
+#
+# - re-attach: read the step counters back; the firmware kept its
+#   coordinates (the link was not reopened, no reset of the board);
+# - re-home: home the axes, which restores the coordinates after a
+#   reset of the board, steps lost, or the error state. Reopening the
+#   serial link resets the Arduino and zeroes its counters, so a
+#   reconnect always re-homes.
+import itertools
+import json
+import os
+import time
+
+
+class Checkpoint:
+    """Index of the last completed step of a scan, and the stage
+    position there, kept in the JSON file ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, index, position, complete=False):
+        data = {"index": index,
+                "position": list(position),
+                "complete": complete,
+                "time": time.time()}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """The saved dict, or None if there is no checkpoint."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _goto(stage, step, timeout):
+    stage.moveto(*step)
+    stage.wait_idle(timeout)
+
+
+def scan(stage, steps, checkpoint, visit=None, start=0, timeout=60):
+    """Move to each (x, y[, z]) position of ``steps`` (any iterable),
+    call ``visit(index, step)`` there and save a checkpoint.
+
+    ``start`` is the index of the first step of ``steps``. Returns the
+    number of steps completed. Errors are raised as they happen; the
+    checkpoint then points at the last completed step.
+    """
+    index = start - 1
+    for index, step in enumerate(steps, start):
+        _goto(stage, step, timeout)
+        if visit is not None:
+            visit(index, step)
+        checkpoint.save(index, stage.get_position(exact=True))
+    if index >= start:
+        checkpoint.save(index, stage.get_position(), complete=True)
+    return index - start + 1
+
+
+def resume(stage, steps, checkpoint, visit=None, home=False, axes="xyz",
+           reconnect=False, timeout=60):
+    """Continue the scan of ``steps`` after the step saved in
+    ``checkpoint`` (from the start without a checkpoint).
+
+    ``steps`` must be the same sequence, or a new generator of the same
+    sequence, as the one given to scan(). The stage is re-homed if
+    ``home`` is set or the firmware is in the error state, and
+    re-attached otherwise; ``reconnect`` reopens the serial link first,
+    which resets the board, and implies ``home``. Returns the number of
+    steps completed by this call.
+    """
+    saved = checkpoint.load()
+    if saved is not None and saved.get("complete"):
+        return 0
+    if reconnect:
+        # Opening the port resets the Arduino: the counters are lost
+        stage.reconnect()
+        home = True
+    _recover(stage, home, axes, timeout)
+    if saved is None:
+        return scan(stage, steps, checkpoint, visit, 0, timeout)
+    # Back to where the last completed step left the stage
+    _goto(stage, saved["position"], timeout)
+    start = saved["index"] + 1
+    remaining = itertools.islice(steps, start, None)
+    return scan(stage, remaining, checkpoint, visit, start, timeout)
+
+
+def _recover(stage, home, axes, timeout):
+    idle, state = stage.send_status()
+    if state == "e" or home:
+        stage.home(axes, timeout)
+        return
+    if state == "p":
+        # Paused halfway through a block: drop the rest
+        stage.handle_reset()
+    stage.invalidate_position()
+    stage.get_position(exact=True, timeout=timeout)
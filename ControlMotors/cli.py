@@ -0,0 +1,330 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Command line tools: `controlmotors run PATH` streams a path file to
+# the stage.
+#
+# A path file holds one absolute position per row, in stage steps: X, Y
+# and optionally Z. It can be
+#
+# - a .npy array of shape (n, 2) or (n, 3), memory-mapped;
+# - a raw binary file of --dtype values, --columns per row, memory-mapped;
+# - a CSV file (optionally with a header line), parsed in chunks.
+#
+# The rows are read --chunk at a time, converted to motor steps, turned
+# into M blocks (differences between consecutive points, with the
+# duration given by the speed profiles or --speed) and streamed with
+# ControlStage.execute, all chunk by chunk: the first block is sent
+# straight away and memory does not depend on the size of the file.
+# A step longer than one M block can carry is split into several
+# blocks, like MotionPlanner does.
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+from .config import MAX_STEP_RATE
+from .planner import MAX_BLOCK_DT, MAX_BLOCK_STEPS
+
+FORMATS = ("npy", "bin", "csv")
+
+
+def _guess_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return "npy"
+    if extension in (".csv", ".txt"):
+        return "csv"
+    return "bin"
+
+
+def read_points(path, format=None, columns=3, dtype="<f8", start=0,
+                stop=None, chunk=65536, delimiter=","):
+    """Yield the rows ``start`` to ``stop`` of a path file as float
+    arrays of at most ``chunk`` rows. ``columns`` and ``dtype`` describe
+    raw binary files."""
+    format = format or _guess_format(path)
+    if format not in FORMATS:
+        raise ValueError("Unknown format: %r" % (format,))
+    if format == "csv":
+        for points in _read_csv(path, start, stop, chunk, delimiter):
+            yield points
+        return
+    if format == "npy":
+        points = np.load(path, mmap_mode="r")
+        if points.ndim != 2:
+            raise ValueError("%s: expected an array of shape (n, 2) or "
+                             "(n, 3), not %s" % (path, points.shape))
+    else:
+        points = np.memmap(path, dtype=np.dtype(dtype), mode="r")
+        if points.size % columns:
+            raise ValueError("%s: size is not a whole number of %d-column "
+                             "rows" % (path, columns))
+        points = points.reshape(-1, columns)
+    if points.shape[1] not in (2, 3):
+        raise ValueError("%s: expected 2 or 3 columns, not %d"
+                         % (path, points.shape[1]))
+    stop = len(points) if stop is None else min(stop, len(points))
+    for i in range(start, stop, chunk):
+        # Only this slice is read from the disk
+        yield np.asarray(points[i:min(i + chunk, stop)], dtype=np.float64)
+
+
+def _read_csv(path, start, stop, chunk, delimiter):
+    with open(path) as f:
+        lines = (line for line in f
+                 if line.strip() and not line.lstrip().startswith("#"))
+        first = next(lines, None)
+        if first is None:
+            return
+        try:
+            [float(v) for v in first.split(delimiter)]
+        except ValueError:
+            pass  # header line
+        else:
+            lines = itertools.chain([first], lines)
+        lines = itertools.islice(lines, start, stop)
+        while True:
+            block = list(itertools.islice(lines, chunk))
+            if not block:
+                return
+            points = np.loadtxt(block, delimiter=delimiter, ndmin=2)
+            if points.shape[1] not in (2, 3):
+                raise ValueError("%s: expected 2 or 3 columns, not %d"
+                                 % (path, points.shape[1]))
+            yield points
+
+
+def motor_blocks(chunks, gears, profiles, speed=None, origin=None):
+    """Turn chunks of absolute positions (stage steps) into arrays of
+    (dt, dx, dy, dz) M blocks in motor steps.
+
+    The first position is reached from ``origin`` (motor steps), or is
+    the starting point when ``origin`` is None. Repeated positions are
+    dropped. ``dt`` is the shortest duration the speed ``profiles``
+    allow, or the time the longest axis takes at ``speed`` steps/s
+    (capped at MAX_STEP_RATE, the fastest the firmware steps). Blocks
+    over MAX_BLOCK_STEPS or MAX_BLOCK_DT are split into equal parts.
+    """
+    gears = np.asarray(gears, dtype=np.float64)
+    max_rates = np.array([p.max_rate for p in profiles], dtype=np.float64)
+    min_dts = np.array([p.min_dt for p in profiles], dtype=np.int64)
+    previous = None if origin is None else np.asarray(origin, np.int64)
+    for points in chunks:
+        if len(points) == 0:
+            continue
+        if points.shape[1] == 2:
+            # No Z column: Z stays where it is
+            z = previous[2] if previous is not None else 0
+            points = np.column_stack([points[:, :2] * gears[:2],
+                                      np.full(len(points), z)])
+        else:
+            points = points * gears
+        motor = np.rint(points).astype(np.int64)
+        if previous is None:
+            previous = motor[0]
+            motor = motor[1:]
+        deltas = np.diff(np.vstack([previous, motor]), axis=0)
+        if len(motor):
+            previous = motor[-1]
+        deltas = deltas[np.any(deltas != 0, axis=1)]
+        if len(deltas) == 0:
+            continue
+        distance = np.abs(deltas)
+        if speed:
+            rate = min(speed, MAX_STEP_RATE)
+            dt = np.ceil(1000.0 * distance.max(axis=1) / rate - 1e-9)
+            dt = np.maximum(dt, 1).astype(np.int64)
+        else:
+            durations = np.ceil(1000.0 * distance / max_rates - 1e-9)
+            durations = np.maximum(durations.astype(np.int64), min_dts)
+            dt = np.where(distance > 0, durations, 0).max(axis=1)
+        yield _split(np.column_stack([dt, deltas]))
+
+
+def _split(blocks):
+    # Cut the blocks that overflow the int16 fields of an M frame into
+    # as many equal parts as needed (see planner._split); piece k of n
+    # ends at k/n of the block, rounded towards zero.
+    largest = np.abs(blocks[:, 1:]).max(axis=1)
+    pieces = np.maximum.reduce([np.ones(len(blocks), dtype=np.int64),
+                                -(-largest // MAX_BLOCK_STEPS),
+                                -(-blocks[:, 0] // MAX_BLOCK_DT)])
+    if pieces.max() == 1:
+        return blocks
+    rows = np.repeat(np.arange(len(blocks)), pieces)
+    n = pieces[rows][:, None]
+    k = np.arange(len(rows)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    k = k[:, None] + 1
+    values = blocks[rows]
+    sign, size = np.sign(values), np.abs(values)
+    return sign * (size * k // n - size * (k - 1) // n)
+
+
+class Throughput:
+    """Block counter for the progress readout, printed at most every
+    ``interval`` seconds."""
+
+    def __init__(self, interval=2.0, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.planned = 0
+        self.motion_ms = 0
+        self.sent = 0
+        self.start = time.monotonic()
+        self._last = self.start
+
+    def plan(self, blocks):
+        """Count an array of blocks read from the file."""
+        self.planned += len(blocks)
+        self.motion_ms += int(blocks[:, 0].sum())
+
+    def tick(self, sent):
+        self.sent = sent
+        now = time.monotonic()
+        if self.interval and now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        self.stream.write("[controlmotors] %d blocks sent, %.0f blocks/s, "
+                          "%.1f s of motion read\n"
+                          % (self.sent, self.sent / elapsed,
+                             self.motion_ms / 1000.0))
+
+
+def _records(arrays, throughput):
+    from .ControlMotors import Block
+    sent = 0
+    for blocks in arrays:
+        throughput.plan(blocks)
+        for dt, dx, dy, dz in blocks.tolist():
+            yield Block(dt, dx, dy, dz)
+            sent += 1
+            if not sent & 1023:
+                throughput.tick(sent)
+    throughput.tick(sent)
+
+
+def run(args):
+    from .config import default_profiles, load_config
+    from .ControlMotors import ControlStage
+
+    chunks = read_points(args.path, args.format, args.columns, args.dtype,
+                         args.start, args.stop, args.chunk, args.delimiter)
+    throughput = Throughput(args.report)
+
+    if args.dry_run:
+        if args.config:
+            config = load_config(args.config)
+            gears, profiles = config["gears"], config["profiles"]
+        else:
+            gears, profiles = args.gears, default_profiles()
+        for blocks in motor_blocks(chunks, gears, profiles, args.speed):
+            throughput.plan(blocks)
+        print("[controlmotors] dry run: %d blocks, %.1f s of motion"
+              % (throughput.planned, throughput.motion_ms / 1000.0))
+        return 0
+
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    if args.config:
+        stage = ControlStage.from_config(args.port, args.config)
+    else:
+        stage = ControlStage(args.port, args.gears)
+    try:
+        stage.handle_enable(1)
+        stage.invalidate_position()
+        stage.get_position(exact=True)
+        # Go to the first point with one coordinated move, then stream
+        stage.moveto(*[int(round(v)) for v in first[0]],
+                     speed=args.speed)
+        origin = [p * g + r for p, g, r in
+                  zip(stage.get_position(), stage.gears, stage.remainder)]
+        arrays = motor_blocks(itertools.chain([first[1:]], chunks),
+                              stage.gears, stage.profiles, args.speed, origin)
+        stage.execute(_records(arrays, throughput), timeout=args.timeout)
+        stage.wait_idle()
+        throughput.report()
+    finally:
+        stage.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="controlmotors",
+        description="Motorised stage command line tools.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    p = commands.add_parser(
+        "run", help="Stream a path file (.npy, raw binary or CSV) of "
+        "absolute positions in stage steps to the stage")
+    p.add_argument("path", help="Path file, one X, Y[, Z] row per point")
+    p.add_argument("--port", help="Serial port (e.g. COM6); not needed "
+                   "with --dry-run")
+    p.add_argument("--gears", type=int, nargs=3, default=[1, 1, 1],
+                   metavar=("GX", "GY", "GZ"),
+                   help="Motor steps per stage step for X, Y and Z")
+    p.add_argument("--config", default=None,
+                   help="Stage configuration file; overrides --gears")
+    p.add_argument("--format", choices=FORMATS, default=None,
+                   help="File format (default: from the extension)")
+    p.add_argument("--columns", type=int, default=3,
+                   help="Values per row of a raw binary file")
+    p.add_argument("--dtype", default="<f8",
+                   help="Value type of a raw binary file (NumPy notation)")
+    p.add_argument("--delimiter", default=",", help="CSV delimiter")
+    p.add_argument("--start", type=int, default=0,
+                   help="Index of the first row to run")
+    p.add_argument("--stop", type=int, default=None,
+                   help="Index of the row to stop before")
+    p.add_argument("--speed", type=int, default=None,
+                   help="Speed of the longest axis in motor steps/s, at "
+                   "most %d (default: the speed profiles)" % MAX_STEP_RATE)
+    p.add_argument("--chunk", type=int, default=65536,
+                   help="Rows read and converted at a time")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Only count the blocks and estimate the duration")
+    p.add_argument("--report", type=float, default=2.0,
+                   help="Seconds between throughput reports (0: none)")
+    p.add_argument("--timeout", type=float, default=60,
+                   help="Give up when the firmware accepts no block for "
+                   "that many seconds")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        if not args.dry_run and not args.port:
+            parser.error("--port is required unless --dry-run is given")
+        return run(args)
+    return 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,176 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Per-axis kinematic profiles and the stage configuration file.
+#
+# The configuration is a small JSON file that stores, for one machine,
+# the gear ratios, the speed profile and the homing speeds of each axis,
+# and the camera calibration matrix (null until calibrated):
+#
+#     {"gears": [1, 100, 1],
+#      "profiles": [{"max_rate": 1000, "min_dt": 10, "acceleration": null},
+#                   ...],
+#      "homing": [{"fast": 3000, "slow": 250, "backoff": 200}, ...],
+#      "pixel_to_step": [[4.1, -0.7], [0.7, 4.1]]}
+import json
+import math
+import os
+
+# The stepper interrupt of the firmware runs 10 times per millisecond
+# and makes at most one step per axis each time (gshield.h).
+INTERRUPTS_PER_MILLISECOND = 10
+MAX_STEP_RATE = INTERRUPTS_PER_MILLISECOND * 1000
+
+# Historical behaviour of move_dx/dy/dz: one motor step per millisecond
+# and blocks of at least 10 ms.
+DEFAULT_MAX_RATE = 1000
+DEFAULT_MIN_DT = 10
+
+# Homing defaults of the Oquam firmware, for X, Y and Z.
+DEFAULT_HOMING = ((3000, 250, 200), (3000, 250, 200), (1200, 100, 80))
+
+
+class AxisProfile:
+    """Speed limits of one motor axis, in motor steps.
+
+    ``max_rate`` is the highest reliable step rate (steps/s, at most
+    MAX_STEP_RATE), ``min_dt``
+    the shortest block the axis should be given (ms) and
+    ``acceleration`` (steps/s^2) the ramp limit used by the motion
+    planner, or None to run blocks at constant speed.
+    """
+
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, min_dt=DEFAULT_MIN_DT,
+                 acceleration=None):
+        if not 0 < max_rate <= MAX_STEP_RATE:
+            raise ValueError("max_rate must be between 1 and %d steps/s, "
+                             "the firmware's limit" % MAX_STEP_RATE)
+        if min_dt < 1:
+            raise ValueError("min_dt must be at least 1 ms")
+        self.max_rate = max_rate
+        self.min_dt = int(min_dt)
+        self.acceleration = acceleration
+
+    def duration(self, steps):
+        """Return the shortest safe duration (ms) of a block of ``steps``
+        motor steps on this axis, or 0 if the axis doesn't move."""
+        if steps == 0:
+            return 0
+        return max(self.min_dt,
+                   int(math.ceil(1000.0 * abs(steps) / self.max_rate - 1e-9)))
+
+    def to_dict(self):
+        return {"max_rate": self.max_rate,
+                "min_dt": self.min_dt,
+                "acceleration": self.acceleration}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get("max_rate", DEFAULT_MAX_RATE),
+                   d.get("min_dt", DEFAULT_MIN_DT),
+                   d.get("acceleration"))
+
+    def __repr__(self):
+        return "AxisProfile(max_rate=%r, min_dt=%r, acceleration=%r)" % (
+            self.max_rate, self.min_dt, self.acceleration)
+
+
+def default_profiles():
+    return [AxisProfile() for _ in range(3)]
+
+
+class HomingProfile:
+    """Homing speeds of one motor axis, in motor steps.
+
+    The firmware seeks the limit switch at ``fast`` steps/s, backs off
+    by ``backoff`` steps and touches the switch again at ``slow``
+    steps/s; the slow pass sets the repeatability. Both speeds are at
+    most MAX_STEP_RATE, the fastest the firmware steps.
+    """
+
+    def __init__(self, fast, slow, backoff):
+        for name, value, limit in (("fast", fast, MAX_STEP_RATE),
+                                   ("slow", slow, MAX_STEP_RATE),
+                                   ("backoff", backoff, 32767)):
+            if not 0 < value <= limit:
+                raise ValueError("%s must be between 1 and %d"
+                                 % (name, limit))
+        self.fast = int(fast)
+        self.slow = int(slow)
+        self.backoff = int(backoff)
+
+    def to_dict(self):
+        return {"fast": self.fast, "slow": self.slow, "backoff": self.backoff}
+
+    @classmethod
+    def from_dict(cls, d, default=None):
+        default = default or cls(*DEFAULT_HOMING[0])
+        return cls(d.get("fast", default.fast),
+                   d.get("slow", default.slow),
+                   d.get("backoff", default.backoff))
+
+    def __repr__(self):
+        return "HomingProfile(fast=%r, slow=%r, backoff=%r)" % (
+            self.fast, self.slow, self.backoff)
+
+
+def default_homing():
+    return [HomingProfile(*speeds) for speeds in DEFAULT_HOMING]
+
+
+def load_config(path):
+    """Read a stage configuration file.
+
+    Returns a dict with at least "gears", "profiles" (a list of three
+    AxisProfile), "homing" (three HomingProfile) and "pixel_to_step" (a
+    2x2 list, or None); missing entries get their defaults.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    config.setdefault("gears", [1, 1, 1])
+    config.setdefault("pixel_to_step", None)
+    profiles = config.get("profiles") or []
+    config["profiles"] = ([AxisProfile.from_dict(p) for p in profiles]
+                          + default_profiles()[len(profiles):])
+    homing = config.get("homing") or []
+    config["homing"] = ([HomingProfile.from_dict(h, default)
+                         for h, default in zip(homing, default_homing())]
+                        + default_homing()[len(homing):])
+    return config
+
+
+def save_config(path, config):
+    """Write a stage configuration dict to ``path``.
+
+    AxisProfile and HomingProfile entries are converted to plain dicts. The file is
+    replaced atomically so that a crash never leaves it half-written.
+    """
+    data = dict(config)
+    data["profiles"] = [p.to_dict() if isinstance(p, AxisProfile) else p
+                        for p in data.get("profiles", [])]
+    data["homing"] = [h.to_dict() if isinstance(h, HomingProfile) else h
+                      for h in data.get("homing", [])]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,188 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Image-based drift compensation.
+#
+# The shift between a reference frame and the current frame is found by
+# phase correlation: the inverse FFT of the normalised cross-power
+# spectrum peaks at the shift. The sub-pixel part comes from a small
+# upsampled DFT around the peak, a few matrix products rather than a
+# larger FFT. The reference spectrum is computed once, so a measurement
+# costs one forward and one inverse FFT plus the refinement. Stacks of
+# frames are handled in one vectorised call.
+#
+# Pixel shifts become stage steps through the 2x2 `pixel_to_step`
+# matrix: moving the stage by pixel_to_step @ (sx, sy) shifts the image
+# by (sx, sy) pixels. It includes the scale, the rotation and the shear
+# between the camera and the X and Y axes (see
+# calibration.calibrate_camera).
+import numpy as np
+
+
+def _gray_stack(frames):
+    frames = np.asarray(frames, dtype=np.float64)
+    if frames.ndim >= 3 and frames.shape[-1] in (3, 4) and frames.shape[-2] > 4:
+        # Colour frames: average the channels
+        frames = frames[..., :3].mean(axis=-1)
+    return frames
+
+
+def _tukey(n, alpha=0.25):
+    # Flat in the middle, cosine taper over alpha/2 of each end
+    ramp = int(alpha * (n - 1) / 2)
+    window = np.ones(n)
+    if ramp > 0:
+        taper = 0.5 * (1 - np.cos(np.pi * np.arange(ramp) / ramp))
+        window[:ramp] = taper
+        window[n - ramp:] = taper[::-1]
+    return window
+
+
+def _window(shape):
+    # Tapering the edges removes the spurious peak at zero shift caused
+    # by the discontinuity between opposite borders; the flat middle
+    # keeps the content that moved within the frame at full weight.
+    return np.outer(_tukey(shape[0]), _tukey(shape[1]))
+
+
+def reference_spectrum(reference, window=True):
+    """Conjugate spectrum of the reference frame, for phase_correlation."""
+    reference = _gray_stack(reference)
+    if reference.ndim != 2:
+        raise ValueError("The reference must be a single frame")
+    reference = reference - reference.mean()
+    if window:
+        reference = reference * _window(reference.shape)
+    return np.conj(np.fft.fft2(reference))
+
+
+def phase_correlation(spectrum, frames, window=True, upsample=20):
+    """Shift (sx, sy) in pixels of ``frames`` relative to the reference
+    whose ``spectrum`` was computed by reference_spectrum().
+
+    ``frames`` is one frame (returns a length-2 array) or a stack of
+    frames (returns an (n, 2) array). A positive sx means the content
+    moved towards higher column indices. The result is accurate to
+    about 1/``upsample`` pixel.
+    """
+    frames = _gray_stack(frames)
+    single = frames.ndim == 2
+    if single:
+        frames = frames[np.newaxis]
+    if frames.shape[1:] != spectrum.shape:
+        raise ValueError("Frames and reference have different sizes")
+    frames = frames - frames.mean(axis=(1, 2), keepdims=True)
+    if window:
+        frames = frames * _window(spectrum.shape)
+
+    cross = np.fft.fft2(frames) * spectrum
+    magnitude = np.maximum(np.abs(cross), 1e-12)
+    correlation = np.fft.ifft2(cross / magnitude).real
+
+    # Whole-pixel peak; peaks past the middle are negative shifts
+    n, height, width = correlation.shape
+    flat = correlation.reshape(n, -1).argmax(axis=1)
+    py, px = np.unravel_index(flat, (height, width))
+    sy = np.where(py > height // 2, py - height, py).astype(np.float64)
+    sx = np.where(px > width // 2, px - width, px).astype(np.float64)
+    if upsample > 1:
+        # Full normalisation gives the sharpest whole-pixel peak but, with
+        # the window, lends the weak frequencies the window leaks into as
+        # much weight as the strong ones and biases the sub-pixel peak.
+        # Dividing by the square root of the magnitude keeps it unbiased.
+        sx, sy = _refine_peak(cross / np.sqrt(magnitude), sx, sy, upsample)
+    shifts = np.column_stack([sx, sy])
+    return shifts[0] if single else shifts
+
+
+def _refine_peak(cross, sx, sy, upsample):
+    # Evaluate the inverse DFT of the cross-power spectrum on a grid of
+    # 1/upsample pixel within +/-1 pixel of the whole-pixel peak (matrix
+    # DFT, Guizar-Sicairos et al., 2008) and take its maximum.
+    n, height, width = cross.shape
+    offsets = np.arange(-upsample, upsample + 1) / float(upsample)
+    ys = sy[:, None] + offsets
+    xs = sx[:, None] + offsets
+    fy = np.fft.fftfreq(height)
+    fx = np.fft.fftfreq(width)
+    row_kernel = np.exp(2j * np.pi * ys[:, :, None] * fy)       # (n, m, H)
+    column_kernel = np.exp(2j * np.pi * fx[:, None] * xs[:, None, :])  # (n, W, m)
+    upsampled = (row_kernel @ cross @ column_kernel).real       # (n, m, m)
+    m = len(offsets)
+    best = upsampled.reshape(n, -1).argmax(axis=1)
+    iy, ix = np.unravel_index(best, (m, m))
+    rows = np.arange(n)
+    return xs[rows, ix], ys[rows, iy]
+
+
+class DriftCorrector:
+    """Keep the field of view of ``acquire()`` on a reference frame.
+
+    ``pixel_to_step`` is the 2x2 calibration matrix described above
+    (default: ``stage.pixel_to_step``). correct() moves the stage once
+    when the drift is at least ``threshold`` stage steps on X or Y.
+    """
+
+    def __init__(self, stage, acquire, pixel_to_step=None, threshold=1.0,
+                 window=True):
+        self.stage = stage
+        self.acquire = acquire
+        if pixel_to_step is None:
+            pixel_to_step = getattr(stage, "pixel_to_step", None)
+            if pixel_to_step is None:
+                raise ValueError("The camera is not calibrated: pass "
+                                 "pixel_to_step or run calibrate_camera")
+        self.pixel_to_step = np.asarray(pixel_to_step, dtype=np.float64)
+        if self.pixel_to_step.shape != (2, 2):
+            raise ValueError("pixel_to_step must be a 2x2 matrix")
+        self.threshold = threshold
+        self.window = window
+        self.total = np.zeros(2, dtype=int)
+        self._spectrum = None
+
+    def set_reference(self, frame=None):
+        """Use ``frame`` (default: a new capture) as the reference."""
+        if frame is None:
+            frame = self.acquire()
+        self._spectrum = reference_spectrum(frame, self.window)
+
+    def measure(self, frame=None):
+        """Shift (sx, sy) in pixels of ``frame`` (default: a new capture)
+        from the reference."""
+        if self._spectrum is None:
+            raise RuntimeError("No reference frame: call set_reference first")
+        if frame is None:
+            frame = self.acquire()
+        return phase_correlation(self._spectrum, frame, self.window)
+
+    def correct(self, frame=None):
+        """Measure the drift and move it back if it is large enough.
+        Returns the correction (dx, dy) in stage steps, (0, 0) if none."""
+        shift = self.measure(frame)
+        steps = np.rint(self.pixel_to_step @ -shift).astype(int)
+        if np.abs(steps).max() < self.threshold:
+            return (0, 0)
+        dx, dy = int(steps[0]), int(steps[1])
+        self.stage.move(dx, dy, 0)
+        self.total += steps
+        return (dx, dy)
@@ -0,0 +1,474 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Python model of the Oquam firmware.
+#
+# OquamModel answers the same commands as Oquam/Oquam.ino and can stand
+# in for the ControlSerial link of a ControlStage, so that protocol and
+# motion code can be tested without a board:
+#
+#     stage.link = OquamModel()
+#
+# Time is simulated: it only moves when advance() is called, or, with
+# `speedup`, at that many times the wall clock. Blocks are executed by
+# the same Bresenham stepping as the stepper interrupt (10 interrupts
+# per millisecond), so step counts and timings match the firmware.
+# The model also keeps a "physical" position next to the step counters;
+# slip() makes them differ, like steps lost by a stalled motor, and
+# setting `homing_error` makes the next homing end in the error state.
+import re
+import time
+from collections import deque
+
+from .config import INTERRUPTS_PER_MILLISECOND
+
+# Mirrors of the firmware constants (block.h, gshield.h, Oquam.ino).
+BLOCK_BUFFER_SIZE = 32
+BLOCK_BUFFER_CAPACITY = BLOCK_BUFFER_SIZE - 1
+MAX_BATCH_BLOCKS = 3
+# Per axis: fast seek speed, slow re-touch speed (steps/s), back-off
+# (steps).
+HOMING_FAST_SPEEDS = (3000, 3000, 1200)
+HOMING_SLOW_SPEEDS = (250, 250, 100)
+HOMING_BACKOFF = (200, 200, 80)
+
+BLOCK_MOVE = 0
+BLOCK_MOVETO = 1
+BLOCK_MOVEAT = 2
+
+STATE_RUNNING = "r"
+STATE_PAUSED = "p"
+STATE_HOMING = "h"
+STATE_ERROR = "e"
+
+_FRAME = re.compile(r"^(.)(?:\[(.*)\])?$")
+
+# Number of arguments of each opcode (the handlers table of Oquam.ino)
+_ARGUMENT_COUNTS = {"m": 4, "M": 4, "B": 4 * MAX_BATCH_BLOCKS, "V": 3,
+                    "p": 0, "c": 0, "r": 0, "z": 0, "P": 0, "I": 0,
+                    "H": 0, "h": 12, "E": 1, "S": 1, "?": 0, "O": 0}
+# Error code of a frame with the wrong number of arguments
+ERROR_BAD_ARGUMENT_COUNT = -7
+
+
+def bresenham_steps(delta, dt_ms, k):
+    """Number of steps taken after ``k`` interrupts of a block moving
+    ``delta`` (>= 0) steps in ``dt_ms`` milliseconds.
+
+    Closed form of the accumulation-error loop in the stepper
+    interrupt; valid while ``delta`` does not exceed the number of
+    interrupts of the block (at most one step per interrupt).
+    """
+    if k <= 0 or delta <= 0:
+        return 0
+    period = INTERRUPTS_PER_MILLISECOND * dt_ms
+    if period <= 0:
+        return min(k, 1)
+    x = delta - period // 2 + (k - 1) * delta
+    if x <= 0:
+        return 0
+    return min(k, -((-x) // period))
+
+
+class _Block:
+    def __init__(self, type, dt, dx, dy, dz):
+        self.type = type
+        self.data = [dt, dx, dy, dz]
+        self.delta = [0, 0, 0]
+        self.dirs = [1, 1, 1]
+        self.interrupts = 0
+        self.done = [0, 0, 0]
+
+
+class _Driver:
+    def close(self):
+        pass
+
+
+class OquamModel:
+    """Simulated Oquam controller with a ControlSerial-like interface.
+
+    ``position`` is the physical position of the axes (motor steps from
+    the home switches); the step counters start at zero there. With
+    ``speedup`` set, simulated time follows the wall clock multiplied by
+    that factor; otherwise call advance().
+    """
+
+    def __init__(self, device=None, position=(0, 0, 0), speedup=None,
+                 switch_hysteresis=2):
+        self.device = device
+        self.driver = _Driver()
+        self.commands = []
+        self.state = STATE_RUNNING
+        self.enabled = False
+        self.now_ms = 0.0
+        self.speedup = speedup
+        self._last_wall = time.monotonic()
+        self.buffer = deque()
+        self.current = None
+        self.counters = [0, 0, 0]
+        self.physical = list(position)
+        self.homing_axes = [-1, -1, -1]
+        self.homing_fast_speeds = list(HOMING_FAST_SPEEDS)
+        self.homing_slow_speeds = list(HOMING_SLOW_SPEEDS)
+        self.homing_backoff = list(HOMING_BACKOFF)
+        self.homing_offset = [0, 0, 0]
+        self.switch_hysteresis = switch_hysteresis
+        self.homing_error = False
+        # (axis, end time) of the axes still to home, in order
+        self._homing_queue = deque()
+        self._interrupt_residue = 0.0
+
+    # ControlSerial interface
+
+    def send_command(self, s):
+        self.commands.append(s)
+        self._sync()
+        match = _FRAME.match(s)
+        if match is None:
+            raise RuntimeError("Invalid frame")
+        opcode, arg_string = match.groups()
+        args = [int(a) for a in arg_string.split(",")] if arg_string else []
+        handler = self._handlers.get(opcode)
+        if handler is None:
+            raise RuntimeError("Unknown opcode")
+        if len(args) != _ARGUMENT_COUNTS[opcode]:
+            # RomiSerial rejects the frame before calling the handler
+            reply = [ERROR_BAD_ARGUMENT_COUNT, "Bad number of arguments"]
+        else:
+            reply = handler(self, *args)
+        if reply[0] != 0:
+            raise RuntimeError(reply[1])
+        return reply
+
+    def close(self):
+        pass
+
+    # Simulation
+
+    def advance(self, ms):
+        """Let ``ms`` milliseconds of controller time pass."""
+        self._interrupt_residue += ms * INTERRUPTS_PER_MILLISECOND
+        interrupts = int(self._interrupt_residue)
+        self._interrupt_residue -= interrupts
+        self._run(interrupts)
+
+    def run_until_idle(self, limit_ms=10 ** 7):
+        """Advance time until every queued block has been executed."""
+        start = self.now_ms
+        while not self.is_idle():
+            if self.now_ms - start > limit_ms:
+                raise RuntimeError("Model still busy after %d ms" % limit_ms)
+            self.advance(max(1, self._time_to_next_event()))
+
+    def is_idle(self):
+        return (self.state == STATE_RUNNING
+                and not self.buffer and self.current is None)
+
+    def slip(self, axis, steps):
+        """Move an axis physically without counting the steps."""
+        self.physical[axis] += steps
+
+    def _sync(self):
+        now = time.monotonic()
+        if self.speedup:
+            self.advance((now - self._last_wall) * 1000.0 * self.speedup)
+        self._last_wall = now
+
+    def _time_to_next_event(self):
+        if self.state == STATE_HOMING:
+            return self._homing_queue[0][1] - self.now_ms
+        if self.current is not None and self.current.type != BLOCK_MOVEAT:
+            period = INTERRUPTS_PER_MILLISECOND * max(self.current.data[0], 0)
+            return (max(period, 1) - self.current.interrupts) / INTERRUPTS_PER_MILLISECOND
+        return 1
+
+    def _run(self, interrupts):
+        while interrupts > 0:
+            if self.state == STATE_HOMING:
+                axis, end = self._homing_queue[0]
+                left = max(0, int(round((end - self.now_ms)
+                                        * INTERRUPTS_PER_MILLISECOND)))
+                if left > interrupts:
+                    self._tick(interrupts)
+                    return
+                self._tick(left)
+                interrupts -= left
+                self._homing_queue.popleft()
+                self._finish_homing_axis(axis)
+                continue
+            if self.state != STATE_RUNNING:
+                # Paused or in error: the stepper timer is off.
+                self._tick(interrupts)
+                return
+            if self.current is None:
+                if not self.buffer:
+                    self._tick(interrupts)
+                    return
+                self._start_block(self.buffer.popleft())
+                if self.current is None:
+                    continue
+            interrupts -= self._step_block(interrupts)
+
+    def _tick(self, interrupts):
+        self.now_ms += float(interrupts) / INTERRUPTS_PER_MILLISECOND
+
+    def _start_block(self, block):
+        if block.type == BLOCK_MOVE and block.data[0] <= 0:
+            return
+        delta = list(block.data[1:])
+        if block.type == BLOCK_MOVETO:
+            delta = [d - c for d, c in zip(delta, self.counters)]
+        block.dirs = [1 if d >= 0 else -1 for d in delta]
+        block.delta = [abs(d) for d in delta]
+        if block.type == BLOCK_MOVETO:
+            n = max(block.delta)
+            # int32 arithmetic, stored back into the int16 DT field.
+            block.data[0] = _int16(1000 * n // block.data[0])
+        self.current = block
+
+    def _step_block(self, available):
+        block = self.current
+        dt = block.data[0]
+        if block.type == BLOCK_MOVEAT:
+            # Runs until another block is queued.
+            n = 1 if self.buffer else available
+        else:
+            period = max(INTERRUPTS_PER_MILLISECOND * dt, 1)
+            n = min(available, period - block.interrupts)
+        k = block.interrupts + n
+        for axis in range(3):
+            steps = self._steps(block, axis, k)
+            moved = block.dirs[axis] * (steps - block.done[axis])
+            self.counters[axis] += moved
+            self.physical[axis] += moved
+            block.done[axis] = steps
+        block.interrupts = k
+        self._tick(n)
+        if block.type == BLOCK_MOVEAT:
+            if self.buffer:
+                self.current = None
+        elif k >= max(INTERRUPTS_PER_MILLISECOND * dt, 1):
+            self.current = None
+        return n
+
+    def _steps(self, block, axis, k):
+        delta = block.delta[axis]
+        dt = block.data[0]
+        if delta <= INTERRUPTS_PER_MILLISECOND * dt or dt <= 0:
+            return bresenham_steps(delta, dt, k)
+        # More steps than interrupts: the firmware can only step once
+        # per interrupt, so replay its loop.
+        period = INTERRUPTS_PER_MILLISECOND * dt
+        error = delta - period // 2
+        steps = 0
+        for _ in range(k):
+            if error > 0:
+                steps += 1
+                error -= period
+            error += delta
+        return steps
+
+    # Homing
+
+    def _homing_duration(self, axis):
+        fast = self.homing_fast_speeds[axis]
+        slow = self.homing_slow_speeds[axis]
+        backoff = self.homing_backoff[axis]
+        hysteresis = self.switch_hysteresis
+        # Fast seek, back-off, release (if the back-off was too short),
+        # slow re-touch, slow release, back-off.
+        seek = max(self.physical[axis], 0) * 1000.0 / fast
+        backoff_ms = max(1, 1000 * backoff // fast)
+        release = max(hysteresis - backoff, 0) * 1000.0 / slow
+        retouch = (max(backoff, hysteresis) - hysteresis) * 1000.0 / slow
+        return (seek + release + retouch + hysteresis * 1000.0 / slow
+                + 2 * backoff_ms)
+
+    def _finish_homing_axis(self, axis):
+        # The axes are homed one after the other and the state stays
+        # STATE_HOMING until the last one is done, like do_homing().
+        if self.homing_error:
+            self._homing_queue.clear()
+            self.state = STATE_ERROR
+            return
+        if axis is not None:
+            # The switch is at physical 0. The axis ends past its
+            # release point plus the final clearance move, and the
+            # counters follow the (lossless) homing moves.
+            rest = self.switch_hysteresis + self.homing_backoff[axis]
+            self.counters[axis] += rest - self.physical[axis]
+            self.physical[axis] = rest
+        if not self._homing_queue:
+            self.homing_offset = list(self.counters)
+            self.counters = [0, 0, 0]
+            self.state = STATE_RUNNING
+
+    # Command handlers
+
+    def _can_queue(self):
+        return self.state in (STATE_RUNNING, STATE_PAUSED)
+
+    def _queue(self, type, dt, dx, dy, dz):
+        if len(self.buffer) >= BLOCK_BUFFER_CAPACITY:
+            return False
+        self.buffer.append(_Block(type, dt, dx, dy, dz))
+        return True
+
+    def _handle_moveto(self, dt, x, y, z):
+        if not self._can_queue():
+            return [101, "Invalid state"]
+        if dt <= 0:
+            return [100, "Invalid DT"]
+        if not self._queue(BLOCK_MOVETO, dt, x, y, z):
+            return [1, "Again"]
+        return [0]
+
+    def _handle_move(self, dt, dx, dy, dz):
+        if not self._can_queue():
+            return [101, "Invalid state"]
+        if dt <= 0:
+            return [100, "Invalid DT"]
+        if not self._queue(BLOCK_MOVE, dt, dx, dy, dz):
+            return [1, "Again"]
+        return [0]
+
+    def _handle_move_batch(self, *args):
+        if not self._can_queue():
+            return [101, "Invalid state"]
+        accepted = 0
+        for i in range(MAX_BATCH_BLOCKS):
+            dt, dx, dy, dz = args[4 * i:4 * i + 4]
+            if dt <= 0 or not self._queue(BLOCK_MOVE, dt, dx, dy, dz):
+                break
+            accepted += 1
+        return [0, accepted]
+
+    def _handle_moveat(self, dx, dy, dz):
+        if not self._can_queue():
+            return [101, "Invalid state"]
+        if dx == 0 and dy == 0 and dz == 0:
+            self._reset()
+        elif not self._queue(BLOCK_MOVEAT, 1000, dx, dy, dz):
+            return [1, "Again"]
+        return [0]
+
+    def _handle_pause(self):
+        if self.state == STATE_RUNNING:
+            self.state = STATE_PAUSED
+        elif self.state != STATE_PAUSED:
+            return [101, "Invalid state"]
+        return [0]
+
+    def _handle_continue(self):
+        if self.state == STATE_PAUSED:
+            self.state = STATE_RUNNING
+        elif self.state != STATE_RUNNING:
+            return [101, "Invalid state"]
+        return [0]
+
+    def _reset(self):
+        self.buffer.clear()
+        self.current = None
+
+    def _handle_reset(self):
+        if self.state in (STATE_RUNNING, STATE_PAUSED):
+            self.state = STATE_RUNNING
+            self._reset()
+            return [0]
+        return [101, "Invalid state"]
+
+    def _handle_zero(self):
+        if self.state == STATE_PAUSED or self.is_idle():
+            self.counters = [0, 0, 0]
+            return [0]
+        return [101, "Invalid state"]
+
+    def _send_position(self):
+        return [0] + list(self.counters)
+
+    def _send_idle(self):
+        return [0, int(self.is_idle()), self.state]
+
+    def _handle_homing(self):
+        self._reset()
+        end = self.now_ms
+        self._homing_queue.clear()
+        for axis in self.homing_axes:
+            if 0 <= axis < 3:
+                end += self._homing_duration(axis)
+                self._homing_queue.append((axis, end))
+        if not self._homing_queue:
+            self._homing_queue.append((None, end))
+        self.state = STATE_HOMING
+        return [0]
+
+    def _handle_set_homing(self, *args):
+        if any(v < 0 for v in args[3:]):
+            return [102, "Invalid homing speed"]
+        self.homing_axes = list(args[:3])
+        for i in range(3):
+            fast, slow, backoff = args[3 + 3 * i:6 + 3 * i]
+            if fast > 0:
+                self.homing_fast_speeds[i] = fast
+            if slow > 0:
+                self.homing_slow_speeds[i] = slow
+            if backoff > 0:
+                self.homing_backoff[i] = backoff
+        return [0]
+
+    def _handle_enable(self, enable):
+        self.enabled = bool(enable)
+        return [0]
+
+    def _handle_spindle(self, on):
+        return [0]
+
+    def _send_info(self):
+        return [0, "Oquam", "0.1", "model"]
+
+    def _send_homing_offset(self):
+        return [0] + list(self.homing_offset)
+
+    _handlers = {
+        "m": _handle_moveto,
+        "M": _handle_move,
+        "B": _handle_move_batch,
+        "V": _handle_moveat,
+        "p": _handle_pause,
+        "c": _handle_continue,
+        "r": _handle_reset,
+        "z": _handle_zero,
+        "P": _send_position,
+        "I": _send_idle,
+        "H": _handle_homing,
+        "h": _handle_set_homing,
+        "E": _handle_enable,
+        "S": _handle_spindle,
+        "?": _send_info,
+        "O": _send_homing_offset,
+    }
+
+
+def _int16(value):
+    return (value + 0x8000) % 0x10000 - 0x8000
@@ -0,0 +1,208 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Focus surface over XY.
+#
+# Autofocusing every tile of a scan is slow. A FocusMap holds the focus
+# Z measured at a few (x, y) anchors and interpolates it everywhere
+# else, either with a least-squares plane (tilted slide) or with a thin
+# plate spline (warped sample). Anchors can be added during the scan;
+# the fit is updated incrementally and solved lazily on the next query:
+#
+# - plane: the normal equations are running sums, so an anchor costs
+#   O(1) and a solve is a 3x3 system;
+# - spline: the kernel matrix is extended by one row and column instead
+#   of being rebuilt.
+#
+# scan() moves through the tiles with coordinated XY+Z moves
+# (ControlStage.moveto) and autofocuses one tile in `refocus_every`.
+import numpy as np
+
+PLANE = "plane"
+SPLINE = "spline"
+
+
+def _tps_kernel(r):
+    # U(r) = r^2 log r, with U(0) = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.square(r) * np.log(r)
+    return np.where(r > 0, u, 0.0)
+
+
+class FocusMap:
+    """Interpolated focus position Z(x, y), in stage steps.
+
+    ``method`` is "plane" or "spline" (thin plate spline). With fewer
+    than 3 anchors the map is flat at their mean Z; the spline also
+    falls back to the plane below ``min_spline`` anchors. ``smoothing``
+    (spline only) trades exact interpolation of the anchors for a
+    smoother surface.
+    """
+
+    def __init__(self, method=PLANE, smoothing=0.0, min_spline=6):
+        if method not in (PLANE, SPLINE):
+            raise ValueError("method must be %r or %r" % (PLANE, SPLINE))
+        self.method = method
+        self.smoothing = smoothing
+        self.min_spline = max(min_spline, 3)
+        self._points = np.zeros((0, 2))
+        self._z = np.zeros(0)
+        # Plane normal equations: sum of [x y 1]^T [x y 1] and [x y 1]^T z
+        self._ata = np.zeros((3, 3))
+        self._atz = np.zeros(3)
+        # Spline kernel matrix U(|p_i - p_j|)
+        self._kernel = np.zeros((0, 0))
+        self._plane = None
+        self._spline = None
+
+    def __len__(self):
+        return len(self._z)
+
+    @property
+    def anchors(self):
+        """The anchors as an (n, 3) array of x, y, z."""
+        return np.column_stack([self._points, self._z])
+
+    @property
+    def ready(self):
+        """True once the anchors determine a plane: at least 3 of them,
+        not all on one line."""
+        if len(self._z) < 3:
+            return False
+        centered = self._points - self._points.mean(axis=0)
+        return np.linalg.matrix_rank(centered) == 2
+
+    def add(self, x, y, z):
+        """Add the focus ``z`` measured at (``x``, ``y``)."""
+        p = np.array([float(x), float(y)])
+        row = np.array([p[0], p[1], 1.0])
+        self._ata += np.outer(row, row)
+        self._atz += row * z
+        if self.method == SPLINE:
+            r = np.sqrt(np.square(self._points - p).sum(axis=1))
+            k = _tps_kernel(r)
+            n = len(self._z)
+            kernel = np.empty((n + 1, n + 1))
+            kernel[:n, :n] = self._kernel
+            kernel[n, :n] = kernel[:n, n] = k
+            kernel[n, n] = 0.0
+            self._kernel = kernel
+        self._points = np.vstack([self._points, p])
+        self._z = np.append(self._z, float(z))
+        self._plane = self._spline = None
+
+    def z_at(self, x, y):
+        """Interpolated Z at (``x``, ``y``); scalars or arrays."""
+        if len(self._z) == 0:
+            raise ValueError("The focus map has no anchors")
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(self._z) < 3:
+            z = np.full(np.broadcast(x, y).shape, self._z.mean())
+        elif self.method == SPLINE and len(self._z) >= self.min_spline:
+            z = self._eval_spline(x, y)
+        else:
+            a, b, c = self._solve_plane()
+            z = a * x + b * y + c
+        return float(z) if z.ndim == 0 else z
+
+    def residuals(self):
+        """Difference between the map and the measured Z at each anchor."""
+        return self.z_at(self._points[:, 0], self._points[:, 1]) - self._z
+
+    def _solve_plane(self):
+        if self._plane is None:
+            # lstsq copes with collinear anchors
+            self._plane = np.linalg.lstsq(self._ata, self._atz, rcond=None)[0]
+        return self._plane
+
+    def _solve_spline(self):
+        if self._spline is None:
+            n = len(self._z)
+            system = np.zeros((n + 3, n + 3))
+            system[:n, :n] = self._kernel + self.smoothing * np.eye(n)
+            system[:n, n] = system[n, :n] = 1.0
+            system[:n, n + 1:] = self._points
+            system[n + 1:, :n] = self._points.T
+            rhs = np.concatenate([self._z, np.zeros(3)])
+            self._spline = np.linalg.lstsq(system, rhs, rcond=None)[0]
+        return self._spline
+
+    def _eval_spline(self, x, y):
+        coefficients = self._solve_spline()
+        n = len(self._z)
+        weights, c, a, b = (coefficients[:n], coefficients[n],
+                            coefficients[n + 1], coefficients[n + 2])
+        shape = np.broadcast(x, y).shape
+        px = np.broadcast_to(x, shape).reshape(-1, 1)
+        py = np.broadcast_to(y, shape).reshape(-1, 1)
+        r = np.sqrt(np.square(px - self._points[:, 0])
+                    + np.square(py - self._points[:, 1]))
+        z = _tps_kernel(r) @ weights + c + a * px[:, 0] + b * py[:, 0]
+        return z.reshape(shape)
+
+
+def measure_anchors(stage, autofocus, points, focus_map, span):
+    """Autofocus at each (x, y) of ``points`` and add the results to
+    ``focus_map``. The search is centred on the current prediction once
+    the map has anchors."""
+    for x, y in points:
+        center = focus_map.z_at(x, y) if len(focus_map) else stage.z
+        stage.moveto(x, y, int(round(center)))
+        result = autofocus.run(span, center=int(round(center)))
+        focus_map.add(x, y, result.z)
+    return focus_map
+
+
+def scan(stage, tiles, focus_map, visit=None, autofocus=None,
+         refocus_every=20, span=100):
+    """Visit the (x, y) ``tiles`` with Z taken from ``focus_map``.
+
+    Each tile is reached with one coordinated XY+Z move. When an
+    ``autofocus`` is given, every ``refocus_every``-th tile is
+    autofocused over ``span`` steps around the prediction and added as
+    an anchor; so is every tile until the anchors determine a plane,
+    since a map fitted on one row of tiles cannot predict the next row.
+    Measuring a few spread-out anchors first (measure_anchors) avoids
+    that. ``visit(x, y, z)`` is then called, typically to take the
+    picture. Returns the list of (x, y, z) visited.
+    """
+    visited = []
+    for i, (x, y) in enumerate(tiles):
+        if len(focus_map):
+            z = int(round(focus_map.z_at(x, y)))
+        elif autofocus is not None:
+            z = stage.z
+        else:
+            raise ValueError("The focus map has no anchors")
+        stage.moveto(x, y, z)
+        if autofocus is not None and (not focus_map.ready
+                                      or i % refocus_every == 0):
+            z = autofocus.run(span, center=z).z
+            focus_map.add(x, y, z)
+        else:
+            stage.wait_idle()
+        if visit is not None:
+            visit(x, y, z)
+        visited.append((x, y, z))
+    return visited
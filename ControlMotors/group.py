@@ -0,0 +1,169 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Drive several Oquam controllers (one Arduino per stage) from one host.
+#
+# Each stage gets its own single-thread I/O worker, so commands for one
+# port never wait on the round trip of another: the wall time of a
+# group-wide operation is that of the slowest stage, not the sum.
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .ControlMotors import ControlStage
+
+
+class StageGroup:
+    """A set of ControlStages driven in parallel."""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._workers = [ThreadPoolExecutor(max_workers=1)
+                         for _ in self.stages]
+        self.start_times = []
+
+    @classmethod
+    def open(cls, ports, gears):
+        """Open one ControlStage per port, all at the same time.
+
+        ``gears`` is either one gear triple shared by every stage or one
+        triple per port.
+        """
+        ports = list(ports)
+        if gears and not isinstance(gears[0], (list, tuple)):
+            gears = [gears] * len(ports)
+        with ThreadPoolExecutor(max_workers=max(1, len(ports))) as pool:
+            stages = list(pool.map(ControlStage, ports, gears))
+        return cls(stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __getitem__(self, i):
+        return self.stages[i]
+
+    def submit(self, i, fn, *args, **kwargs):
+        """Run ``fn(stage, *args, **kwargs)`` on the worker of stage ``i``
+        and return its Future."""
+        return self._workers[i].submit(fn, self.stages[i], *args, **kwargs)
+
+    def map(self, fn, *per_stage_args):
+        """Run ``fn(stage, *args)`` on every stage concurrently.
+
+        ``per_stage_args`` are sequences with one entry per stage. The
+        results are returned in stage order once all stages are done;
+        the first exception, if any, is raised after that.
+        """
+        if per_stage_args:
+            args = list(zip(*per_stage_args))
+        else:
+            args = [()] * len(self.stages)
+        futures = [self.submit(i, fn, *a) for i, a in enumerate(args)]
+        return _gather(futures)
+
+    def call(self, method, *args, **kwargs):
+        """Call the same ControlStage method on every stage."""
+        return self.map(lambda stage: getattr(stage, method)(*args, **kwargs))
+
+    def move(self, moves):
+        """Queue one coordinated move per stage.
+
+        ``moves[i]`` is a (dx, dy, dz) displacement in stage steps for
+        stage i, or None to leave that stage alone.
+        """
+        def move_one(stage, delta):
+            if delta is not None:
+                stage.move(*delta)
+        return self.map(move_one, moves)
+
+    def synchronized_start(self, plans):
+        """Start the plans of all stages at (nearly) the same moment.
+
+        ``plans[i]`` is a list of (dx, dy, dz) moves in stage steps, or a
+        callable ``plan(stage)`` that queues its own blocks, for stage i.
+        Every stage is paused (``p``) and its block buffer filled,
+        including the moves held back by its lookahead or batching; then
+        all the workers meet at a barrier and send ``c`` together. The
+        firmware buffers at most 31 blocks, so a plan must fit in that
+        while the stage is paused.
+
+        Returns the measured skew in seconds: the spread between the
+        earliest and the latest ``c`` round trips, each taken at its
+        midpoint.
+        """
+        self.call("handle_pause")
+
+        def prefill(stage, plan):
+            if callable(plan):
+                plan(stage)
+            else:
+                for delta in plan:
+                    stage.move(*delta)
+            # Otherwise c would send them after the barrier
+            stage.flush()
+        self.map(prefill, plans)
+
+        barrier = threading.Barrier(len(self.stages))
+
+        def start(stage):
+            barrier.wait()
+            sent = time.perf_counter()
+            stage.handle_continue()
+            return (sent + time.perf_counter()) / 2
+
+        self.start_times = self.map(start)
+        return max(self.start_times) - min(self.start_times)
+
+    def home(self, axes="xyz", timeout=60):
+        """Home all the stages at the same time; see ControlStage.home.
+        Takes as long as the slowest stage rather than the sum."""
+        return self.map(lambda stage: stage.home(axes, timeout))
+
+    def wait_idle(self, timeout=None, interval=0.05):
+        """Block until every stage has executed all its queued moves."""
+        return self.map(lambda stage: stage.wait_idle(timeout, interval))
+
+    def close(self):
+        try:
+            self.call("close")
+        finally:
+            for worker in self._workers:
+                worker.shutdown(wait=True)
+
+
+def _gather(futures):
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+    return results
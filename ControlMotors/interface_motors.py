@@ -21,13 +21,8 @@
   <http://www.gnu.org/licenses/>.
 
 """
-import numpy as np
-import tkinter as tk
-from tkinter import ttk, messagebox
 import argparse
 from ControlMotors import ControlStage
-import sys
-from serial.tools import list_ports
 import threading
 
 
@@ -36,6 +31,12 @@ def interface_motors(stage=None):
 
     """--------Params-----------"""
 
+    # Tk and the port-listing tools are only needed once the window is
+    # opened; importing them here keeps `import ControlMotors` light.
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+    from serial.tools import list_ports
+
     root = tk.Tk()
     root.title('Command interface')
     # Medium-sized window
@@ -0,0 +1,301 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Well plates and sample holders.
+#
+# A Layout is a grid of wells (or slots of a holder), rows x columns,
+# defined by the stage position of well A1, the pitch and the rotation
+# of the plate on the stage, or measured from three corner wells. It is
+# compiled once into an array of the stage positions of all the wells
+# and a dict from the well IDs ("A1", "H12", "AF48") to their index, so
+# looking a well up is O(1) and a list of wells is one array lookup.
+#
+# A FocusCache keeps the last good focus Z of each well, in an array
+# indexed like the layout. visit_wells() goes through the wells in a
+# short order (routing.order_tiles) and autofocuses each of them over a
+# narrow range around its cached Z, or around the Z predicted from the
+# focused wells (a FocusMap plane, or the nearest focused well); only
+# the first well, or a well whose narrow search fails, needs a full
+# search.
+import json
+import math
+import os
+import string
+
+import numpy as np
+
+from .focusmap import FocusMap
+from .routing import order_tiles
+
+# Standard plates (ANSI/SLAS footprint): rows, columns, pitch (mm)
+FORMATS = {
+    "6": (2, 3, 39.12),
+    "12": (3, 4, 26.01),
+    "24": (4, 6, 19.30),
+    "48": (6, 8, 13.08),
+    "96": (8, 12, 9.0),
+    "384": (16, 24, 4.5),
+    "1536": (32, 48, 2.25),
+}
+
+
+def row_name(row):
+    """Letters of a row: A to Z, then AA, AB, ..."""
+    letters = string.ascii_uppercase
+    if row < 26:
+        return letters[row]
+    return letters[row // 26 - 1] + letters[row % 26]
+
+
+class Layout:
+    """Grid of ``rows`` x ``columns`` wells, ``pitch`` stage steps apart
+    (one value, or the column and row pitches), with well A1 at stage
+    position ``origin`` (x, y). ``rotation`` (degrees) is the angle of
+    the rows on the stage; columns run along +X and rows along +Y before
+    the rotation.
+    """
+
+    def __init__(self, rows, columns, pitch, origin=(0, 0), rotation=0.0,
+                 name=None):
+        if rows < 1 or columns < 1:
+            raise ValueError("A layout needs at least one row and column")
+        if np.ndim(pitch) == 0:
+            pitch = (pitch, pitch)
+        angle = math.radians(rotation)
+        c, s = math.cos(angle), math.sin(angle)
+        self.rows = rows
+        self.columns = columns
+        self.name = name
+        self._compile(origin, (pitch[0] * c, pitch[0] * s),
+                      (-pitch[1] * s, pitch[1] * c))
+
+    @classmethod
+    def plate(cls, format, steps_per_mm, origin=(0, 0), rotation=0.0):
+        """A standard plate ("6" to "1536" wells, see FORMATS);
+        ``steps_per_mm`` converts its pitch to stage steps."""
+        rows, columns, pitch = FORMATS[str(format)]
+        return cls(rows, columns, pitch * steps_per_mm, origin, rotation,
+                   "%s-well plate" % format)
+
+    @classmethod
+    def from_corners(cls, rows, columns, first, row_end, column_end,
+                     name=None):
+        """The layout through the measured stage positions of well A1
+        (``first``), of the last well of row A (``row_end``) and of the
+        last well of column 1 (``column_end``). Accounts for rotation,
+        different X and Y scales and a slight skew."""
+        if rows < 2 or columns < 2:
+            raise ValueError("from_corners needs at least 2 rows and "
+                             "2 columns")
+        layout = cls(rows, columns, 1.0, first, name=name)
+        first = np.asarray(first, dtype=np.float64)
+        layout._compile(first,
+                        (np.asarray(row_end) - first) / (columns - 1),
+                        (np.asarray(column_end) - first) / (rows - 1))
+        return layout
+
+    def _compile(self, origin, column_step, row_step):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.column_step = np.asarray(column_step, dtype=np.float64)
+        self.row_step = np.asarray(row_step, dtype=np.float64)
+        r, c = np.mgrid[0:self.rows, 0:self.columns]
+        xy = (self.origin + c[..., None] * self.column_step
+              + r[..., None] * self.row_step)
+        # One row per well, A1, A2, ..., B1, ...
+        self.positions = np.rint(xy.reshape(-1, 2)).astype(np.int64)
+        self.wells = ["%s%d" % (row_name(i), j + 1)
+                      for i in range(self.rows) for j in range(self.columns)]
+        self._index = {well: k for k, well in enumerate(self.wells)}
+
+    def __len__(self):
+        return len(self.wells)
+
+    def __contains__(self, well):
+        return str(well).upper() in self._index
+
+    def __repr__(self):
+        return "Layout(%r, rows=%d, columns=%d)" % (self.name, self.rows,
+                                                   self.columns)
+
+    def index(self, well):
+        """Index of a well ID ("B3") or (row, column) pair (0-based)."""
+        if isinstance(well, str):
+            try:
+                return self._index[well.upper()]
+            except KeyError:
+                raise KeyError("No well %r in %r" % (well, self)) from None
+        row, column = well
+        if not (0 <= row < self.rows and 0 <= column < self.columns):
+            raise KeyError("No well %r in %r" % (well, self))
+        return row * self.columns + column
+
+    def position(self, well):
+        """Stage position (x, y) of a well."""
+        x, y = self.positions[self.index(well)]
+        return int(x), int(y)
+
+    def lookup(self, wells):
+        """Stage positions of a list of wells, as an (n, 2) array."""
+        return self.positions[[self.index(w) for w in wells]]
+
+    def to_dict(self):
+        return {"name": self.name,
+                "rows": self.rows,
+                "columns": self.columns,
+                "origin": self.origin.tolist(),
+                "column_step": self.column_step.tolist(),
+                "row_step": self.row_step.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        layout = cls(data["rows"], data["columns"], 1.0, data["origin"],
+                     name=data.get("name"))
+        layout._compile(data["origin"], data["column_step"],
+                        data["row_step"])
+        return layout
+
+
+class FocusCache:
+    """Last good focus Z of the wells of ``layout`` (NaN while unknown),
+    kept in the JSON file ``path`` if given."""
+
+    def __init__(self, layout, path=None):
+        self.layout = layout
+        self.path = path
+        self.z = np.full(len(layout), np.nan)
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.z)))
+
+    def get(self, well):
+        """Cached Z of a well, or None."""
+        z = self.z[self.layout.index(well)]
+        return None if np.isnan(z) else float(z)
+
+    def set(self, well, z):
+        self.z[self.layout.index(well)] = z
+
+    def forget(self, well=None):
+        """Drop the Z of a well, or of all of them."""
+        if well is None:
+            self.z[:] = np.nan
+        else:
+            self.z[self.layout.index(well)] = np.nan
+
+    def predict(self, well):
+        """Cached Z of a well, else the Z of a plane through the cached
+        wells, or that of the nearest one while they are on a line;
+        None if no well is cached."""
+        z = self.get(well)
+        if z is not None or len(self) == 0:
+            return z
+        known = ~np.isnan(self.z)
+        points = self.layout.positions[known]
+        focus_map = FocusMap()
+        for (x, y), z in zip(points, self.z[known]):
+            focus_map.add(float(x), float(y), float(z))
+        x, y = self.layout.position(well)
+        if focus_map.ready:
+            return float(focus_map.z_at(x, y))
+        nearest = np.argmin(np.square(points - (x, y)).sum(axis=1))
+        return float(self.z[known][nearest])
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        for well, z in data.get("z", {}).items():
+            if well in self.layout:
+                self.set(well, z)
+
+    def save(self):
+        known = ~np.isnan(self.z)
+        data = {"layout": self.layout.to_dict(),
+                "z": {self.layout.wells[k]: float(self.z[k])
+                      for k in np.flatnonzero(known)}}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp, self.path)
+
+
+def _in_focus(result, min_score):
+    # The peak must be inside the searched range, not on its border
+    zs = [z for z, _ in result.samples]
+    if result.z in (zs[0], zs[-1]):
+        return False
+    return min_score is None or result.score >= min_score
+
+
+def visit_wells(stage, layout, wells=None, autofocus=None, cache=None,
+                visit=None, span=40, full_span=400, min_score=None,
+                order=True, timeout=60):
+    """Visit ``wells`` (default: all of them) of ``layout``.
+
+    Each well is reached with one coordinated XY+Z move. With an
+    ``autofocus``, Z is searched over ``span`` steps around the cached
+    (or predicted) Z of the well, or over ``full_span`` around the Z of
+    the previous well when there is none or the narrow search fails
+    (the best position is on the border of the range, or scores below
+    ``min_score``). Good results are stored in ``cache`` (saved after
+    each well if it has a path). ``visit(well, x, y, z)`` is then
+    called. The wells are visited in a short order unless ``order`` is
+    False. Returns the list of (well, x, y, z).
+    """
+    wells = list(layout.wells if wells is None else wells)
+    if cache is None:
+        cache = FocusCache(layout)
+    if order and len(wells) > 2:
+        here = stage.get_position()[:2]
+        wells = [wells[k] for k in order_tiles(layout.lookup(wells),
+                                               stage.gears, stage.profiles,
+                                               here)]
+    visited = []
+    for well in wells:
+        x, y = layout.position(well)
+        predicted = cache.predict(well)
+        previous = stage.z
+        z = previous if predicted is None else int(round(predicted))
+        stage.moveto(x, y, z)
+        if autofocus is not None:
+            result = None
+            if predicted is not None:
+                result = autofocus.run(span, center=z)
+            if result is None or not _in_focus(result, min_score):
+                # Full search from where the last well was in focus
+                result = autofocus.run(full_span, center=previous)
+            z = result.z
+            if _in_focus(result, min_score):
+                cache.set(well, z)
+                if cache.path is not None:
+                    cache.save()
+        else:
+            stage.wait_idle(timeout)
+        if visit is not None:
+            visit(well, x, y, z)
+        visited.append((well, x, y, z))
+    return visited
@@ -0,0 +1,104 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Lookahead merger for relative moves.
+#
+# Paths from tracking or drawing code are long runs of tiny, mostly
+# collinear increments. Sent one by one, each costs a frame, a firmware
+# block and at least the minimum block time. The Lookahead holds the
+# moves back and merges consecutive ones into a single segment as long
+# as every intermediate point stays within `tolerance` motor steps of
+# the merged straight line and the segment fits in an M frame.
+import math
+
+from .planner import MAX_BLOCK_STEPS
+
+
+class Lookahead:
+    """Merge consecutive collinear relative moves (in motor steps).
+
+    ``window`` is the maximum number of moves merged into one segment;
+    ``tolerance`` the largest distance (motor steps) an intermediate
+    point of the original path may have from the merged segment.
+    """
+
+    def __init__(self, window=64, tolerance=0.5):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        self.tolerance = tolerance
+        self._points = []
+        self.merged = 0
+
+    @property
+    def pending(self):
+        """The displacement held back, (0, 0, 0) if none."""
+        return self._points[-1] if self._points else (0, 0, 0)
+
+    def push(self, dx, dy, dz):
+        """Add a move; return the list of segments ready to be sent."""
+        delta = (int(dx), int(dy), int(dz))
+        if delta == (0, 0, 0):
+            return []
+        if not self._points:
+            self._points.append(delta)
+            return []
+        total = self._points[-1]
+        candidate = tuple(t + d for t, d in zip(total, delta))
+        if self._can_merge(total, delta, candidate):
+            self._points.append(candidate)
+            self.merged += 1
+            return []
+        self._points = [delta]
+        return [total]
+
+    def flush(self):
+        """Return the segment held back (or None) and empty the buffer."""
+        if not self._points:
+            return None
+        segment = self._points[-1]
+        self._points = []
+        return segment
+
+    def clear(self):
+        """Drop the moves held back."""
+        self._points = []
+
+    def _can_merge(self, total, delta, candidate):
+        if len(self._points) >= self.window:
+            return False
+        if any(abs(c) > MAX_BLOCK_STEPS for c in candidate):
+            return False
+        # Same direction: no reversal, which would also hide backlash.
+        if sum(t * d for t, d in zip(total, delta)) <= 0:
+            return False
+        length = math.sqrt(sum(c * c for c in candidate))
+        return all(_distance_to_line(p, candidate, length) <= self.tolerance
+                   for p in self._points)
+
+
+def _distance_to_line(p, direction, length):
+    cx = p[1] * direction[2] - p[2] * direction[1]
+    cy = p[2] * direction[0] - p[0] * direction[2]
+    cz = p[0] * direction[1] - p[1] * direction[0]
+    return math.sqrt(cx * cx + cy * cy + cz * cz) / length
@@ -0,0 +1,282 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Z axis made of the stepper of the stage (coarse) and a piezo (fine).
+#
+# The Z-stage/PiezoThorlabs setup drives the micrometer of a Thorlabs
+# stage with a stepper and its piezo with a KPZ101: the piezo has a
+# short travel (20 um) but moves in a few milliseconds with no backlash
+# and no mechanical settling, the geared stepper has the full travel but
+# is slow to move and to settle.
+#
+# A FineActuator is any such short-range actuator; SimulatedPiezo is a
+# stand-in for tests and dry runs, and a driver for real hardware only
+# has to implement move_to() and the travel.
+#
+# HybridZ combines the two into one Z axis in micrometres:
+#
+#   z = stepper steps * um_per_step + (piezo position - piezo centre)
+#
+# A move whose target the piezo can reach from the current stepper
+# position is made with the piezo alone; a larger one moves the stepper
+# to the nearest step and the piezo takes the remainder. zstack() places
+# the stepper once so that the whole stack fits in the piezo travel and
+# then only moves the piezo.
+#
+# recenter() brings a piezo left near the end of its travel back
+# towards its centre, from a background thread: the stepper moves by the
+# whole steps of the piezo offset and the piezo back by as much, so z
+# ends where it was. z is not steady meanwhile, so it runs when the
+# caller is not imaging (after a z-stack, while XY moves to the next
+# field); the next move waits for it to finish. The stepper move is a
+# relative Z-only move, so it does not undo an XY move sent by the
+# caller in the meantime (ControlStage serializes the two).
+import threading
+import time
+
+
+class FineActuator:
+    """Short-range actuator (piezo) of a hybrid axis, positions in
+    micrometres.
+
+    Subclasses implement ``move_to`` and set ``travel`` (low, high) and
+    ``settle_time`` (s, the time to wait after a move before imaging).
+    """
+
+    travel = (0.0, 20.0)
+    settle_time = 0.0
+
+    @property
+    def center(self):
+        low, high = self.travel
+        return (low + high) / 2.0
+
+    @property
+    def position(self):
+        raise NotImplementedError()
+
+    def move_to(self, position):
+        """Move to ``position`` (um) and return once it is reached."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SimulatedPiezo(FineActuator):
+    """A FineActuator that only records its moves."""
+
+    def __init__(self, travel=(0.0, 20.0), settle_time=0.002):
+        self.travel = tuple(travel)
+        self.settle_time = settle_time
+        self.moves = []
+        self._position = self.center
+
+    @property
+    def position(self):
+        return self._position
+
+    def move_to(self, position):
+        low, high = self.travel
+        if not low - 1e-9 <= position <= high + 1e-9:
+            raise ValueError("Piezo position %.3f out of its travel "
+                             "[%.3f, %.3f]" % (position, low, high))
+        self._position = min(max(position, low), high)
+        self.moves.append(self._position)
+
+
+class HybridZ:
+    """Z axis of ``stage`` (a ControlStage or StageClient) refined by
+    the FineActuator ``piezo``. ``um_per_step`` is the size of one stage
+    Z step in micrometres.
+
+    Piezo moves stay ``margin`` (a fraction of the travel) away from its
+    ends; recenter() acts when the piezo is within ``recenter_margin``
+    of them, and runs after each zstack() if ``recenter_after`` is set.
+    ``settle`` (s) is the pause after stepper moves, the settle_time of
+    the piezo the pause after piezo moves.
+    """
+
+    def __init__(self, stage, piezo, um_per_step, margin=0.05,
+                 recenter_margin=0.25, recenter_after=True, settle=0.05,
+                 timeout=60, sleep=time.sleep):
+        if um_per_step <= 0:
+            raise ValueError("um_per_step must be positive")
+        low, high = piezo.travel
+        if um_per_step > (1 - 2 * margin) * (high - low):
+            raise ValueError("A stepper step (%.3f um) is longer than the "
+                             "usable piezo travel" % um_per_step)
+        self.stage = stage
+        self.piezo = piezo
+        self.um_per_step = float(um_per_step)
+        self.margin = margin
+        self.recenter_margin = recenter_margin
+        self.recenter_after = recenter_after
+        self.settle = settle
+        self.timeout = timeout
+        self.sleep = sleep
+        self.coarse_moves = 0
+        self.fine_moves = 0
+        self.recenters = 0
+        self._lock = threading.RLock()
+        self._thread = None
+        self._error = None
+
+    def _limits(self, margin):
+        low, high = self.piezo.travel
+        edge = margin * (high - low)
+        return low + edge, high - edge
+
+    @property
+    def offset(self):
+        """Piezo position relative to its centre (um)."""
+        return self.piezo.position - self.piezo.center
+
+    @property
+    def z(self):
+        """Position of the axis (um)."""
+        with self._lock:
+            return self.stage.z * self.um_per_step + self.offset
+
+    def wait(self):
+        """Wait for a background re-centring to finish; raise its error
+        if it failed."""
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _move_piezo(self, position):
+        self.piezo.move_to(position)
+        if self.piezo.settle_time:
+            self.sleep(self.piezo.settle_time)
+
+    def move_to(self, z):
+        """Move the axis to ``z`` (um)."""
+        self.wait()
+        with self._lock:
+            low, high = self._limits(self.margin)
+            target = self.piezo.center + z - self.stage.z * self.um_per_step
+            if low <= target <= high:
+                self._move_piezo(target)
+                self.fine_moves += 1
+            else:
+                self._coarse(z)
+
+    def move_by(self, dz):
+        self.move_to(self.z + dz)
+
+    def _coarse(self, z):
+        # Stepper to the nearest step, the piezo takes the rest
+        steps = int(round(z / self.um_per_step))
+        self.stage.moveto(z=steps)
+        self.stage.wait_idle(self.timeout)
+        if self.settle:
+            self.sleep(self.settle)
+        self._move_piezo(self.piezo.center + z - steps * self.um_per_step)
+        self.coarse_moves += 1
+
+    def recenter(self, wait=False):
+        """Bring the piezo back towards the centre of its travel if it is
+        within ``recenter_margin`` of an end: the stepper moves by the
+        whole steps of the piezo offset and the piezo back by as much,
+        keeping z. Runs in the background unless ``wait`` is set; z
+        moves while the stepper does, so call it when not imaging, e.g.
+        while XY moves to the next field. Returns True if it started."""
+        self.wait()
+        low, high = self._limits(self.recenter_margin)
+        if low <= self.piezo.position <= high:
+            return False
+        if wait:
+            self._recenter()
+            return True
+        self._thread = threading.Thread(target=self._recenter_worker,
+                                        daemon=True)
+        self._thread.start()
+        return True
+
+    def _recenter_worker(self):
+        try:
+            self._recenter()
+        except Exception as e:
+            self._error = e
+
+    def _recenter(self):
+        with self._lock:
+            steps = int(round(self.offset / self.um_per_step))
+            if steps == 0:
+                return
+            z = self.z
+            # Relative and Z only: an XY move made meanwhile is kept
+            self.stage.move(dz=steps)
+            self.stage.wait_idle(self.timeout)
+            if self.settle:
+                self.sleep(self.settle)
+            self._move_piezo(self.piezo.center + z
+                             - self.stage.z * self.um_per_step)
+            self.recenters += 1
+
+    def zstack(self, start, stop, step, visit):
+        """Visit the planes ``start``, ``start + step``, ... up to
+        ``stop`` (um, included) and call ``visit(z)`` at each of them.
+
+        The stepper is placed once so that the stack is centred in the
+        piezo travel; stacks longer than the travel are taken in as
+        many parts. The piezo is re-centred in the background after the
+        last plane if ``recenter_after`` is set. Returns the list of z
+        visited."""
+        if step == 0:
+            raise ValueError("step must not be 0")
+        count = int((stop - start) / step + 1e-9) + 1
+        planes = [start + i * step for i in range(max(count, 0))]
+        low, high = self._limits(self.margin)
+        # Room for the rounding of the stepper position
+        span = high - low - self.um_per_step
+        visited = []
+        i = 0
+        while i < len(planes):
+            # Planes that fit in the piezo travel together
+            j = i
+            while (j + 1 < len(planes)
+                   and abs(planes[j + 1] - planes[i]) <= span):
+                j += 1
+            self.wait()
+            with self._lock:
+                base = self.stage.z * self.um_per_step - self.piezo.center
+                bottom = min(planes[i], planes[j])
+                top = max(planes[i], planes[j])
+                if not low <= bottom - base <= top - base <= high:
+                    self._coarse((bottom + top) / 2.0)
+                for z in planes[i:j + 1]:
+                    self._move_piezo(self.piezo.center + z
+                                     - self.stage.z * self.um_per_step)
+                    self.fine_moves += 1
+                    visit(z)
+                    visited.append(z)
+            i = j + 1
+        if self.recenter_after:
+            self.recenter()
+        return visited
@@ -0,0 +1,191 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Pipelined acquisition: motion, capture and processing overlap.
+#
+#   motion thread --(positioned, 1)--> capture --(free slots, depth)--> pool
+#
+# - motion: moves to a tile and waits for the stage to be idle. It starts
+#   the move to the next tile as soon as the capture of the current one
+#   returns, not when its processing is done.
+# - capture: runs the user callback in the calling thread, copies the
+#   frame into a free shared-memory slot and submits it to the pool.
+# - processing: a process pool whose workers map the slot instead of
+#   receiving a pickled copy of the frame. The slot goes back to the free
+#   list when the worker is done with it.
+#
+# Every hand-over is bounded, so a slow stage stalls the ones before it
+# (back-pressure) instead of piling frames up in memory. The scan time
+# tends to max(motion + capture, processing / workers) per tile.
+#
+# Needs Python 3.8 (multiprocessing.shared_memory); the rest of the
+# package still runs on 3.7, so the import error is only raised when a
+# Pipeline is created.
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python 3.7
+    shared_memory = None
+
+
+def _process_slot(process, name, shape, dtype, tile):
+    # Runs in a worker: map the slot, never copy it
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        frame = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        try:
+            return process(frame, tile)
+        finally:
+            del frame
+    finally:
+        memory.close()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Pipeline:
+    """Scan tiles with ``stage`` while processing the frames in parallel.
+
+    ``capture(tile)`` returns the frame (a NumPy array) taken at the
+    current tile; ``process(frame, tile)`` returns the result for that
+    tile. With ``workers`` > 0, ``process`` runs in a process pool and
+    must be picklable (a module-level function); with 0 it runs in a
+    single thread. It must not keep a reference to ``frame``, whose
+    buffer is reused. ``depth`` is the number of shared-memory slots, i.e.
+    of frames captured but not yet processed.
+    """
+
+    def __init__(self, stage, capture, process, workers=2, depth=4,
+                 timeout=60):
+        if shared_memory is None:
+            raise RuntimeError("Pipeline needs Python 3.8 or later "
+                               "(multiprocessing.shared_memory)")
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        self.stage = stage
+        self.capture = capture
+        self.process = process
+        self.workers = workers
+        self.depth = depth
+        self.timeout = timeout
+
+    def run(self, tiles):
+        """Visit ``tiles``, a sequence of (x, y) or (x, y, z) positions
+        passed to stage.moveto(), and return the list of results in the
+        same order."""
+        tiles = [tuple(tile) for tile in tiles]
+        if not tiles:
+            return []
+        stop = threading.Event()
+        positioned = queue.Queue(maxsize=1)
+        released = threading.Semaphore(0)
+        motion = threading.Thread(target=self._motion,
+                                  args=(tiles, positioned, released, stop),
+                                  name="pipeline-motion", daemon=True)
+        free = queue.Queue()
+        slots = []
+        futures = []
+        if self.workers:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=1)
+        motion.start()
+        try:
+            for _ in tiles:
+                item = positioned.get()
+                if isinstance(item, BaseException):
+                    raise item
+                tile = item
+                frame = np.ascontiguousarray(self.capture(tile))
+                # The stage is free: let it move to the next tile
+                released.release()
+                slot = self._slot(frame, slots, free)
+                view = np.ndarray(frame.shape, dtype=frame.dtype,
+                                  buffer=slot.buf)
+                view[...] = frame
+                del view
+                future = pool.submit(_process_slot, self.process, slot.name,
+                                     frame.shape, frame.dtype.str, tile)
+                future.add_done_callback(lambda f, s=slot: free.put(s))
+                futures.append(future)
+            return [f.result() for f in futures]
+        finally:
+            stop.set()
+            released.release()
+            motion.join()
+            pool.shutdown(wait=True)
+            for slot in slots:
+                slot.close()
+                slot.unlink()
+
+    def _slot(self, frame, slots, free):
+        # A free slot, or a new one until there are ``depth``. Blocks
+        # until a worker releases one (back-pressure).
+        if free.empty() and len(slots) < self.depth:
+            slot = shared_memory.SharedMemory(create=True,
+                                              size=max(frame.nbytes, 1))
+            slots.append(slot)
+        else:
+            try:
+                slot = free.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError("No frame processed in %.1f s"
+                                   % self.timeout)
+        if slot.size < frame.nbytes:
+            raise ValueError("Frames must all have the same size")
+        return slot
+
+    def _motion(self, tiles, positioned, released, stop):
+        try:
+            for i, tile in enumerate(tiles):
+                if i > 0:
+                    released.acquire()
+                if stop.is_set():
+                    return
+                self.stage.moveto(*tile)
+                self.stage.wait_idle(self.timeout)
+                self._put(positioned, tile, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            try:
+                self._put(positioned, e, stop)
+            except _Stopped:
+                pass
+
+    @staticmethod
+    def _put(q, item, stop):
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if stop.is_set():
+                    raise _Stopped()
@@ -0,0 +1,169 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Host-side acceleration ramps.
+#
+# The firmware executes every M block at constant velocity (Bresenham
+# over dt milliseconds), so a single block starts and stops abruptly.
+# The planner cuts a move into short blocks whose average speeds follow
+# a trapezoidal or S-curve velocity profile, within per-axis speed and
+# acceleration limits. All quantities are in motor steps.
+import math
+
+# Limits of the int16 fields of an M frame.
+MAX_BLOCK_STEPS = 32767
+MAX_BLOCK_DT = 32767
+
+TRAPEZOID = "trapezoid"
+SCURVE = "scurve"
+
+
+class MotionPlanner:
+    """Split moves into constant-velocity blocks approximating a ramp.
+
+    ``max_rates`` (steps/s) and ``accelerations`` (steps/s^2) give the
+    limits of the X, Y and Z motors. ``profile`` is "trapezoid"
+    (constant acceleration) or "scurve" (sinusoidal acceleration, no
+    jerk at the ends of the ramps). The ramps are sampled every
+    ``segment_ms`` milliseconds.
+    """
+
+    def __init__(self, max_rates, accelerations, profile=TRAPEZOID,
+                 segment_ms=20):
+        if profile not in (TRAPEZOID, SCURVE):
+            raise ValueError("Unknown profile: %r" % (profile,))
+        if segment_ms < 1:
+            raise ValueError("segment_ms must be at least 1")
+        self.max_rates = list(max_rates)
+        self.accelerations = list(accelerations)
+        self.profile = profile
+        self.segment_ms = int(segment_ms)
+
+    @classmethod
+    def from_profiles(cls, profiles, **kwargs):
+        """Create a planner from the AxisProfiles of the X, Y and Z axes."""
+        return cls([p.max_rate for p in profiles],
+                   [p.acceleration for p in profiles], **kwargs)
+
+    def plan(self, dx, dy, dz):
+        """Return the list of (dt, dx, dy, dz) blocks for a move.
+
+        The displacements of the blocks add up exactly to the requested
+        move; the durations are whole milliseconds.
+        """
+        delta = (int(dx), int(dy), int(dz))
+        if delta == (0, 0, 0):
+            return []
+
+        ramp_ms, cruise_ms = self._timing(delta)
+        speed = 1.0 / (ramp_ms + cruise_ms)   # path fraction per ms
+        total_ms = 2 * ramp_ms + cruise_ms
+
+        # Breakpoints (ms): the ramps are sampled, the cruise is one
+        # piece (split later if it overflows a frame).
+        n = max(1, int(math.ceil(ramp_ms / self.segment_ms))) if ramp_ms else 0
+        ramp = [int(round(k * ramp_ms / n)) for k in range(1, n + 1)] if n else []
+        times = sorted(set(ramp + [total_ms - t for t in ramp] + [total_ms]))
+
+        blocks = []
+        previous_t = 0
+        previous = (0, 0, 0)
+        carry_ms = 0
+        for t in times:
+            u = self._position(t, ramp_ms, cruise_ms, speed)
+            current = tuple(int(round(d * u)) for d in delta)
+            steps = tuple(c - p for c, p in zip(current, previous))
+            dt = t - previous_t + carry_ms
+            if steps == (0, 0, 0):
+                # Nothing to step yet; fold the wait into the next block.
+                carry_ms = dt
+            else:
+                blocks.extend(_split(dt, steps))
+                carry_ms = 0
+            previous_t = t
+            previous = current
+        return blocks
+
+    def duration(self, dx, dy, dz):
+        """Return the duration of a planned move in milliseconds."""
+        return sum(block[0] for block in self.plan(dx, dy, dz))
+
+    def _timing(self, delta):
+        # Speed and acceleration limits of the path parameter u in
+        # [0, 1], in 1/ms and 1/ms^2, set by the most limiting axis.
+        v = min(self.max_rates[i] / 1000.0 / abs(d)
+                for i, d in enumerate(delta) if d)
+        a = min(self.accelerations[i] / 1.0e6 / abs(d)
+                for i, d in enumerate(delta) if d)
+
+        if self.profile == TRAPEZOID:
+            ramp = v / a
+            if v * ramp > 1:            # never reaches full speed
+                v = math.sqrt(a)
+                ramp = v / a
+        else:
+            # v(t) = V/2 (1 - cos(pi t / T)), peak acceleration pi V / 2T
+            ramp = math.pi * v / (2 * a)
+            if v * ramp > 1:
+                v = math.sqrt(2 * a / math.pi)
+                ramp = math.pi * v / (2 * a)
+
+        # Whole milliseconds, rounded up so that the limits still hold.
+        ramp_ms = int(math.ceil(ramp - 1e-9))
+        cruise_ms = int(math.ceil(max(0.0, 1.0 / v - ramp) - 1e-9))
+        if ramp_ms + cruise_ms == 0:
+            cruise_ms = 1
+        return ramp_ms, cruise_ms
+
+    def _position(self, t, ramp_ms, cruise_ms, speed):
+        total = 2 * ramp_ms + cruise_ms
+        if t >= total:
+            return 1.0
+        if t > ramp_ms + cruise_ms:
+            return 1.0 - self._position(total - t, ramp_ms, cruise_ms, speed)
+        if t > ramp_ms:
+            return speed * (ramp_ms / 2.0 + t - ramp_ms)
+        if self.profile == TRAPEZOID:
+            return speed * t * t / (2.0 * ramp_ms)
+        return speed / 2.0 * (t - ramp_ms / math.pi * math.sin(math.pi * t / ramp_ms))
+
+
+def _split(dt, steps):
+    """Split a block that overflows the int16 fields of an M frame."""
+    largest = max(abs(s) for s in steps)
+    pieces = max(1,
+                 int(math.ceil(largest / float(MAX_BLOCK_STEPS))),
+                 int(math.ceil(dt / float(MAX_BLOCK_DT))))
+    if pieces == 1:
+        return [(dt,) + tuple(steps)]
+    blocks = []
+    done_t = 0
+    done = (0, 0, 0)
+    for k in range(1, pieces + 1):
+        t = dt * k // pieces
+        target = tuple(s * k // pieces if s >= 0 else -((-s) * k // pieces)
+                       for s in steps)
+        blocks.append((t - done_t,) + tuple(a - b for a, b in zip(target, done)))
+        done_t = t
+        done = target
+    return blocks
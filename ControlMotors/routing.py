@@ -0,0 +1,211 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Visiting order of a set of stage positions.
+#
+# travel_times() predicts how long ControlStage.moveto takes between any
+# two positions: one coordinated move whose longest axis runs at the
+# lowest max_rate of the moving axes. plan_route() orders the visits of
+# a round so that the latest visit is as little late as possible (which,
+# unlike the total lateness, never lets a distant position wait
+# forever), then so that the total lateness and the travel are the
+# shortest. It starts from the better of
+# the nearest-neighbour and the earliest-deadline orders and improves it
+# with 2-opt (reversing sub-sequences) until no reversal helps.
+#
+# order_tiles() orders large sets of tiles, where 2-opt would be too
+# slow: the better of a serpentine and a nearest-neighbour tour.
+import numpy as np
+
+
+def _durations(deltas, gears, rates, overhead):
+    # Durations of the moves of stage displacements ``deltas`` (..., axes)
+    motor = np.abs(deltas) * gears
+    # moveto runs the longest axis at the lowest rate of the moving axes
+    speed = np.where(motor > 0, rates, np.inf).min(axis=-1)
+    longest = motor.max(axis=-1)
+    with np.errstate(invalid="ignore"):
+        return np.where(longest > 0, longest / speed + overhead, 0.0)
+
+
+def _model(points, gears, profiles):
+    points = np.asarray(points, dtype=np.float64)
+    axes = points.shape[1]
+    gears = np.asarray(gears, dtype=np.float64)[:axes]
+    rates = np.array([p.max_rate for p in profiles], dtype=np.float64)[:axes]
+    return points, gears, rates
+
+
+def travel_times(points, gears, profiles, overhead=0.0):
+    """Matrix of the moveto durations (s) between ``points`` (stage
+    steps, one row per position), plus ``overhead`` per actual move."""
+    points, gears, rates = _model(points, gears, profiles)
+    return _durations(points[:, None, :] - points[None, :, :], gears, rates,
+                      overhead)
+
+
+def path_time(points, gears, profiles, overhead=0.0):
+    """Total moveto duration (s) to go through ``points`` in order."""
+    points, gears, rates = _model(points, gears, profiles)
+    return float(_durations(np.diff(points, axis=0), gears, rates,
+                            overhead).sum())
+
+
+def _serpentine(points):
+    # Row by row, alternating the direction
+    rows = np.unique(points[:, 1], return_inverse=True)[1].ravel()
+    x = np.where(rows % 2, -points[:, 0], points[:, 0])
+    return np.lexsort((x, rows))
+
+
+def order_tiles(points, gears, profiles, start=None):
+    """Short visiting order of many positions (too many for plan_route),
+    as an array of indices into ``points``.
+
+    Takes the shorter, in moveto time, of the row-by-row serpentine and
+    of the nearest-neighbour order from ``start`` (default: the first
+    point of the serpentine).
+    """
+    points, gears, rates = _model(points, gears, profiles)
+    n = len(points)
+    if n < 3:
+        return np.arange(n)
+    serpentine = _serpentine(points)
+    if start is not None:
+        start = np.asarray(start, dtype=np.float64)[:points.shape[1]]
+
+    greedy = np.empty(n, dtype=np.intp)
+    left = np.ones(n, dtype=bool)
+    here = points[serpentine[0]] if start is None else start
+    for k in range(n):
+        times = _durations(points - here, gears, rates, 0.0)
+        times[~left] = np.inf
+        j = int(np.argmin(times))
+        greedy[k] = j
+        left[j] = False
+        here = points[j]
+
+    def total(order):
+        path = points[order]
+        if start is not None:
+            path = np.vstack([start, path])
+        return _durations(np.diff(path, axis=0), gears, rates, 0.0).sum()
+
+    if total(greedy) < total(serpentine):
+        return greedy
+    return serpentine
+
+
+class Route:
+    """A visiting order with its predicted timing: ``order`` (indices
+    into the positions), ``starts`` (predicted start time of each
+    visit), ``lateness`` (total time past the deadlines),
+    ``max_lateness`` (that of the latest visit) and ``travel`` (total
+    moving time)."""
+
+    def __init__(self, order, starts, lateness, travel, max_lateness=0.0):
+        self.order = order
+        self.starts = starts
+        self.lateness = lateness
+        self.max_lateness = max_lateness
+        self.travel = travel
+
+    def __repr__(self):
+        return "Route(order=%r, lateness=%.3f, travel=%.3f)" % (
+            self.order, self.lateness, self.travel)
+
+
+def _simulate(order, travel, deadlines, durations, now, releases):
+    t = now
+    previous = 0
+    starts = []
+    lateness = 0.0
+    worst = 0.0
+    moving = 0.0
+    for j in order:
+        step = travel[previous, j + 1]
+        moving += step
+        t += step
+        if releases is not None:
+            # Arrived early: wait until the visit is due
+            t = max(t, releases[j])
+        starts.append(t)
+        late = max(0.0, t - deadlines[j])
+        lateness += late
+        worst = max(worst, late)
+        t += durations[j]
+        previous = j + 1
+    return Route(list(order), starts, lateness, moving, worst)
+
+
+def _better(a, b):
+    # Lateness first, then travel; ignore rounding noise
+    if abs(a.max_lateness - b.max_lateness) > 1e-9:
+        return a.max_lateness < b.max_lateness
+    if abs(a.lateness - b.lateness) > 1e-9:
+        return a.lateness < b.lateness
+    return a.travel < b.travel - 1e-9
+
+
+def plan_route(travel, deadlines, durations, now=0.0, releases=None):
+    """Order the visits of one round.
+
+    ``travel`` is the (n + 1) x (n + 1) matrix of travel_times() with the
+    current stage position first and the n positions to visit after
+    it; ``deadlines`` and ``durations`` (s) are those of the n visits,
+    and ``releases``, if given, the times before which they must not
+    start. Returns a Route.
+    """
+    travel = np.asarray(travel, dtype=np.float64)
+    n = len(deadlines)
+    if n == 0:
+        return Route([], [], 0.0, 0.0)
+
+    # Nearest neighbour
+    order = []
+    left = set(range(n))
+    previous = 0
+    while left:
+        j = min(left, key=lambda j: travel[previous, j + 1])
+        order.append(j)
+        left.remove(j)
+        previous = j + 1
+    best = _simulate(order, travel, deadlines, durations, now, releases)
+    edf = sorted(range(n), key=lambda j: deadlines[j])
+    candidate = _simulate(edf, travel, deadlines, durations, now, releases)
+    if _better(candidate, best):
+        best = candidate
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            for k in range(i + 1, n):
+                order = best.order[:i] + best.order[i:k + 1][::-1] \
+                    + best.order[k + 1:]
+                candidate = _simulate(order, travel, deadlines, durations,
+                                      now, releases)
+                if _better(candidate, best):
+                    best = candidate
+                    improved = True
+    return best
@@ -0,0 +1,401 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Local stage daemon.
+#
+# Only one process can open the serial port, and every open resets the
+# Arduino. `StageServer` keeps a single ControlStage open and serves its
+# commands to any number of local clients over a TCP or Unix socket.
+# `StageClient` exposes the same methods as ControlStage, so scripts can
+# switch between a direct connection and the daemon without changes.
+#
+# The protocol is one JSON object per line. A request looks like
+#
+#     {"id": 3, "op": "move_dx", "args": [10], "kwargs": {}}
+#
+# and the reply carries the same id, the result and the stage position:
+#
+#     {"id": 3, "ok": true, "result": null, "pos": [10, 0, 0]}
+#
+# Clients that send {"op": "subscribe"} also receive an event after every
+# command that may have changed the stage, whichever client issued it:
+#
+#     {"event": "position", "op": "move_dx", "client": 1, "pos": [10, 0, 0]}
+import argparse
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from .ControlMotors import ControlStage
+
+DEFAULT_ADDRESS = ("127.0.0.1", 8642)
+
+# Commands that only read state; they don't trigger a broadcast.
+READ_ONLY_OPS = {"send_idle", "send_position", "send_homing_offset"}
+
+# Commands the daemon keeps to itself: clients must not close or reopen
+# the port that every other client shares, hold the stage for a whole
+# plan (execute) while the others wait, nor write files on the daemon's
+# host (save_config).
+PRIVATE_OPS = {"close", "reset", "reconnect", "execute", "from_config",
+               "save_config"}
+
+
+def stage_operations():
+    """Return the names of the ControlStage methods served remotely."""
+    return sorted(name for name in dir(ControlStage)
+                  if not name.startswith("_")
+                  and callable(getattr(ControlStage, name))
+                  and name not in PRIVATE_OPS)
+
+
+def _encode(message):
+    return (json.dumps(message, separators=(",", ":"), default=_to_json)
+            + "\n").encode("utf-8")
+
+
+def _to_json(value):
+    # Settings objects such as AxisProfile know how to flatten themselves.
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def parse_address(text):
+    """Parse "host:port" into a TCP address, "unix:/path" into a path."""
+    if text.startswith("unix:"):
+        return text[len("unix:"):]
+    host, _, port = text.rpartition(":")
+    return (host or DEFAULT_ADDRESS[0], int(port))
+
+
+class _StageRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.client_id = self.server.new_client_id()
+        self.write_lock = threading.Lock()
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as e:
+                    # Answer with an error and keep the connection
+                    self.send({"id": None, "ok": False,
+                               "error": "Invalid request: %s" % e,
+                               "type": "ValueError",
+                               "pos": self.server.position()})
+                    continue
+                self.send(self.server.dispatch(self, request))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.unsubscribe(self)
+
+    def send(self, message):
+        data = _encode(message)
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class _StageServerMixin:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def init_stage(self, stage):
+        self.stage = stage
+        self.stage_lock = threading.Lock()
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+        self._client_ids = itertools.count(1)
+        self.operations = set(stage_operations())
+
+    def new_client_id(self):
+        return next(self._client_ids)
+
+    def position(self):
+        return [self.stage.x, self.stage.y, self.stage.z]
+
+    def dispatch(self, handler, request):
+        reply = {"id": request.get("id")}
+        op = request.get("op")
+        try:
+            if op == "subscribe":
+                with self.subscribers_lock:
+                    self.subscribers.add(handler)
+                result = None
+            elif op == "info":
+                result = {"gears": list(self.stage.gears),
+                          "port": self.stage.arduino_port,
+                          "operations": sorted(self.operations)}
+            elif op in self.operations:
+                method = getattr(self.stage, op)
+                # One command at a time on the serial link.
+                with self.stage_lock:
+                    result = method(*request.get("args", []),
+                                    **request.get("kwargs", {}))
+            else:
+                raise ValueError("Unknown operation: %r" % (op,))
+        except Exception as e:
+            reply.update(ok=False, error=str(e), type=type(e).__name__)
+        else:
+            reply.update(ok=True, result=result)
+        reply["pos"] = self.position()
+        if op in self.operations and op not in READ_ONLY_OPS:
+            self.broadcast({"event": "position", "op": op,
+                            "client": handler.client_id,
+                            "pos": reply["pos"]})
+        return reply
+
+    def broadcast(self, event):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for handler in subscribers:
+            try:
+                handler.send(event)
+            except OSError:
+                self.unsubscribe(handler)
+
+    def unsubscribe(self, handler):
+        with self.subscribers_lock:
+            self.subscribers.discard(handler)
+
+
+class _TCPStageServer(_StageServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _UnixStageServer(_StageServerMixin, socketserver.ThreadingUnixStreamServer):
+        pass
+else:  # pragma: no cover - Windows
+    _UnixStageServer = None
+
+
+def StageServer(stage, address=DEFAULT_ADDRESS):
+    """Create a server that shares `stage` with clients on `address`.
+
+    `address` is a (host, port) tuple for TCP or a filesystem path for
+    a Unix socket. Call serve_forever() on the result to run it and
+    shutdown()/server_close() to stop.
+    """
+    if isinstance(address, str):
+        if _UnixStageServer is None:
+            raise ValueError("Unix sockets are not supported on this platform")
+        server = _UnixStageServer(address, _StageRequestHandler)
+    else:
+        server = _TCPStageServer(tuple(address), _StageRequestHandler)
+    server.init_stage(stage)
+    return server
+
+
+class StageClient:
+    """Talks to a StageServer with the same API as ControlStage.
+
+    Every ControlStage method is forwarded to the daemon. The x, y and
+    z attributes are refreshed from each reply and, after subscribe(),
+    from the events caused by the other clients.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = tuple(address)
+        self.sock.connect(address)
+        self.timeout = timeout
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.listeners = []
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Set by the reader thread when the connection is gone
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+        info = self._call("info")
+        self.gears = info["gears"]
+        self.arduino_port = info["port"]
+        self._operations = set(info["operations"])
+
+    def __getattr__(self, name):
+        operations = self.__dict__.get("_operations", ())
+        if name not in operations:
+            raise AttributeError(name)
+
+        def remote(*args, **kwargs):
+            return self._call(name, args, kwargs)
+
+        remote.__name__ = name
+        return remote
+
+    def subscribe(self, callback=None):
+        """Receive position events caused by any client.
+
+        `callback(event)` is called from the reader thread for each
+        event, after x, y and z have been updated.
+        """
+        if callback is not None:
+            self.listeners.append(callback)
+        self._call("subscribe")
+
+    def wait_idle(self, timeout=None, interval=0.05):
+        """Poll the daemon until the stage is idle.
+
+        Polling from the client keeps the serial link free for the other
+        clients in between.
+        """
+        start = time.monotonic()
+        while not self.send_idle():
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Stage still busy after %.1f s" % timeout)
+            time.sleep(interval)
+
+    def close(self):
+        """Disconnect from the daemon; the stage itself stays open."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    reset = close
+
+    def _call(self, op, args=(), kwargs=None):
+        request_id = next(self._ids)
+        slot = [threading.Event(), None]
+        with self._pending_lock:
+            if self._closed:
+                raise ConnectionError("Connection to stage server lost")
+            self._pending[request_id] = slot
+        message = {"id": request_id, "op": op, "args": list(args),
+                   "kwargs": kwargs or {}}
+        data = _encode(message)
+        try:
+            with self._write_lock:
+                self.sock.sendall(data)
+        except OSError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise ConnectionError("Connection to stage server lost")
+        if not slot[0].wait(self.timeout):
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError("No reply from stage server for %r" % op)
+        reply = slot[1]
+        if reply is None:
+            raise ConnectionError("Connection to stage server lost")
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return reply["result"]
+
+    def _update_position(self, pos):
+        self.x, self.y, self.z = pos
+
+    def _read_loop(self):
+        try:
+            for line in self.sock.makefile("rb"):
+                message = json.loads(line.decode("utf-8"))
+                if "pos" in message:
+                    self._update_position(message["pos"])
+                if "event" in message:
+                    for callback in list(self.listeners):
+                        try:
+                            callback(message)
+                        except Exception:
+                            # A faulty subscriber must not stop the
+                            # replies to this client
+                            traceback.print_exc()
+                    continue
+                with self._pending_lock:
+                    slot = self._pending.pop(message.get("id"), None)
+                if slot is not None:
+                    slot[1] = message
+                    slot[0].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Wake up any caller still waiting for a reply; later calls
+            # fail at once.
+            with self._pending_lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+            for slot in pending.values():
+                slot[0].set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="controlmotors-server",
+        description="Share one Oquam stage between several local clients.")
+    parser.add_argument("--port", required=True,
+                        help="Serial port of the Arduino (e.g. COM6)")
+    parser.add_argument("--gears", type=int, nargs=3, default=[1, 1, 1],
+                        metavar=("GX", "GY", "GZ"),
+                        help="Motor steps per stage step for X, Y and Z")
+    parser.add_argument("--config", default=None,
+                        help="Stage configuration file (gears and speed "
+                        "profiles); overrides --gears")
+    parser.add_argument("--listen", default="%s:%d" % DEFAULT_ADDRESS,
+                        help="host:port for TCP or unix:/path for a Unix socket")
+    args = parser.parse_args(argv)
+
+    if args.config:
+        stage = ControlStage.from_config(args.port, args.config)
+    else:
+        stage = ControlStage(args.port, args.gears)
+    server = StageServer(stage, parse_address(args.listen))
+    print("[controlmotors-server] Serving %s on %s" % (args.port, args.listen))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stage.close()
+        if isinstance(server.server_address, str):
+            os.unlink(server.server_address)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,219 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Time-lapse over several positions, each revisited at its own interval.
+#
+# Every position has a due time. Due times are anchored to the schedule
+# (the next one is the previous due time plus the interval, not the
+# time of the visit plus the interval), so a late visit does not shift
+# the ones after it. The schedule of a position starts at its first
+# visit: all positions are due at the start, and anchoring them there
+# would make them all fall due together at every cycle. A visit is on
+# time if it starts no later than `tolerance` seconds after it is due;
+# a visit that could not even start before the following due time is
+# skipped and counted as missed.
+#
+# Before each visit, the scheduler takes the positions due now, plus
+# those that fall due before their visits are predicted to be over, and
+# orders them with routing.plan_route using the stage's time model: the
+# moveto durations from travel_times() and the measured visit durations
+# (a running average per position). It then makes the first visit of
+# that route and plans again. Positions are never visited before they
+# are due.
+import time
+
+import numpy as np
+
+from .routing import plan_route, travel_times
+
+
+class Visit:
+    """One visit: position ``index``, its ``due`` time, the ``start``
+    and ``end`` of the visit and the ``deadline`` (due + tolerance)."""
+
+    def __init__(self, index, due, deadline, start, end):
+        self.index = index
+        self.due = due
+        self.deadline = deadline
+        self.start = start
+        self.end = end
+
+    @property
+    def lateness(self):
+        return max(0.0, self.start - self.deadline)
+
+    @property
+    def slack(self):
+        return self.deadline - self.start
+
+    def __repr__(self):
+        return "Visit(index=%d, due=%.3f, start=%.3f, end=%.3f)" % (
+            self.index, self.due, self.start, self.end)
+
+
+class TimeLapse:
+    """Revisit ``positions`` ((x, y[, z]) in stage steps) every
+    ``intervals`` seconds (one value, or one per position) and call
+    ``visit(index, position)`` at each of them.
+
+    ``visit_time`` is the initial estimate of the duration of a visit
+    and ``overhead`` the time lost per move on top of the motion
+    (serial round trips, settling). ``clock`` and ``sleep`` default to
+    time.monotonic and time.sleep.
+    """
+
+    def __init__(self, stage, positions, intervals, visit, visit_time=1.0,
+                 tolerance=0.0, overhead=0.05, clock=time.monotonic,
+                 sleep=time.sleep, timeout=60):
+        self.stage = stage
+        self.positions = [tuple(p) for p in positions]
+        n = len(self.positions)
+        if n == 0:
+            raise ValueError("No positions")
+        if len(set(len(p) for p in self.positions)) != 1:
+            raise ValueError("All positions need the same number of axes")
+        if np.ndim(intervals) == 0:
+            intervals = [intervals] * n
+        if len(intervals) != n:
+            raise ValueError("Expected %d intervals, got %d"
+                             % (n, len(intervals)))
+        if min(intervals) <= 0:
+            raise ValueError("Intervals must be positive")
+        self.intervals = [float(t) for t in intervals]
+        self.visit = visit
+        self.durations = [float(visit_time)] * n
+        self.tolerance = tolerance
+        self.overhead = overhead
+        self.clock = clock
+        self.sleep = sleep
+        self.timeout = timeout
+        self.smoothing = 0.3
+        self.due = None
+        self.started = [False] * n
+        self.visits = []
+        self.missed = [0] * n
+        self._travel = travel_times(self.positions, stage.gears,
+                                    stage.profiles, overhead)
+
+    def plan(self, now=None):
+        """Order of the next positions to visit, as a list of indices:
+        those due now (or the next ones to fall due) and those that
+        fall due before their visits are predicted to be over."""
+        now = self.clock() if now is None else now
+        if self.due is None:
+            self.due = [now] * len(self.positions)
+        # Nothing due yet: plan from the next due time, so the stage
+        # is already there when it comes
+        start = max(now, min(self.due))
+        selected = [i for i in range(len(self.positions))
+                    if self.due[i] <= start]
+        while True:
+            end = start + sum(self.durations[i] + self._travel[i].max()
+                            for i in selected)
+            more = [i for i in range(len(self.positions))
+                    if i not in selected and self.due[i] <= end]
+            if not more:
+                break
+            selected += more
+        here = self.stage.get_position()[:len(self.positions[0])]
+        points = [here] + [self.positions[i] for i in selected]
+        travel = travel_times(points, self.stage.gears, self.stage.profiles,
+                              self.overhead)
+        route = plan_route(travel,
+                           [self.due[i] + self.tolerance for i in selected],
+                           [self.durations[i] for i in selected], now,
+                           [self.due[i] for i in selected])
+        return [selected[j] for j in route.order]
+
+    def _skip_missed(self, i, now):
+        # Drop the cycles that can no longer start before the next one
+        if now >= self.due[i] + self.intervals[i]:
+            skipped = int((now - self.due[i]) // self.intervals[i])
+            self.due[i] += skipped * self.intervals[i]
+            self.missed[i] += skipped
+
+    def step(self):
+        """Move to the next position, wait there until it is due, make
+        the visit and return it as a Visit.
+
+        The order is planned again before every visit, so a position
+        that falls due while others are visited takes its place in the
+        route as soon as it is due."""
+        now = self.clock()
+        if self.due is None:
+            self.due = [now] * len(self.positions)
+        i = self.plan(now)[0]
+        self.stage.moveto(*self.positions[i])
+        self.stage.wait_idle(self.timeout)
+        now = self.clock()
+        if now < self.due[i]:
+            self.sleep(self.due[i] - now)
+            now = self.clock()
+        if not self.started[i]:
+            self.due[i] = now
+            self.started[i] = True
+        self._skip_missed(i, now)
+        self.visit(i, self.positions[i])
+        end = self.clock()
+        self.durations[i] += self.smoothing * (end - now - self.durations[i])
+        visit = Visit(i, self.due[i], self.due[i] + self.tolerance, now, end)
+        self.visits.append(visit)
+        self.due[i] += self.intervals[i]
+        return visit
+
+    def run(self, visits=None, duration=None):
+        """Make ``visits`` visits, or run for ``duration`` seconds, or
+        until interrupted."""
+        start = self.clock()
+        count = 0
+        while visits is None or count < visits:
+            if duration is not None and self.clock() - start >= duration:
+                break
+            self.step()
+            count += 1
+
+    def utilization(self):
+        """Predicted fraction of the time the stage is busy: the visit
+        durations plus the mean travel to each position, over the
+        intervals. Above 1 the deadlines cannot all be met."""
+        n = len(self.positions)
+        travel = self._travel.sum(axis=0) / max(n - 1, 1)
+        return float(sum((self.durations[i] + travel[i]) / self.intervals[i]
+                         for i in range(n)))
+
+    def stats(self):
+        """Lateness and slack (s) of the visits made so far."""
+        lateness = [v.lateness for v in self.visits]
+        slack = [v.slack for v in self.visits]
+        count = len(self.visits)
+        return {
+            "visits": count,
+            "late": sum(1 for v in lateness if v > 0),
+            "on_time": (count - sum(1 for v in lateness if v > 0)) / count
+            if count else 1.0,
+            "mean_lateness": float(sum(lateness) / count) if count else 0.0,
+            "max_lateness": float(max(lateness)) if count else 0.0,
+            "min_slack": float(min(slack)) if count else None,
+            "missed": sum(self.missed),
+            "utilization": self.utilization(),
+        }
@@ -0,0 +1,352 @@
+"""
+  Motorised Stage
+
+  Copyright (C) 2021 Sony Computer Science Laboratories
+  Author(s) Ali Ruyer-Thompson, Aliénor Lahlou, Peter Hanappe
+
+  Motorised Stage allows to control the position of a microscope stage.
+
+  Motorised Stage is free software: you can redistribute it and/or modify
+  it under the terms of the GNU Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program.  If not, see
+  <http://www.gnu.org/licenses/>.
+
+"""
+# Stage position at any time, reconstructed from the commands sent.
+#
+# A Trajectory listens to the frames a ControlStage exchanges with the
+# firmware (ControlStage.frame_listeners) and replays them the way the
+# firmware executes them: blocks run back to back, each one starts when
+# it is accepted or when the previous one ends, lasts 10 * dt stepper
+# interrupts, and steps every axis with the accumulation-error loop of
+# the interrupt, whose step count after k interrupts has a closed form.
+# position_at() evaluates it for whole arrays of timestamps (camera
+# frame times, for example) without querying the device.
+#
+# Pause, continue, reset, zero and homing are followed too. Every P
+# reply is a measurement: while a block runs, the difference with the
+# prediction along its longest axis is taken as a timing error and
+# moves the block (and those queued behind it) in time; what is left,
+# or any difference while idle, becomes a position offset from then on.
+#
+# Times are time.monotonic() seconds, positions motor steps. During a
+# homing the position is unknown; it is zero once the homing is done.
+import math
+import re
+
+import numpy as np
+
+INTERRUPTS_PER_SECOND = 10000
+
+_ARGS = re.compile(r"-?\d+")
+
+
+def bresenham_steps(delta, period, k):
+    """Number of steps taken after ``k`` interrupts by blocks moving
+    ``delta`` (>= 0) steps in ``period`` interrupts (10 * dt), for
+    arrays of blocks. Vectorised form of
+    firmware_model.bresenham_steps."""
+    delta, period, k = np.broadcast_arrays(np.asarray(delta, np.int64),
+                                           np.asarray(period, np.int64),
+                                           np.asarray(k, np.int64))
+    safe = np.maximum(period, 1)
+    x = delta - period // 2 + (k - 1) * delta
+    steps = np.minimum(k, -((-x) // safe))
+    # A block with dt <= 0 makes a single step
+    steps = np.where(period > 0, steps, np.minimum(k, 1))
+    return np.where((k > 0) & (delta > 0) & ((x > 0) | (period <= 0)),
+                    steps, 0)
+
+
+def _int16(value):
+    return (value + 32768) % 65536 - 32768
+
+
+class Trajectory:
+    """Commanded position of a stage as a function of time.
+
+    Attach it to a ControlStage with attach(), or pass the frames to it
+    yourself (it is a frame listener). ``origin`` is the step counters
+    of the firmware when nothing was sent yet. Only the last
+    ``max_blocks`` blocks are kept.
+    """
+
+    def __init__(self, origin=(0, 0, 0), max_blocks=100000):
+        self.max_blocks = max_blocks
+        self.gears = None
+        self._origin = np.array(origin, dtype=np.int64)
+        # One row per block (or piece of a block split by a pause):
+        # accepted, begin, k_low, k_high, period, x0, y0, z0, dx, dy, dz.
+        # The block is at interrupt k_low at time `begin` and stops at
+        # k_high; x0.. is its start position without the offsets.
+        self._rows = []
+        self._offset_times = [-math.inf]
+        self._offsets = [np.zeros(3, dtype=np.int64)]
+        self._paused = None
+        self._arrays = None
+
+    def attach(self, stage):
+        """Follow the frames of ``stage``; reads P once to anchor the
+        trajectory on the firmware counters."""
+        self.gears = list(stage.gears)
+        stage.frame_listeners.append(self)
+        stage.send_position()
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Frame listener
+
+    def __call__(self, command, reply, sent, received):
+        t = 0.5 * (sent + received)
+        opcode = command[0]
+        args = [int(a) for a in _ARGS.findall(command[1:])]
+        if opcode == "M":
+            self.add_block(t, *args)
+        elif opcode == "m":
+            self.add_moveto(t, *args)
+        elif opcode == "B":
+            for i in range(reply[1]):
+                self.add_block(t, *args[4 * i:4 * i + 4])
+        elif opcode == "P":
+            self.correct(t, reply[1:4])
+        elif opcode == "p":
+            self.pause(t)
+        elif opcode == "c":
+            self.resume(t)
+        elif opcode == "r":
+            self.stop(t)
+        elif opcode == "z":
+            self.zero(t)
+        elif opcode == "H":
+            # Stops, homes, and ends with zeroed counters
+            self.stop(t)
+            self.zero(t)
+
+    # Events
+
+    def add_block(self, t, dt, dx, dy, dz):
+        """A relative move (M) of ``dt`` ms accepted at time ``t``."""
+        begin = max(t, self._end()) if self._paused is None else math.inf
+        position = self._raw_end()
+        self._rows.append([t, begin, 0, 0, 10 * dt]
+                          + list(position) + [dx, dy, dz])
+        self._rows[-1][3] = self._duration(self._rows[-1])
+        self._changed()
+        if len(self._rows) > self.max_blocks:
+            self._prune()
+
+    def add_moveto(self, t, speed, x, y, z):
+        """An absolute move (m) at ``speed`` steps/s accepted at ``t``."""
+        end = self._raw_end() + self._offsets[-1]
+        delta = np.array([x, y, z]) - end
+        n = int(np.abs(delta).max())
+        # Same int32 arithmetic and int16 DT field as the firmware
+        dt = _int16(1000 * n // speed)
+        self.add_block(t, dt, *[int(d) for d in delta])
+
+    def pause(self, t):
+        """The steppers stop at ``t`` until resume()."""
+        if self._paused is not None:
+            return
+        self._paused = t
+        i = self._active(t)
+        if i is not None:
+            row = self._rows[i]
+            k = self._interrupts(row, t)
+            piece = list(row)
+            row[3] = k
+            piece[2] = k
+            self._rows.insert(i + 1, piece)
+            i += 1
+        else:
+            i = self._first_after(t)
+        for row in self._rows[i:]:
+            row[1] = math.inf
+        self._changed()
+
+    def resume(self, t):
+        """The steppers restart at ``t`` where they were paused."""
+        if self._paused is None:
+            return
+        self._paused = None
+        i = self._first_after(math.inf)
+        for row in self._rows[i:]:
+            row[0] = max(row[0], t)
+        self._rechain(i)
+
+    def stop(self, t):
+        """Reset at ``t``: the running block stops, the queued ones are
+        dropped."""
+        i = self._active(t)
+        if i is not None:
+            self._rows[i][3] = self._interrupts(self._rows[i], t)
+            i += 1
+        else:
+            i = self._first_after(t)
+        del self._rows[i:]
+        self._paused = None
+        self._changed()
+
+    def zero(self, t):
+        """The firmware counters are set to zero at ``t``."""
+        self._add_offset(t, -self._raw_position(np.array([t]))[0])
+
+    def correct(self, t, counters):
+        """Take the step ``counters`` read (P) at time ``t`` into account."""
+        counters = np.asarray(counters, dtype=np.int64)
+        error = counters - self.position_at(t)
+        if not error.any():
+            return
+        i = self._active(t)
+        if i is not None and self._rows[i][1] != math.inf:
+            self._correct_timing(i, t, counters)
+            error = counters - self.position_at(t)
+        if error.any():
+            self._add_offset(t, self._offsets[-1] + error)
+
+    # Queries
+
+    def position_at(self, t):
+        """Position in motor steps at time(s) ``t``: an (x, y, z) array
+        for a scalar, an (n, 3) array for n timestamps."""
+        scalar = np.ndim(t) == 0
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        position = self._raw_position(t)
+        index = np.searchsorted(self._offset_times, t, side="right") - 1
+        position = position + np.asarray(self._offsets)[index]
+        return position[0] if scalar else position
+
+    def stage_position_at(self, t):
+        """Like position_at(), in stage steps (floats), using the gears
+        of the attached stage."""
+        if self.gears is None:
+            raise RuntimeError("No stage attached: the gears are unknown")
+        return self.position_at(t) / np.asarray(self.gears, dtype=np.float64)
+
+    def end_time(self):
+        """Time at which the last block sent ends (inf while paused)."""
+        return self._end()
+
+    # Internals
+
+    def _changed(self):
+        self._arrays = None
+
+    def _table(self):
+        if self._arrays is None:
+            rows = np.array(self._rows, dtype=np.float64).reshape(-1, 11)
+            self._arrays = (rows[:, 1], rows[:, 2].astype(np.int64),
+                            rows[:, 3].astype(np.int64),
+                            rows[:, 4].astype(np.int64),
+                            rows[:, 5:8].astype(np.int64),
+                            rows[:, 8:11].astype(np.int64))
+        return self._arrays
+
+    def _raw_position(self, t):
+        if not self._rows:
+            return np.tile(self._origin, (len(t), 1))
+        begin, k_low, k_high, period, start, delta = self._table()
+        i = np.searchsorted(begin, t, side="right") - 1
+        before = i < 0
+        i = np.maximum(i, 0)
+        elapsed = (t - begin[i]) * INTERRUPTS_PER_SECOND
+        # The epsilon keeps t on an interrupt boundary from rounding down
+        k = k_low[i] + np.floor(np.where(before, 0, elapsed) + 1e-6)
+        k = np.clip(k.astype(np.int64), k_low[i], k_high[i])
+        steps = bresenham_steps(np.abs(delta[i]), period[i, None], k[:, None])
+        position = start[i] + np.sign(delta[i]) * steps
+        return np.where(before[:, None], self._origin, position)
+
+    @staticmethod
+    def _duration(row):
+        return max(row[4], 1)
+
+    def _end(self):
+        if not self._rows:
+            return -math.inf
+        row = self._rows[-1]
+        return row[1] + float(row[3] - row[2]) / INTERRUPTS_PER_SECOND
+
+    def _raw_end(self):
+        if not self._rows:
+            return self._origin.copy()
+        row = self._rows[-1]
+        delta = np.array(row[8:11])
+        steps = bresenham_steps(np.abs(delta), row[4], row[3])
+        return np.array(row[5:8]) + np.sign(delta) * steps
+
+    def _active(self, t):
+        # Index of the block running at t, or None
+        for i in range(len(self._rows) - 1, -1, -1):
+            row = self._rows[i]
+            if row[1] <= t:
+                end = row[1] + float(row[3] - row[2]) / INTERRUPTS_PER_SECOND
+                return i if t < end else None
+        return None
+
+    def _first_after(self, t):
+        i = len(self._rows)
+        while i > 0 and self._rows[i - 1][1] >= t:
+            i -= 1
+        return i
+
+    def _interrupts(self, row, t):
+        k = row[2] + int(math.floor((t - row[1]) * INTERRUPTS_PER_SECOND
+                                    + 1e-6))
+        return min(max(k, row[2]), row[3])
+
+    def _rechain(self, i):
+        # Blocks start when accepted or when the previous one ends
+        previous = self._rows[i - 1] if i > 0 else None
+        for row in self._rows[i:]:
+            end = (-math.inf if previous is None else previous[1]
+                   + float(previous[3] - previous[2]) / INTERRUPTS_PER_SECOND)
+            row[1] = max(row[0], end)
+            previous = row
+        self._changed()
+
+    def _correct_timing(self, i, t, counters):
+        row = self._rows[i]
+        delta = np.array(row[8:11])
+        axis = int(np.abs(delta).argmax())
+        n = abs(int(delta[axis]))
+        period = row[4]
+        if n == 0 or period <= 0:
+            return
+        offset = self._offsets[-1][axis]
+        done = (counters[axis] - offset - row[5 + axis]) * np.sign(delta[axis])
+        if not 0 < done <= n:
+            return
+        # Middle of the interrupts at which the block has made `done` steps
+        k_measured = ((done - 0.5) * period + period // 2) / float(n)
+        k_predicted = (t - row[1]) * INTERRUPTS_PER_SECOND + row[2]
+        lag = (k_predicted - k_measured) / INTERRUPTS_PER_SECOND
+        row[0] = row[1] = row[1] + lag
+        self._rechain(i + 1)
+
+    def _add_offset(self, t, offset):
+        # Offsets apply from t on; later ones replace earlier ones
+        while self._offset_times[-1] >= t and len(self._offset_times) > 1:
+            self._offset_times.pop()
+            self._offsets.pop()
+        self._offset_times.append(t)
+        self._offsets.append(np.asarray(offset, dtype=np.int64))
+
+    def _prune(self):
+        keep = self.max_blocks // 2
+        dropped = self._rows[-keep - 1]
+        delta = np.array(dropped[8:11])
+        steps = bresenham_steps(np.abs(delta), dropped[4], dropped[3])
+        self._origin = np.array(dropped[5:8]) + np.sign(delta) * steps
+        del self._rows[:-keep]
+        self._changed()
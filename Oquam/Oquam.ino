@@ -44,8 +44,13 @@ uint8_t controller_state;
 
 static const char *kInvalidState = "Invalid state";
 
+// Blocks per 'B' frame, 4 arguments each; bounded by the number of
+// arguments a RomiSerial frame can carry.
+#define MAX_BATCH_BLOCKS 3
+
 void handle_moveto(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_move(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
+void handle_move_batch(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_moveat(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_pause(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_continue(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
@@ -58,11 +63,13 @@ void handle_set_homing(IRomiSerial *romiSerial, int16_t *args, const char *strin
 void handle_enable(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_spindle(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void send_info(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
+void send_homing_offset(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 void handle_test(IRomiSerial *romiSerial, int16_t *args, const char *string_arg);
 
 const static MessageHandler handlers[] = {
         { 'm', 4, false, handle_moveto },
         { 'M', 4, false, handle_move },
+        { 'B', 4 * MAX_BATCH_BLOCKS, false, handle_move_batch },
         { 'V', 3, false, handle_moveat },
         { 'p', 0, false, handle_pause },
         { 'c', 0, false, handle_continue },
@@ -71,11 +78,12 @@ const static MessageHandler handlers[] = {
         { 'P', 0, false, send_position },
         { 'I', 0, false, send_idle },
         { 'H', 0, false, handle_homing },
-        { 'h', 3, false, handle_set_homing },
+        { 'h', 12, false, handle_set_homing },
         { 'E', 1, false, handle_enable },
         { 'S', 1, false, handle_spindle },
         { 'T', 1, false, handle_test },
         { '?', 0, false, send_info },
+        { 'O', 0, false, send_homing_offset },
 };
 
 ArduinoSerial serial(Serial);
@@ -83,8 +91,14 @@ RomiSerial romiSerial(serial, serial, handlers, sizeof(handlers) / sizeof(Messag
 
 static char reply_string[80];
 static int8_t homing_axes[3] =  {-1, -1, -1};
-static int16_t homing_speeds[3] =  {1000, 1000, 400};
+// Homing: seek the switch at the fast speed, back off, then touch it
+// again at the slow speed, which sets the precision. Speeds in steps/s,
+// back-off in steps; set per axis with 'h'.
+static int16_t homing_fast_speeds[3] =  {3000, 3000, 1200};
+static int16_t homing_slow_speeds[3] =  {250, 250, 100};
+static int16_t homing_backoff[3] =  {200, 200, 80};
 static uint8_t limit_switches[3] = {0, 0, 0};
+static int32_t homing_offset[3] = {0, 0, 0};
 
 int moveat(int dx, int dy, int dz);
 
@@ -215,6 +229,34 @@ void handle_move(IRomiSerial *romiSerial, int16_t *args, const char *string_arg)
         }
 }
 
+/**
+ * \brief Queue up to MAX_BATCH_BLOCKS relative moves from one frame.
+ *
+ * The arguments are MAX_BATCH_BLOCKS groups of [dt,dx,dy,dz], as for
+ * 'M'. A group with dt <= 0 ends the list, so shorter batches are
+ * padded with zeros. The blocks are queued in order until the buffer
+ * is full; the reply gives the number of blocks accepted, and the
+ * client resends the others later.
+ */
+void handle_move_batch(IRomiSerial *romiSerial, int16_t *args, const char *string_arg)
+{
+        if (controller_state == STATE_RUNNING
+            || controller_state == STATE_PAUSED) {
+                int accepted = 0;
+                for (int i = 0; i < MAX_BATCH_BLOCKS; i++) {
+                        int16_t *b = args + 4 * i;
+                        if (b[0] <= 0
+                            || move(b[0], b[1], b[2], b[3]) != 0)
+                                break;
+                        accepted++;
+                }
+                snprintf(reply_string, sizeof(reply_string), "[0,%d]", accepted);
+                romiSerial->send(reply_string); 
+        } else {
+                romiSerial->send_error(101, kInvalidState);  
+        }
+}
+
 void handle_moveat(IRomiSerial *romiSerial, int16_t *args, const char *string_arg)
 {
         if (controller_state == STATE_RUNNING
@@ -375,26 +417,55 @@ int homing_wait_switch(int speed, int axis, int state)
         return err;
 }
 
-int homing_moveto_switch_pressed(int axis)
+int homing_moveto_switch_pressed(int speed, int axis)
+{
+        return homing_wait_switch(-speed, axis, LOW);
+}
+
+int homing_moveto_switch_released(int speed, int axis)
+{
+        return homing_wait_switch(speed, axis, HIGH);
+}
+
+int homing_move_backoff(int axis)
 {
-        return homing_wait_switch(-homing_speeds[axis], axis, LOW);
+        // Move away from the switch at the fast speed
+        int32_t dt = 1000L * homing_backoff[axis] / homing_fast_speeds[axis];
+        if (dt < 1)
+                dt = 1;
+        return homing_move((int) dt, homing_backoff[axis], axis);
 }
 
-int homing_moveto_switch_released(int axis)
+void homing_wait_move()
 {
-        return homing_wait_switch(homing_speeds[axis], axis, HIGH);
+        // Like wait(), but in STATE_HOMING
+        while (!stepper_is_idle()) {
+                romiSerial.handle_input();
+                delay(1);
+        }
 }
 
 bool do_homing_axis(int axis)
 {
         bool success = false; 
-        if (homing_moveto_switch_pressed(axis) == 0 
-            && homing_moveto_switch_released(axis) == 0
-            && homing_move(100, homing_speeds[axis]/5, axis) == 0) {
-                // Don't remove the RUNNING because wait() depends on
-                // it!
-                controller_state = STATE_RUNNING;
-                wait();
+        int fast = homing_fast_speeds[axis];
+        int slow = homing_slow_speeds[axis];
+        if (homing_moveto_switch_pressed(fast, axis) == 0
+            && homing_move_backoff(axis) == 0) {
+                homing_wait_move();
+        } else {
+                return false;
+        }
+        // If the back-off was too short to release the switch, the
+        // first wait below finishes the job at the slow speed.
+        if (homing_moveto_switch_released(slow, axis) == 0
+            && homing_moveto_switch_pressed(slow, axis) == 0 
+            && homing_moveto_switch_released(slow, axis) == 0
+            && homing_move_backoff(axis) == 0) {
+                // Stay in STATE_HOMING until handle_homing() is done
+                // with all the axes: 'I' must not report the
+                // controller as idle between two axes.
+                homing_wait_move();
                 success = true;
         }
         return success;
@@ -429,6 +500,11 @@ void handle_homing(IRomiSerial *romiSerial, int16_t *args, const char *string_ar
         
         if (do_homing()) {
                 reset();
+                // Keep the step counters as they were at the end of
+                // the homing, before zeroing them. On a homed axis, a
+                // non-zero value is the number of steps lost since the
+                // previous homing.
+                get_stepper_position(homing_offset);
                 stepper_zero();
                 controller_state = STATE_RUNNING;
         } else {
@@ -436,10 +512,39 @@ void handle_homing(IRomiSerial *romiSerial, int16_t *args, const char *string_ar
         }
 }
 
+void send_homing_offset(IRomiSerial *romiSerial, int16_t *args, const char *string_arg)
+{
+        snprintf(reply_string, sizeof(reply_string),
+                 "[0,%ld,%ld,%ld]", homing_offset[0], homing_offset[1],
+                 homing_offset[2]);
+        romiSerial->send(reply_string); 
+}
+
+/**
+ * \brief Set the homing order and the homing speeds.
+ *
+ * args[0..2] is the order of the axes (0, 1, 2 or -1 to skip). For
+ * each axis i, args[3+3i..5+3i] are the fast speed, the slow speed
+ * (steps/s) and the back-off (steps); 0 keeps the current value.
+ */
 void handle_set_homing(IRomiSerial *romiSerial, int16_t *args, const char *string_arg)
 {
-        for (int i = 0; i < 3; i++)
-                homing_axes[i] = args[i];        
+        for (int i = 3; i < 12; i++) {
+                if (args[i] < 0) {
+                        romiSerial->send_error(102, "Invalid homing speed");
+                        return;
+                }
+        }
+        for (int i = 0; i < 3; i++) {
+                int16_t *speeds = args + 3 + 3 * i;
+                homing_axes[i] = args[i];
+                if (speeds[0] > 0)
+                        homing_fast_speeds[i] = speeds[0];
+                if (speeds[1] > 0)
+                        homing_slow_speeds[i] = speeds[1];
+                if (speeds[2] > 0)
+                        homing_backoff[i] = speeds[2];
+        }
         romiSerial->send_ok();
 }
 
@@ -130,22 +130,16 @@ def main():
 			print("[axis-test] ==== Final homing sequence (per selected axis) ====")
 			for axis in axes:
 				print("")
-				if axis == "x":
-					print("[axis-test] Starting X homing (X only, Y/Z skipped) ...")
-					stage.handle_set_homing(0, -1, -1)
-				elif axis == "y":
-					print("[axis-test] Starting Y homing (Y only, X/Z skipped) ...")
-					stage.handle_set_homing(1, -1, -1)
-				else:  # "z"
-					print("[axis-test] Starting Z homing (Z only, X/Y skipped) ...")
-					stage.handle_set_homing(2, -1, -1)
-
-				stage.handle_homing()
 				print(
-					f"[axis-test] Waiting up to {homing_timeout:.0f} s for homing to complete ..."
+					f"[axis-test] Homing {axis.upper()} only (waiting up to "
+					f"{homing_timeout:.0f} s) ..."
+				)
+				start = time.monotonic()
+				stage.home(axis, timeout=homing_timeout)
+				print(
+					"[axis-test] Homing completed for this axis in "
+					f"{time.monotonic() - start:.1f} s."
 				)
-				time.sleep(homing_timeout)
-				print("[axis-test] Homing completed for this axis.")
 	finally:
 		print("[axis-test] Disabling stage movement and closing stage.")
 		try:
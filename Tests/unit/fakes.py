@@ -0,0 +1,62 @@
+"""Stage shared by the unit tests of the modules that drive a stage
+(no hardware required).
+
+ModelStage is a real ControlStage whose serial link is the Python model
+of the Oquam firmware, so the moves go through moveto() and the m
+blocks like on the board. The model runs on simulated time: it only
+moves in wait_idle(), which executes the queued blocks and hands their
+duration to ``sleep`` (a fake clock, time.sleep, or nothing when the
+moves may be instantaneous).
+
+Test modules import it as ``from fakes import ModelStage``: unittest
+discovery and pytest both put this folder on sys.path.
+"""
+
+from __future__ import annotations
+
+import importlib
+
+from ControlMotors import ControlStage  # type: ignore
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+
+
+class ModelStage(ControlStage):
+    """ControlStage on an OquamModel. ``moves`` lists the position
+    (x, y, z) after every move and moveto."""
+
+    def __init__(self, gears=(1, 1, 1), profiles=None, sleep=None,
+                 **kwargs):
+        cm = importlib.import_module(ControlStage.__module__)
+        original = cm.ControlSerial
+        cm.ControlSerial = OquamModel
+        try:
+            super().__init__("MODEL", list(gears), profiles=profiles,
+                             **kwargs)
+        finally:
+            cm.ControlSerial = original
+        self.sleep = sleep
+        self.moves = []
+
+    def moveto(self, x=None, y=None, z=None, speed=None):
+        super().moveto(x, y, z, speed)
+        self.moves.append((self.x, self.y, self.z))
+
+    def move(self, dx=0, dy=0, dz=0, dt=-1):
+        super().move(dx, dy, dz, dt)
+        self.moves.append((self.x, self.y, self.z))
+
+    def wait_idle(self, timeout=None, interval=0.05):
+        # The model is not thread-safe: run it under the stage lock
+        with self._lock:
+            self.flush()
+            start = self.link.now_ms
+            self.link.run_until_idle()
+            if self.sleep is not None:
+                self.sleep((self.link.now_ms - start) / 1000.0)
+            super().wait_idle(timeout, interval)
+
+    @property
+    def reached(self):
+        """Position (stage steps) the simulated motors are at, which
+        lags the tracked x, y, z until wait_idle()."""
+        return tuple(c // g for c, g in zip(self.link.physical, self.gears))
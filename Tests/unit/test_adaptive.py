@@ -0,0 +1,158 @@
+"""Unit tests for the adaptive coarse-to-fine scan (no hardware
+required).
+
+The stage runs on the firmware model (fakes.ModelStage); the camera
+sees a textured frame where the motors are near a few objects of the
+sample and a flat one elsewhere.
+"""
+
+from __future__ import annotations
+
+import threading
+import unittest
+
+import numpy as np
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.adaptive import (AdaptiveScan, gradient,  # type: ignore
+                                    standard_deviation)
+from ControlMotors.config import default_profiles  # type: ignore
+from ControlMotors.routing import order_tiles, path_time  # type: ignore
+from fakes import ModelStage  # type: ignore
+
+
+class FakeCamera:
+    def __init__(self, stage, objects, radius):
+        self.stage = stage
+        self.objects = objects
+        self.radius = radius
+        self.rng = np.random.default_rng(0)
+
+    def __call__(self):
+        x, y = self.stage.reached[:2]
+        frame = np.full((16, 16), 100.0)
+        if any(abs(x - ox) <= self.radius and abs(y - oy) <= self.radius
+               for ox, oy in self.objects):
+            frame += self.rng.normal(0, 20, frame.shape)
+        return frame
+
+
+class TestScores(unittest.TestCase):
+    def test_vectorised_over_the_stack(self):
+        rng = np.random.default_rng(1)
+        frames = rng.normal(0, 1, (5, 12, 10))
+        for score in (standard_deviation, gradient):
+            together = score(frames)
+            one_by_one = [score(frame[None])[0] for frame in frames]
+            np.testing.assert_allclose(together, one_by_one)
+
+    def test_colour_frames(self):
+        frames = np.zeros((2, 8, 8, 3))
+        frames[1, ::2] = 50
+        np.testing.assert_allclose(standard_deviation(frames), [0, 25])
+
+
+class TestOrderTiles(unittest.TestCase):
+    def test_shorter_than_the_raster(self):
+        rng = np.random.default_rng(2)
+        points = rng.integers(0, 10000, (200, 2))
+        profiles = [AxisProfile(1000)] * 3
+        order = order_tiles(points, [1, 1, 1], profiles)
+
+        self.assertEqual(sorted(order), list(range(200)))
+        self.assertLess(path_time(points[order], [1, 1, 1], profiles),
+                        0.3 * path_time(points, [1, 1, 1], profiles))
+
+    def test_grid_is_a_serpentine(self):
+        points = np.array([(x, y) for y in range(3) for x in range(4)]) * 100
+        order = order_tiles(points, [1, 1, 1], [AxisProfile(1000)] * 3)
+        steps = np.abs(np.diff(points[order], axis=0)).max(axis=1)
+        self.assertTrue(np.all(steps == 100))
+
+
+class TestAdaptiveScan(unittest.TestCase):
+    def setUp(self):
+        self.stage = ModelStage(profiles=[AxisProfile(1000)] * 3)
+        self.camera = FakeCamera(self.stage, [(1500, 2500)], 400)
+        self.visited = []
+
+    def visit(self, x, y, frame):
+        self.visited.append((x, y))
+
+    def test_refines_only_the_interesting_cells(self):
+        scan = AdaptiveScan(self.stage, self.camera, threshold=5.0)
+        result = scan.run(0, 0, 4000, 4000, 1000, 250, visit=self.visit)
+
+        self.assertEqual(len(result.coarse), 16)
+        self.assertEqual(int(result.selected.sum()), 1)
+        self.assertEqual(tuple(result.coarse[result.selected][0]),
+                         (1500, 2500))
+        self.assertEqual(len(self.visited), 16)
+        self.assertEqual(result.full, 256)
+        self.assertEqual(result.tiles, 32)
+        xs, ys = zip(*self.visited)
+        self.assertEqual((min(xs), max(xs), min(ys), max(ys)),
+                         (1125, 1875, 2125, 2875))
+        self.assertEqual([m[:2] for m in self.stage.moves[16:]],
+                         self.visited)
+        # Serpentine coarse pass: each move to a neighbouring cell
+        steps = np.abs(np.diff(result.coarse, axis=0)).max(axis=1)
+        self.assertTrue(np.all(steps == 1000))
+
+    def test_grow_adds_the_neighbours(self):
+        scan = AdaptiveScan(self.stage, self.camera, threshold=5.0,
+                            grow=True)
+        result = scan.run(0, 0, 4000, 4000, 1000, 250, visit=self.visit)
+
+        self.assertEqual(int(result.selected.sum()), 5)
+        self.assertEqual(len(result.fine), 80)
+        self.assertEqual(len(set(self.visited)), 80)
+
+    def test_empty_sample(self):
+        self.camera.objects = []
+        scan = AdaptiveScan(self.stage, self.camera, threshold=5.0,
+                            score="gradient")
+        result = scan.run(0, 0, 4000, 3000, 1000, 250)
+
+        self.assertEqual(result.tiles, 12)
+        self.assertEqual(len(result.fine), 0)
+
+    def test_steps_must_nest(self):
+        scan = AdaptiveScan(self.stage, self.camera, threshold=5.0)
+        with self.assertRaises(ValueError):
+            scan.run(0, 0, 4000, 4000, 1000, 300)
+
+
+class TestAdaptiveScanThroughTheDaemon(unittest.TestCase):
+    def setUp(self):
+        from ControlMotors.server import StageClient, StageServer  # type: ignore
+
+        self.stage = ModelStage(profiles=[AxisProfile(1000)] * 3)
+        # The client polls send_idle(): let the model follow the clock
+        self.stage.link.speedup = 1000
+        self.server = StageServer(self.stage, ("127.0.0.1", 0))
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.client = StageClient(self.server.server_address, timeout=5)
+        self.camera = FakeCamera(self.stage, [(1500, 2500)], 400)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stage_client_uses_the_default_profiles(self):
+        scan = AdaptiveScan(self.client, self.camera, threshold=5.0)
+        result = scan.run(0, 0, 4000, 4000, 1000, 250)
+
+        self.assertEqual(int(result.selected.sum()), 1)
+        self.assertEqual(len(result.fine), 16)
+        self.assertEqual(self.stage.reached[:2], tuple(result.fine[-1]))
+        self.assertAlmostEqual(
+            result.travel,
+            path_time(np.vstack([result.coarse, result.fine]),
+                      self.stage.gears, default_profiles()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Unit tests for the autofocus search and the focus metrics
+(no hardware required).
+
+The stage runs on the firmware model (fakes.ModelStage); the fake
+camera returns a random texture whose contrast fades with the distance
+between the Z the motor has reached and the focal plane.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ControlMotors.autofocus import (  # type: ignore
+    METRICS, Autofocus, _parabola_vertex)
+from fakes import ModelStage  # type: ignore
+
+
+def box_blur(image, radius):
+    if radius == 0:
+        return image
+    kernel = np.ones(2 * radius + 1) / (2 * radius + 1)
+    image = np.apply_along_axis(np.convolve, 0, image, kernel, "same")
+    return np.apply_along_axis(np.convolve, 1, image, kernel, "same")
+
+
+class FakeCamera:
+    def __init__(self, stage, focus, depth=60.0):
+        self.stage = stage
+        self.focus = focus
+        self.depth = depth
+        self.captures = 0
+        self.texture = np.random.default_rng(1).random((64, 64))
+
+    def __call__(self):
+        self.captures += 1
+        distance = (self.stage.reached[2] - self.focus) / self.depth
+        contrast = np.exp(-distance * distance)
+        return 100 + 50 * contrast * self.texture
+
+
+class TestFocusMetrics(unittest.TestCase):
+    def test_sharper_frames_score_higher(self):
+        texture = np.random.default_rng(0).random((48, 64)) * 255
+        for name, metric in METRICS.items():
+            scores = [metric(box_blur(texture, r)) for r in (0, 1, 3)]
+            self.assertGreater(scores[0], scores[1], name)
+            self.assertGreater(scores[1], scores[2], name)
+
+    def test_colour_frames_are_averaged(self):
+        texture = np.random.default_rng(0).random((32, 32))
+        colour = np.stack([texture] * 3, axis=2)
+        for metric in METRICS.values():
+            self.assertAlmostEqual(metric(colour), metric(texture))
+
+    def test_parabola_vertex(self):
+        self.assertAlmostEqual(_parabola_vertex((0, 0), (2, 4), (6, 0)), 3.0)
+        self.assertIsNone(_parabola_vertex((0, 0), (1, 1), (2, 2)))
+        self.assertIsNone(_parabola_vertex((0, 1), (1, 0), (2, 1)))
+
+
+class TestAutofocus(unittest.TestCase):
+    def test_finds_focus_in_few_captures(self):
+        for focus in (-137, 12, 188):
+            stage = ModelStage()
+            camera = FakeCamera(stage, focus)
+
+            result = Autofocus(stage, camera).run(span=500, tolerance=2)
+
+            self.assertLessEqual(abs(result.z - focus), 4, focus)
+            self.assertLessEqual(camera.captures, 10)
+            self.assertEqual(result.captures, camera.captures)
+            self.assertEqual(stage.reached[2], result.z)
+
+    def test_every_metric_converges(self):
+        for metric in ("laplacian", "brenner", "tenengrad"):
+            stage = ModelStage()
+            stage.moveto(z=1000)
+            stage.wait_idle()
+            camera = FakeCamera(stage, focus=1060)
+
+            result = Autofocus(stage, camera, metric=metric).run(
+                span=400, tolerance=2)
+
+            self.assertLessEqual(abs(result.z - 1060), 4, metric)
+
+    def test_metric_runs_while_the_stage_moves(self):
+        # Every move takes 50 ms of wall clock
+        stage = ModelStage(sleep=lambda seconds: time.sleep(0.05))
+        camera = FakeCamera(stage, focus=0)
+        threads = set()
+
+        def slow_metric(frame):
+            threads.add(threading.get_ident())
+            time.sleep(0.05)
+            return float(frame.std())
+
+        start = time.perf_counter()
+        Autofocus(stage, camera, metric=slow_metric).run(
+            span=400, max_captures=5)
+        elapsed = time.perf_counter() - start
+
+        self.assertNotIn(threading.get_ident(), threads)
+        # Six moves and five metrics would take 0.55 s one after the other
+        self.assertLess(elapsed, 0.45)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
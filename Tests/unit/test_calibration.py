@@ -0,0 +1,194 @@
+"""Unit tests for the speed and camera calibration routines (no
+hardware required).
+
+The fake link loses steps whenever a block asks an axis to step faster
+than its (hidden) true limit, and reports them through the homing
+offset like the Oquam firmware does. The fake camera shifts a texture
+by the stage position through a hidden pixel-to-step matrix.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import importlib
+import io
+import re
+import unittest
+from unittest import mock
+
+import numpy as np
+
+TRUE_LIMITS = [3300, 7000, 900]
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+        self.lost = [0, 0, 0]
+        self.offset = [0, 0, 0]
+        self.homing_axes = [-1, -1, -1]
+
+    def send_command(self, s: str):
+        self.commands.append(s)
+        args = [int(a) for a in re.findall(r"-?\d+", s)]
+        if s.startswith("M"):
+            dt, steps = args[0], args[1:]
+            for axis, n in enumerate(steps):
+                if abs(n) * 1000.0 / dt > TRUE_LIMITS[axis]:
+                    self.lost[axis] += abs(n) // 10
+        elif s.startswith("h"):
+            self.homing_axes = args[:3]
+        elif s == "H":
+            self.offset = [0, 0, 0]
+            for axis in self.homing_axes:
+                if axis >= 0:
+                    self.offset[axis] = -self.lost[axis]
+                    self.lost[axis] = 0
+        elif s == "O":
+            return [0] + self.offset
+        elif s == "I":
+            return [0, 1, "r"]
+        return [0]
+
+
+class TestSpeedCalibration(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+        self.stage = ControlStage("FAKE_PORT", [1, 1, 1])
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def test_finds_highest_rate_without_loss(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+
+        rate = calibrate_speed(self.stage, "x", distance=2000, resolution=50)
+
+        self.assertLessEqual(rate, TRUE_LIMITS[0])
+        self.assertGreater(rate, TRUE_LIMITS[0] - 50 - 20)
+        self.assertEqual(self.stage.profiles[0].max_rate, rate)
+        # Only X was homed and moved.
+        homing = [c for c in self.stage.link.commands if c.startswith("h")]
+        self.assertTrue(all(c.startswith("h[0,-1,-1,") for c in homing))
+
+    def test_high_bound_is_kept_when_reliable(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+
+        rate = calibrate_speed(self.stage, 1, low=1000, high=5000)
+
+        self.assertEqual(rate, 5000)
+        self.assertEqual(self.stage.profiles[1].max_rate, 5000)
+
+    def test_margin_scales_the_stored_rate(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+
+        rate = calibrate_speed(self.stage, "z", distance=500, low=400,
+                               resolution=10, margin=0.5)
+
+        self.assertLessEqual(rate, TRUE_LIMITS[2] // 2)
+        self.assertGreater(rate, (TRUE_LIMITS[2] - 30) // 2)
+
+    def test_unreliable_low_bound_is_an_error(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+
+        with self.assertRaises(RuntimeError):
+            calibrate_speed(self.stage, "z", low=2000)
+
+    def test_rates_are_capped_at_the_firmware_limit(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+        from ControlMotors.config import MAX_STEP_RATE  # type: ignore
+
+        with mock.patch(__name__ + ".TRUE_LIMITS", [3300, 20000, 900]):
+            rate = calibrate_speed(self.stage, "y", low=4000, high=30000)
+
+        self.assertEqual(rate, MAX_STEP_RATE)
+        for c in self.stage.link.commands:
+            if c.startswith("M"):
+                dt, dx, dy, dz = [int(a) for a in re.findall(r"-?\d+", c)]
+                self.assertLessEqual(abs(dy) * 1000 / dt, MAX_STEP_RATE)
+
+    def test_quiet_unless_verbose(self):
+        from ControlMotors.calibration import calibrate_speed  # type: ignore
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            calibrate_speed(self.stage, 1, low=1000, high=5000)
+        self.assertEqual(out.getvalue(), "")
+
+        with contextlib.redirect_stdout(out):
+            calibrate_speed(self.stage, 1, low=1000, high=5000,
+                            verbose=True)
+        self.assertIn("[calibration] Y at 5000 steps/s", out.getvalue())
+
+
+class FakeCamera:
+    def __init__(self, stage, pixel_to_step, shape=(96, 128)):
+        self.stage = stage
+        self.step_to_pixel = np.linalg.inv(pixel_to_step)
+        noise = np.random.default_rng(3).random(shape)
+        self.fy = np.fft.fftfreq(shape[0])[:, None]
+        self.fx = np.fft.fftfreq(shape[1])[None, :]
+        # Low-passed noise, so that features span a few pixels
+        self.spectrum = np.fft.fft2(noise) * np.exp(
+            -(self.fx ** 2 + self.fy ** 2) / (2 * 0.08 ** 2))
+
+    def __call__(self):
+        sx, sy = self.step_to_pixel @ [self.stage.x, self.stage.y]
+        phase = np.exp(-2j * np.pi * (self.fx * sx + self.fy * sy))
+        return np.fft.ifft2(self.spectrum * phase).real * 1000
+
+
+class TestCameraCalibration(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+        self.stage = ControlStage("FAKE_PORT", [1, 1, 1])
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def test_fits_scale_rotation_and_shear(self):
+        from ControlMotors.calibration import calibrate_camera  # type: ignore
+
+        angle = np.radians(-7)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                             [np.sin(angle), np.cos(angle)]])
+        shear = np.array([[1.0, 0.05], [0.0, 1.0]])
+        truth = 3.0 * rotation @ shear
+        camera = FakeCamera(self.stage, truth)
+
+        matrix = calibrate_camera(self.stage, camera, distance=24)
+
+        np.testing.assert_allclose(matrix, truth, atol=0.05)
+        self.assertEqual(self.stage.pixel_to_step, matrix.tolist())
+        # Back where it started, through X and Y moves only
+        self.assertEqual(self.stage.get_position(), (0, 0, 0))
+        moves = [c for c in self.stage.link.commands if c.startswith("M")]
+        self.assertTrue(all(c.endswith(",0]") for c in moves))
+
+    def test_a_still_image_is_an_error(self):
+        from ControlMotors.calibration import calibrate_camera  # type: ignore
+
+        still = np.random.default_rng(0).random((32, 32))
+        with self.assertRaises(RuntimeError):
+            calibrate_camera(self.stage, lambda: still, distance=5)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,176 @@
+"""Unit tests for resumable scans (no hardware required).
+
+The stage talks to the Python model of the Oquam firmware, running
+fifty times faster than the wall clock; faults are raised from the visit
+callback or injected into the model.
+"""
+
+from __future__ import annotations
+
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ControlMotors.checkpoint import Checkpoint, resume, scan  # type: ignore
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+
+STEPS = [(x * 20, y * 30, y) for y in range(3) for x in range(4)]
+
+
+class LinkLost(IOError):
+    pass
+
+
+class TestCheckpointFile(unittest.TestCase):
+    def test_save_is_atomic_and_loads_back(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            checkpoint = Checkpoint(os.path.join(tmp, "scan.json"))
+            self.assertIsNone(checkpoint.load())
+            checkpoint.save(4, (1, 2, 3))
+            checkpoint.save(5, (4, 5, 6))
+
+            saved = checkpoint.load()
+            self.assertEqual((saved["index"], saved["position"]),
+                             (5, [4, 5, 6]))
+            self.assertEqual(os.listdir(tmp), ["scan.json"])
+            checkpoint.clear()
+            self.assertIsNone(checkpoint.load())
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestResumableScan(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        self.models = []
+
+        def model(port):
+            self.models.append(OquamModel(speedup=50, position=(500, 500, 50)))
+            return self.models[-1]
+
+        cm.ControlSerial = model
+        self.tmp = tempfile.mkdtemp()
+        self.checkpoint = Checkpoint(os.path.join(self.tmp, "scan.json"))
+        self.visited = []
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+        shutil.rmtree(self.tmp)
+
+    def _stage(self):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("MODEL", [1, 1, 1])
+        stage.home("zxy")
+        return stage
+
+    def _visit(self, fail_at=None, fault=None):
+        def visit(index, step):
+            if index == fail_at:
+                fault()
+            self.visited.append((index, tuple(step)))
+        return visit
+
+    def test_a_full_scan_is_marked_complete(self):
+        stage = self._stage()
+        self.assertEqual(scan(stage, STEPS, self.checkpoint,
+                              self._visit()), len(STEPS))
+        saved = self.checkpoint.load()
+        self.assertTrue(saved["complete"])
+        self.assertEqual(resume(stage, iter(STEPS), self.checkpoint), 0)
+
+    def test_resume_after_a_fault_reattaches(self):
+        stage = self._stage()
+        board = self.models[-1]
+
+        def lose_camera():
+            raise IOError("camera lost")
+
+        with self.assertRaises(IOError):
+            scan(stage, STEPS, self.checkpoint, self._visit(7, lose_camera))
+        self.assertEqual(self.checkpoint.load()["index"], 6)
+
+        # Same link, the board kept its counters: no homing
+        done = resume(stage, (s for s in STEPS), self.checkpoint,
+                      self._visit())
+
+        self.assertEqual(done, len(STEPS) - 7)
+        self.assertEqual([i for i, _ in self.visited], list(range(12)))
+        self.assertEqual(self.visited[7:], list(enumerate(STEPS))[7:])
+        self.assertFalse(any(c.startswith("H") for c in
+                             board.commands[board.commands.index("P"):]))
+        self.assertEqual(board.counters, list(STEPS[-1]))
+
+    def test_resume_after_a_link_failure_rehomes(self):
+        stage = self._stage()
+        board = self.models[-1]
+        home = [p - c for p, c in zip(board.physical, board.counters)]
+
+        def lose_link():
+            raise LinkLost("serial port closed")
+
+        with self.assertRaises(LinkLost):
+            scan(stage, STEPS, self.checkpoint, self._visit(7, lose_link))
+        self.assertEqual(self.checkpoint.load()["index"], 6)
+
+        # Reopening the port resets the board: the axes stay where they
+        # are but the counters start again from zero
+        def reset_board(port):
+            self.models.append(OquamModel(speedup=50,
+                                          position=board.physical))
+            return self.models[-1]
+
+        self._cm.ControlSerial = reset_board
+        done = resume(stage, (s for s in STEPS), self.checkpoint,
+                      self._visit(), reconnect=True)
+        board = self.models[-1]
+
+        self.assertEqual(done, len(STEPS) - 7)
+        self.assertEqual(self.visited[7:], list(enumerate(STEPS))[7:])
+        self.assertIn("H", board.commands)
+        self.assertEqual(board.counters, list(STEPS[-1]))
+        self.assertEqual([p - c for p, c in
+                          zip(board.physical, board.counters)], home)
+
+    def test_resume_after_a_firmware_error_rehomes(self):
+        stage = self._stage()
+        board = self.models[-1]
+        # Where the homing leaves the axes, relative to the switches
+        home = [p - c for p, c in zip(board.physical, board.counters)]
+
+        def fail():
+            board.state = "e"
+            stage.move(10, 0, 0)
+
+        with self.assertRaises(RuntimeError):
+            scan(stage, STEPS, self.checkpoint, self._visit(4, fail))
+        self.assertEqual(self.checkpoint.load()["index"], 3)
+
+        # The step counters are lost too
+        board.counters = [0, 0, 0]
+        done = resume(stage, STEPS, self.checkpoint, self._visit())
+
+        self.assertEqual(done, len(STEPS) - 4)
+        self.assertIn("H", board.commands)
+        self.assertEqual(board.counters, list(STEPS[-1]))
+        self.assertEqual([p - c for p, c in
+                          zip(board.physical, board.counters)], home)
+
+    def test_checkpoint_is_plain_json(self):
+        stage = self._stage()
+        scan(stage, STEPS[:2], self.checkpoint)
+        with open(self.checkpoint.path) as f:
+            data = json.load(f)
+        self.assertEqual(data["index"], 1)
+        self.assertEqual(data["position"], list(STEPS[1]))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
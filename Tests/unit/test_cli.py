@@ -0,0 +1,182 @@
+"""Unit tests for the `controlmotors` command line tool (no hardware
+required).
+
+Path files are written to a temporary directory; `run` drives a stage
+on the Python model of the Oquam firmware.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.cli import main, motor_blocks, read_points  # type: ignore
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+from ControlMotors.planner import MAX_BLOCK_DT, MAX_BLOCK_STEPS  # type: ignore
+
+
+def spiral(n):
+    t = np.linspace(0, 6 * np.pi, n)
+    return np.column_stack([100 * t * np.cos(t), 100 * t * np.sin(t),
+                            np.round(10 * t)])
+
+
+class TestReadPoints(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.points = spiral(1000)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp)
+
+    def _path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def _read(self, path, **kwargs):
+        return np.vstack(list(read_points(path, chunk=64, **kwargs)))
+
+    def test_formats_give_the_same_rows(self):
+        np.save(self._path("p.npy"), self.points)
+        self.points.astype("<f4").tofile(self._path("p.bin"))
+        with open(self._path("p.csv"), "w") as f:
+            f.write("x,y,z\n")
+            np.savetxt(f, self.points, delimiter=",", fmt="%.17g")
+
+        np.testing.assert_array_equal(self._read(self._path("p.npy")),
+                                      self.points)
+        np.testing.assert_array_equal(self._read(self._path("p.csv")),
+                                      self.points)
+        np.testing.assert_allclose(
+            self._read(self._path("p.bin"), dtype="<f4"), self.points,
+            rtol=1e-6)
+
+    def test_start_and_stop(self):
+        np.save(self._path("p.npy"), self.points)
+        np.savetxt(self._path("p.csv"), self.points, delimiter=",")
+        for name in ("p.npy", "p.csv"):
+            rows = self._read(self._path(name), start=100, stop=301)
+            np.testing.assert_allclose(rows, self.points[100:301])
+
+    def test_chunks_are_bounded(self):
+        np.save(self._path("p.npy"), self.points)
+        sizes = [len(c) for c in read_points(self._path("p.npy"), chunk=300)]
+        self.assertEqual(sizes, [300, 300, 300, 100])
+
+    def test_ragged_binary_file(self):
+        np.arange(10, dtype="<f8").tofile(self._path("p.bin"))
+        with self.assertRaises(ValueError):
+            self._read(self._path("p.bin"))
+
+    def test_csv_with_the_wrong_number_of_columns(self):
+        np.savetxt(self._path("p.csv"), np.zeros((5, 4)), delimiter=",")
+        with self.assertRaises(ValueError):
+            self._read(self._path("p.csv"))
+
+
+class TestMotorBlocks(unittest.TestCase):
+    def test_blocks_add_up_to_the_path_across_chunks(self):
+        points = spiral(500)
+        gears = [2, 3, 1]
+        profiles = [AxisProfile(4000), AxisProfile(2000, 5), AxisProfile(500)]
+        chunks = [points[i:i + 37] for i in range(0, len(points), 37)]
+
+        blocks = np.vstack(list(motor_blocks(chunks, gears, profiles)))
+
+        motor = np.rint(points * gears).astype(int)
+        np.testing.assert_array_equal(blocks[:, 1:].sum(axis=0),
+                                      motor[-1] - motor[0])
+        for dt, dx, dy, dz in blocks[:20]:
+            expected = max(p.duration(d) for p, d in
+                           zip(profiles, (dx, dy, dz)))
+            self.assertEqual(dt, expected)
+
+    def test_fixed_speed_and_repeated_points(self):
+        points = np.array([[0, 0], [10, 0], [10, 0], [10, 40]])
+        blocks = list(motor_blocks([points], [1, 1, 1],
+                                   [AxisProfile()] * 3, speed=2000))[0]
+        np.testing.assert_array_equal(blocks, [[5, 10, 0, 0], [20, 0, 40, 0]])
+
+    def test_speed_is_capped_at_the_step_rate(self):
+        points = np.array([[0, 0], [100, 0], [100, 5]])
+        blocks = list(motor_blocks([points], [1, 1, 1],
+                                   [AxisProfile()] * 3, speed=50000))[0]
+        np.testing.assert_array_equal(blocks, [[10, 100, 0, 0], [1, 0, 5, 0]])
+
+    def test_long_steps_are_split(self):
+        points = np.array([[0, 0, 0], [100000, -40000, 7],
+                           [100001, -40000, 7]])
+        blocks = list(motor_blocks([points], [1, 1, 1],
+                                   [AxisProfile()] * 3, speed=10000))[0]
+
+        np.testing.assert_array_equal(blocks[:, 1:].sum(axis=0),
+                                      [100001, -40000, 7])
+        self.assertEqual(len(blocks), 5)
+        self.assertTrue(np.all(np.abs(blocks[:, 1:]) <= MAX_BLOCK_STEPS))
+        self.assertEqual(blocks[:4, 0].sum(), 10000)
+        np.testing.assert_array_equal(blocks[-1], [1, 1, 0, 0])
+
+    def test_slow_steps_are_split(self):
+        points = np.array([[0, 0], [30000, 0]])
+        blocks = list(motor_blocks([points], [1, 1, 1],
+                                   [AxisProfile()] * 3, speed=100))[0]
+
+        np.testing.assert_array_equal(blocks[:, :2].sum(axis=0),
+                                      [300000, 30000])
+        self.assertTrue(np.all(blocks[:, 0] <= MAX_BLOCK_DT))
+
+
+class TestRunCommand(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        self.models = []
+
+        def model(port):
+            self.models.append(OquamModel(speedup=100))
+            return self.models[-1]
+
+        cm.ControlSerial = model
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "path.npy")
+        np.save(self.path, spiral(400))
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+        shutil.rmtree(self.tmp)
+
+    def test_dry_run_estimates_without_a_stage(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(["run", self.path, "--dry-run",
+                                   "--speed", "5000"]), 0)
+        self.assertIn("399 blocks", out.getvalue())
+        self.assertEqual(self.models, [])
+
+    def test_streams_the_path_to_the_stage(self):
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            main(["run", self.path, "--port", "MODEL", "--gears", "2", "1",
+                  "1", "--speed", "5000", "--start", "50", "--stop", "300"])
+
+        model = self.models[0]
+        last = np.rint(spiral(400)[299] * [2, 1, 1]).astype(int)
+        self.assertEqual(model.counters, list(last))
+        self.assertIn("249 blocks sent", err.getvalue())
+        # One coordinated move to the first point, then the blocks
+        after_read = model.commands[model.commands.index("P") + 1]
+        self.assertTrue(after_read.startswith("m["))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,161 @@
+"""Unit tests for per-axis speed profiles and the config file
+(no hardware required)."""
+
+from __future__ import annotations
+
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from ControlMotors import AxisProfile, HomingProfile  # type: ignore
+from ControlMotors.config import MAX_STEP_RATE, load_config  # type: ignore
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+
+    def send_command(self, s: str):
+        self.commands.append(s)
+        return [0]
+
+
+class TestAxisProfile(unittest.TestCase):
+    def test_duration_uses_rate_and_floor(self):
+        profile = AxisProfile(max_rate=4000, min_dt=5)
+        self.assertEqual(profile.duration(0), 0)
+        self.assertEqual(profile.duration(8), 5)
+        self.assertEqual(profile.duration(-4000), 1000)
+        self.assertEqual(profile.duration(4001), 1001)
+
+    def test_defaults_match_historical_heuristic(self):
+        profile = AxisProfile()
+        self.assertEqual(profile.duration(3), 10)
+        self.assertEqual(profile.duration(250), 250)
+
+    def test_rejects_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            AxisProfile(max_rate=0)
+        with self.assertRaises(ValueError):
+            AxisProfile(min_dt=0)
+
+    def test_rejects_rates_the_firmware_cannot_step(self):
+        # 10 interrupts per ms, one step per interrupt
+        self.assertEqual(MAX_STEP_RATE, 10000)
+        self.assertEqual(AxisProfile(10000).duration(32), 10)
+        with self.assertRaises(ValueError):
+            AxisProfile(max_rate=16000)
+
+
+class TestStageProfiles(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+        shutil.rmtree(self.tmp)
+
+    def _stage(self, gears, profiles=None):
+        from ControlMotors import ControlStage  # type: ignore
+        return ControlStage("FAKE_PORT", gears, profiles=profiles)
+
+    def test_dt_is_set_by_the_slowest_moving_axis(self):
+        stage = self._stage([1, 1, 1], [AxisProfile(5000, 2),
+                                        AxisProfile(2000, 2),
+                                        AxisProfile(500, 20)])
+
+        stage.move(1000, 1000, 0)
+        stage.move(0, 0, 1)
+        stage.move(10, 0, 0)
+
+        self.assertEqual(stage.link.commands,
+                         ["M[500,1000,1000,0]", "M[20,0,0,1]", "M[2,10,0,0]"])
+
+    def test_profiles_persist_with_gears(self):
+        stage = self._stage([1, 100, 1], [AxisProfile(3000, 4),
+                                          AxisProfile(8000, 2, 40000),
+                                          AxisProfile(600, 10)])
+        path = os.path.join(self.tmp, "stage.json")
+        stage.save_config(path)
+
+        config = load_config(path)
+        self.assertEqual(config["gears"], [1, 100, 1])
+        self.assertEqual([p.to_dict() for p in config["profiles"]],
+                         [p.to_dict() for p in stage.profiles])
+
+        from ControlMotors import ControlStage  # type: ignore
+        reopened = ControlStage.from_config("FAKE_PORT", path)
+        self.assertEqual(reopened.gears, [1, 100, 1])
+        self.assertEqual(reopened.profiles[1].max_rate, 8000)
+        self.assertIsNone(reopened.planner)
+
+    def test_homing_speeds_persist_and_are_sent_with_h(self):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("FAKE_PORT", [1, 1, 1],
+                             homing=[HomingProfile(4000, 200, 300),
+                                     HomingProfile(3000, 250, 200),
+                                     HomingProfile(1500, 50, 100)])
+        path = os.path.join(self.tmp, "stage.json")
+        stage.save_config(path)
+
+        reopened = ControlStage.from_config("FAKE_PORT", path)
+        reopened.handle_set_homing(0, 2, -1)
+        self.assertEqual(reopened.link.commands[-1],
+                         "h[0,2,-1,4000,200,300,3000,250,200,1500,50,100]")
+
+    def test_camera_calibration_persists(self):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("FAKE_PORT", [1, 1, 1],
+                             pixel_to_step=[[4.1, -0.7], [0.7, 4.1]])
+        path = os.path.join(self.tmp, "stage.json")
+        stage.save_config(path)
+
+        reopened = ControlStage.from_config("FAKE_PORT", path)
+        self.assertEqual(reopened.pixel_to_step, [[4.1, -0.7], [0.7, 4.1]])
+
+        with open(path, "w") as f:
+            f.write('{"gears": [1, 1, 1]}')
+        self.assertIsNone(load_config(path)["pixel_to_step"])
+
+    def test_missing_homing_speeds_get_defaults(self):
+        path = os.path.join(self.tmp, "old.json")
+        with open(path, "w") as f:
+            f.write('{"gears": [1, 1, 1], "homing": [{"fast": 5000}]}')
+
+        homing = load_config(path)["homing"]
+        self.assertEqual([h.to_dict() for h in homing],
+                         [{"fast": 5000, "slow": 250, "backoff": 200},
+                          {"fast": 3000, "slow": 250, "backoff": 200},
+                          {"fast": 1200, "slow": 100, "backoff": 80}])
+        with self.assertRaises(ValueError):
+            HomingProfile(0, 100, 100)
+        # Speeds the firmware cannot step
+        with self.assertRaises(ValueError):
+            HomingProfile(MAX_STEP_RATE + 1, 100, 100)
+        with self.assertRaises(ValueError):
+            HomingProfile(3000, 20000, 100)
+        HomingProfile(MAX_STEP_RATE, 100, 20000)
+
+    def test_planner_created_when_every_axis_has_acceleration(self):
+        stage = self._stage([1, 1, 1], [AxisProfile(5000, 2, 20000)] * 3)
+        self.assertIsNotNone(stage.planner)
+        self.assertEqual(stage.planner.max_rates, [5000] * 3)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
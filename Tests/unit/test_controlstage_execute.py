@@ -0,0 +1,94 @@
+"""Unit tests for ControlStage.execute (no hardware required).
+
+The stage talks to the Python model of the Oquam firmware; with
+`speedup` its buffer drains in (accelerated) real time, so plans longer
+than the buffer have to wait for free blocks.
+"""
+
+from __future__ import annotations
+
+import importlib
+import unittest
+
+from ControlMotors import Move, MoveTo  # type: ignore
+from ControlMotors.firmware_model import (  # type: ignore
+    BLOCK_BUFFER_CAPACITY, OquamModel)
+
+
+class TestControlStageExecute(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        self.speedup = None
+        cm.ControlSerial = lambda port: OquamModel(speedup=self.speedup)
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def _make_stage(self, **kwargs):
+        from ControlMotors import ControlStage  # type: ignore
+        return ControlStage("MODEL", [1, 1, 1], **kwargs)
+
+    def test_plan_longer_than_the_buffer(self):
+        self.speedup = 50
+        stage = self._make_stage()
+
+        def zstack():
+            for x in range(4):
+                yield MoveTo(x=x * 100, y=0, z=0, speed=5000)
+                for _ in range(20):
+                    yield Move(dz=5, dt=10)
+
+        self.assertEqual(stage.execute(zstack()), 84)
+
+        self.assertFalse(stage.stale)
+        self.assertEqual(stage.get_position(), (300, 0, 100))
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [300, 0, 100])
+
+    def test_records_are_read_lazily(self):
+        stage = self._make_stage()
+        window = 4
+        sent_before_read = []
+        ahead = []
+
+        def plan():
+            for i in range(10):
+                sent_before_read.append(len(stage.link.commands))
+                ahead.append(i - stage.executed)
+                yield Move(1, 0, 0, 10)
+
+        stage.execute(plan(), window=window)
+
+        # The first move goes out before the second record is read
+        self.assertEqual(sent_before_read[:2], [0, 1])
+        self.assertLessEqual(max(ahead), window)
+        self.assertEqual(stage.executed, 10)
+
+    def test_full_buffer_times_out(self):
+        # Simulated time does not pass: the buffer never drains
+        stage = self._make_stage()
+        plan = (Move(1, 0, 0, 10) for _ in range(40))
+
+        with self.assertRaises(RuntimeError) as cm:
+            stage.execute(plan, timeout=0.05)
+
+        self.assertEqual(str(cm.exception), "Again")
+        self.assertEqual(stage.executed, BLOCK_BUFFER_CAPACITY)
+        self.assertTrue(stage.stale)
+        # Outside execute a full buffer fails at once
+        with self.assertRaises(RuntimeError):
+            stage.move(1, 0, 0, 10)
+
+    def test_only_records_are_accepted(self):
+        stage = self._make_stage()
+        with self.assertRaises(TypeError):
+            stage.execute([Move(1), (2, 0, 0)])
+        self.assertEqual(stage.executed, 1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Unit tests for ControlStage.home (no hardware required).
+
+The stage talks to the Python model of the Oquam firmware, running
+faster than the wall clock.
+"""
+
+from __future__ import annotations
+
+import importlib
+import time
+import unittest
+
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+
+
+class TestControlStageHoming(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = OquamModel
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def _make_stage(self, position=(0, 0, 0), speedup=100.0):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("MODEL", [1, 1, 1])
+        stage.link.physical = list(position)
+        stage.link.speedup = speedup
+        return stage
+
+    def test_home_returns_when_the_firmware_is_done(self):
+        stage = self._make_stage(position=(2000, 500, 300))
+        stage.move(10, 20, 30)
+
+        start = time.monotonic()
+        stage.home("zx", timeout=5)
+        elapsed = time.monotonic() - start
+
+        link = stage.link
+        self.assertTrue(link.is_idle())
+        self.assertIn("h[2,0,-1,3000,250,200,3000,250,200,1200,100,80]",
+                      link.commands)
+        self.assertEqual((stage.x, stage.y, stage.z), (0, 0, 0))
+        self.assertFalse(stage.stale)
+        self.assertEqual(link.counters, [0, 0, 0])
+        # About 3 s of homing at 100 times the wall clock
+        self.assertLess(elapsed, 0.5)
+
+    def test_home_waits_for_the_last_axis(self):
+        stage = self._make_stage(position=(3000, 3000, 1200))
+        link = stage.link
+        states = []
+        send_command = link.send_command
+
+        def record(command):
+            reply = send_command(command)
+            if command == "I":
+                states.append(reply[2])
+            return reply
+        link.send_command = record
+
+        stage.home("xyz", timeout=5)
+
+        # No idle report between two axes
+        self.assertEqual(set(states[:-1]), {"h"})
+        self.assertEqual(states[-1], "r")
+        self.assertEqual(link.physical, [202, 202, 82])
+        self.assertEqual(link.counters, [0, 0, 0])
+
+    def test_homing_error_is_raised(self):
+        stage = self._make_stage()
+        stage.link.homing_error = True
+
+        with self.assertRaises(RuntimeError):
+            stage.home([1], timeout=5)
+
+    def test_timeout(self):
+        stage = self._make_stage(speedup=None)
+
+        with self.assertRaises(TimeoutError):
+            stage.home("x", timeout=0.05)
+
+    def test_invalid_order(self):
+        stage = self._make_stage()
+
+        with self.assertRaises(ValueError):
+            stage.home("xx")
+        self.assertEqual(stage.link.commands, [])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
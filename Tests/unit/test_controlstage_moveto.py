@@ -0,0 +1,122 @@
+"""Unit tests for ControlStage.moveto (no hardware required).
+
+The stage talks to the Python model of the Oquam firmware, which
+executes the m blocks like the board does.
+"""
+
+from __future__ import annotations
+
+import importlib
+import unittest
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+
+
+class TestControlStageMoveTo(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = OquamModel
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def _make_stage(self, gears, profiles=None):
+        from ControlMotors import ControlStage  # type: ignore
+        return ControlStage("MODEL", gears, profiles=profiles)
+
+    def test_moveto_converts_through_gears(self):
+        stage = self._make_stage([2, 3, 4])
+
+        stage.moveto(10, -5, 1, speed=500)
+
+        self.assertEqual(stage.link.commands[-1], "m[500,20,-15,4]")
+        self.assertEqual((stage.x, stage.y, stage.z), (10, -5, 1))
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [20, -15, 4])
+        # 20 steps on the longest axis at 500 steps/s
+        self.assertEqual(stage.link.now_ms, 40)
+
+    def test_moveto_after_relative_moves(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(100, 50, 0)
+
+        stage.moveto(y=10)
+
+        self.assertEqual((stage.x, stage.y, stage.z), (100, 10, 0))
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [100, 10, 0])
+
+    def test_default_speed_is_the_slowest_moving_axis(self):
+        stage = self._make_stage([1, 1, 1], [AxisProfile(4000, 2),
+                                             AxisProfile(2500, 2),
+                                             AxisProfile(300, 10)])
+        stage.moveto(100, 100)
+        self.assertEqual(stage.link.commands[-1], "m[2500,100,100,0]")
+
+        stage.moveto(100, 100, 5)
+        self.assertEqual(stage.link.commands[-1], "m[300,100,100,5]")
+
+    def test_long_slow_moves_are_split(self):
+        stage = self._make_stage([1, 1, 1])
+
+        stage.moveto(20000, 10000, speed=500)
+
+        moves = [c for c in stage.link.commands if c.startswith("m")]
+        self.assertEqual(moves, ["m[500,10000,5000,0]", "m[500,20000,10000,0]"])
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [20000, 10000, 0])
+
+    def test_out_of_range_target_is_rejected(self):
+        stage = self._make_stage([100, 1, 1])
+
+        with self.assertRaises(ValueError):
+            stage.moveto(x=400)
+        with self.assertRaises(ValueError):
+            stage.moveto(x=1, speed=0)
+        self.assertEqual(stage.link.commands, [])
+        self.assertEqual(stage.x, 0)
+
+    def test_short_fast_moves_make_every_step(self):
+        stage = self._make_stage([1, 1, 1])
+
+        # 1000*5//8000 would be a 0 ms block that makes a single step
+        stage.moveto(5, speed=8000)
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [5, 0, 0])
+
+        # 1000*25//9000 = 2 ms is too short for 25 steps
+        stage.moveto(30, speed=9000)
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [30, 0, 0])
+
+    def test_speed_is_capped_at_the_step_rate(self):
+        stage = self._make_stage([1, 1, 1])
+
+        stage.moveto(1000, speed=20000)
+
+        self.assertEqual(stage.link.commands[-1], "m[10000,1000,0,0]")
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [1000, 0, 0])
+
+    def test_stale_position_is_read_back_first(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(100, 0, 0)
+        stage.link.run_until_idle()
+        stage.x = 0
+        stage.invalidate_position()
+
+        # X is left where the firmware says it is, not at the tracked 0
+        stage.moveto(y=50)
+
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [100, 50, 0])
+        self.assertEqual((stage.x, stage.y), (100, 50))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
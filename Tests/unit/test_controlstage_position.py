@@ -0,0 +1,109 @@
+"""Unit tests for the position reconciliation of ControlStage
+(no hardware required).
+
+The stage talks to the Python model of the Oquam firmware.
+"""
+
+from __future__ import annotations
+
+import importlib
+import unittest
+
+from ControlMotors.firmware_model import (  # type: ignore
+    BLOCK_BUFFER_CAPACITY, OquamModel)
+
+
+class TestControlStagePosition(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = OquamModel
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def _make_stage(self, gears):
+        from ControlMotors import ControlStage  # type: ignore
+        return ControlStage("MODEL", gears)
+
+    def _reads(self, stage):
+        return stage.link.commands.count("P")
+
+    def test_exact_read_is_free_while_in_sync(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(10, 20, 0)
+
+        self.assertEqual(stage.get_position(exact=True), (10, 20, 0))
+        self.assertEqual(self._reads(stage), 0)
+
+    def test_failed_move_is_reconciled(self):
+        stage = self._make_stage([1, 1, 1])
+        for _ in range(BLOCK_BUFFER_CAPACITY):
+            stage.move(1, 0, 0)
+        with self.assertRaises(RuntimeError):
+            stage.move(1, 0, 0)
+        self.assertTrue(stage.stale)
+        # The optimistic position is unchanged by a cheap read
+        self.assertEqual(stage.get_position(), (BLOCK_BUFFER_CAPACITY, 0, 0))
+
+        stage.link.run_until_idle()
+        self.assertEqual(stage.get_position(exact=True),
+                         (BLOCK_BUFFER_CAPACITY, 0, 0))
+        self.assertFalse(stage.stale)
+        self.assertEqual(self._reads(stage), 1)
+
+    def test_reset_stops_the_moves(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(100, 0, 0, dt=100)
+        stage.move(100, 0, 0, dt=100)
+        stage.link.advance(150)
+        stage.handle_reset()
+
+        # Stopped half-way through the second move
+        self.assertEqual(stage.get_position(exact=True), (150, 0, 0))
+
+    def test_motor_steps_are_converted_with_remainders(self):
+        stage = self._make_stage([3, 1, 1])
+        stage.link.send_command("M[10,10,0,0]")
+        stage.link.run_until_idle()
+        stage.invalidate_position()
+
+        self.assertEqual(stage.get_position(exact=True), (3, 0, 0))
+        self.assertEqual(stage.remainder, [1, 0, 0])
+
+        stage.move_dx(1)
+        stage.moveto(x=5)
+        stage.link.run_until_idle()
+        self.assertEqual(stage.link.counters, [15, 0, 0])
+
+    def test_homing_and_disabled_motors_mark_the_position_stale(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(10, 0, 0)
+        stage.handle_enable(0)
+        self.assertTrue(stage.stale)
+        stage.link.slip(0, 5)
+        stage.link.counters[0] += 5
+        stage.link.run_until_idle()
+        self.assertEqual(stage.get_position(exact=True), (15, 0, 0))
+
+        stage.handle_set_homing(0, -1, -1)
+        stage.handle_homing()
+        self.assertTrue(stage.stale)
+        stage.link.run_until_idle()
+        self.assertEqual(stage.get_position(exact=True), (0, 0, 0))
+
+    def test_waiting_on_a_firmware_error_fails_at_once(self):
+        stage = self._make_stage([1, 1, 1])
+        stage.move(100, 0, 0, dt=100)
+        stage.link.state = "e"
+
+        with self.assertRaises(RuntimeError):
+            stage.wait_idle(timeout=10)
+        self.assertTrue(stage.stale)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
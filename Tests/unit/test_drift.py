@@ -0,0 +1,120 @@
+"""Unit tests for phase correlation and drift compensation
+(no hardware required).
+
+The stage runs on the firmware model (fakes.ModelStage); the fake
+camera shifts a texture by the position the motors have reached plus
+the drift.
+"""
+
+from __future__ import annotations
+
+import unittest
+
+import numpy as np
+
+from ControlMotors.drift import (  # type: ignore
+    DriftCorrector, phase_correlation, reference_spectrum)
+from fakes import ModelStage  # type: ignore
+
+
+def texture(shape=(96, 128), seed=0):
+    noise = np.random.default_rng(seed).random(shape)
+    # Low-pass the noise so that the features span a few pixels
+    spectrum = np.fft.fft2(noise)
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.fftfreq(shape[1])[None, :]
+    spectrum *= np.exp(-(fx * fx + fy * fy) / (2 * 0.08 ** 2))
+    return np.fft.ifft2(spectrum).real * 1000
+
+
+def shifted(image, sx, sy):
+    """``image`` moved by (sx, sy) pixels (periodic, sub-pixel)."""
+    fy = np.fft.fftfreq(image.shape[0])[:, None]
+    fx = np.fft.fftfreq(image.shape[1])[None, :]
+    phase = np.exp(-2j * np.pi * (fx * sx + fy * sy))
+    return np.fft.ifft2(np.fft.fft2(image) * phase).real
+
+
+class TestPhaseCorrelation(unittest.TestCase):
+    def test_integer_and_subpixel_shifts(self):
+        image = texture()
+        spectrum = reference_spectrum(image)
+        for sx, sy in [(0, 0), (5, -3), (-12.4, 7.7), (0.3, 0.6)]:
+            measured = phase_correlation(spectrum, shifted(image, sx, sy))
+            np.testing.assert_allclose(measured, [sx, sy], atol=0.2)
+
+    def test_stacks_are_measured_in_one_call(self):
+        image = texture()
+        shifts = [(1, 2), (-4, 0.5), (10, -10)]
+        stack = np.stack([shifted(image, sx, sy) for sx, sy in shifts])
+
+        measured = phase_correlation(reference_spectrum(image), stack)
+
+        self.assertEqual(measured.shape, (3, 2))
+        np.testing.assert_allclose(measured, shifts, atol=0.2)
+
+    def test_size_mismatch(self):
+        spectrum = reference_spectrum(texture((32, 32)))
+        with self.assertRaises(ValueError):
+            phase_correlation(spectrum, texture((32, 48)))
+
+
+class TestDriftCorrector(unittest.TestCase):
+    def setUp(self):
+        self.image = texture()
+        # 4 stage steps per pixel, camera rotated by 10 degrees
+        angle = np.radians(10)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                             [np.sin(angle), np.cos(angle)]])
+        self.pixel_to_step = 4 * rotation
+        self.step_to_pixel = np.linalg.inv(self.pixel_to_step)
+        self.stage = ModelStage()
+        self.drift = np.zeros(2)
+
+    def acquire(self):
+        self.stage.wait_idle()
+        offset = np.array(self.stage.reached[:2]) + self.drift
+        sx, sy = self.step_to_pixel @ offset
+        return shifted(self.image, sx, sy)
+
+    def test_drift_is_moved_back_in_one_move(self):
+        corrector = DriftCorrector(self.stage, self.acquire,
+                                   self.pixel_to_step, threshold=2)
+        corrector.set_reference()
+
+        self.drift = np.array([30.0, -18.0])
+        correction = corrector.correct()
+
+        self.assertEqual(len(self.stage.moves), 1)
+        self.assertLessEqual(abs(correction[0] + 30), 1)
+        self.assertLessEqual(abs(correction[1] - 18), 1)
+        np.testing.assert_allclose(corrector.measure(), [0, 0], atol=0.3)
+        self.assertEqual(list(corrector.total), list(correction))
+
+    def test_small_drift_is_left_alone(self):
+        corrector = DriftCorrector(self.stage, self.acquire,
+                                   self.pixel_to_step, threshold=3)
+        corrector.set_reference()
+        self.drift = np.array([1.0, 1.0])
+
+        self.assertEqual(corrector.correct(), (0, 0))
+        self.assertEqual(self.stage.moves, [])
+
+    def test_matrix_defaults_to_the_stage_calibration(self):
+        self.stage.pixel_to_step = self.pixel_to_step.tolist()
+        corrector = DriftCorrector(self.stage, self.acquire)
+        np.testing.assert_allclose(corrector.pixel_to_step,
+                                   self.pixel_to_step)
+
+        self.stage.pixel_to_step = None
+        with self.assertRaises(ValueError):
+            DriftCorrector(self.stage, self.acquire)
+
+    def test_reference_is_required(self):
+        corrector = DriftCorrector(self.stage, self.acquire, np.eye(2))
+        with self.assertRaises(RuntimeError):
+            corrector.correct()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,199 @@
+"""Unit tests for the Python model of the Oquam firmware and the batched
+B frames (no hardware required)."""
+
+from __future__ import annotations
+
+import unittest
+
+from ControlMotors.firmware_model import (  # type: ignore
+    BLOCK_BUFFER_CAPACITY, OquamModel, bresenham_steps)
+
+
+def simulate_interrupts(delta, dt_ms):
+    # The accumulation-error loop of the stepper interrupt, step by step.
+    period = 10 * dt_ms
+    error = delta - period // 2
+    steps = []
+    done = 0
+    for _ in range(period):
+        if error > 0:
+            done += 1
+            error -= period
+        error += delta
+        steps.append(done)
+    return steps
+
+
+class TestBresenham(unittest.TestCase):
+    def test_closed_form_matches_the_interrupt_loop(self):
+        for dt in (1, 3, 10):
+            for delta in range(0, 10 * dt + 1):
+                expected = simulate_interrupts(delta, dt)
+                got = [bresenham_steps(delta, dt, k + 1)
+                       for k in range(10 * dt)]
+                self.assertEqual(got, expected, (delta, dt))
+
+
+class TestOquamModel(unittest.TestCase):
+    def test_move_takes_dt_milliseconds(self):
+        model = OquamModel()
+        model.send_command("M[100,50,-20,0]")
+        model.advance(50)
+        self.assertEqual(model.send_command("I")[1], 0)
+        self.assertEqual(model.counters, [25, -10, 0])
+        model.advance(50)
+        self.assertEqual(model.send_command("P"), [0, 50, -20, 0])
+        self.assertEqual(model.send_command("I"), [0, 1, "r"])
+
+    def test_full_buffer_answers_again(self):
+        model = OquamModel()
+        for _ in range(BLOCK_BUFFER_CAPACITY):
+            model.send_command("M[10,1,0,0]")
+        with self.assertRaises(RuntimeError) as cm:
+            model.send_command("M[10,1,0,0]")
+        self.assertEqual(str(cm.exception), "Again")
+
+    def test_batch_stops_at_terminator_and_full_buffer(self):
+        model = OquamModel()
+        reply = model.send_command("B[10,1,0,0,10,2,0,0,0,0,0,0]")
+        self.assertEqual(reply, [0, 2])
+        for _ in range(BLOCK_BUFFER_CAPACITY - 3):
+            model.send_command("M[10,1,0,0]")
+        reply = model.send_command("B[10,4,0,0,10,8,0,0,10,16,0,0]")
+        self.assertEqual(reply, [0, 1])
+        model.run_until_idle()
+        self.assertEqual(model.counters[0],
+                         1 + 2 + BLOCK_BUFFER_CAPACITY - 3 + 4)
+
+    def test_homing_offset_reports_lost_steps(self):
+        model = OquamModel(position=(500, 0, 0))
+        model.send_command("h[0,-1,-1,0,0,0,0,0,0,0,0,0]")
+        model.send_command("H")
+        model.run_until_idle()
+        self.assertEqual(model.send_command("P"), [0, 0, 0, 0])
+
+        model.send_command("M[100,300,0,0]")
+        model.slip(0, -7)
+        model.send_command("M[100,-300,0,0]")
+        model.run_until_idle()
+        model.send_command("H")
+        model.run_until_idle()
+        # Seven steps lost on the way out: the switch is reached early.
+        self.assertEqual(model.send_command("O")[1], 7)
+
+    def test_axes_are_homed_one_after_the_other(self):
+        model = OquamModel(position=(3000, 3000, 1200))
+        model.send_command("h[0,1,2,0,0,0,0,0,0,0,0,0]")
+        model.send_command("H")
+        # About 2 s per axis: X is done, Y is homing
+        model.advance(2500)
+        self.assertEqual(model.send_command("I"), [0, 0, "h"])
+        self.assertEqual(model.physical[0], 202)
+        self.assertEqual(model.physical[1], 3000)
+        model.run_until_idle()
+        self.assertEqual(model.send_command("I"), [0, 1, "r"])
+        self.assertEqual(model.physical, [202, 202, 82])
+
+    def test_homing_speeds_are_set_with_h(self):
+        def homing_time(command):
+            model = OquamModel(position=(20000, 0, 0))
+            model.send_command(command)
+            model.send_command("H")
+            model.run_until_idle()
+            return model.now_ms
+
+        # The former single-speed homing: 1000 steps/s all the way
+        single = homing_time("h[0,-1,-1,1000,1000,200,0,0,0,0,0,0]")
+        two_phase = homing_time("h[0,-1,-1,0,0,0,0,0,0,0,0,0]")
+        self.assertLess(two_phase, single / 2.5)
+
+        model = OquamModel()
+        with self.assertRaises(RuntimeError):
+            model.send_command("h[0,-1,-1,-5,0,0,0,0,0,0,0,0]")
+        model.send_command("h[1,-1,-1,0,0,0,5000,400,0,0,0,0]")
+        self.assertEqual(model.homing_fast_speeds, [3000, 5000, 1200])
+        self.assertEqual(model.homing_slow_speeds, [250, 400, 100])
+        self.assertEqual(model.homing_backoff, [200, 200, 80])
+
+    def test_old_homing_order_frame_is_rejected(self):
+        model = OquamModel()
+        with self.assertRaisesRegex(RuntimeError, "number of arguments"):
+            model.send_command("h[1,0,-1]")
+        self.assertEqual(model.homing_axes, [-1, -1, -1])
+
+    def test_homing_error_state(self):
+        model = OquamModel()
+        model.homing_error = True
+        model.send_command("h[2,-1,-1,0,0,0,0,0,0,0,0,0]")
+        model.send_command("H")
+        with self.assertRaises(RuntimeError):
+            model.run_until_idle()
+        self.assertEqual(model.send_command("I")[2], "e")
+        with self.assertRaises(RuntimeError):
+            model.send_command("M[10,1,0,0]")
+
+
+class TestBatchedStage(unittest.TestCase):
+    def _stage(self, **kwargs):
+        from ControlMotors import ControlStage  # type: ignore
+        import importlib
+
+        cm = importlib.import_module(ControlStage.__module__)
+        orig = cm.ControlSerial
+        cm.ControlSerial = OquamModel
+        try:
+            return ControlStage("MODEL", [1, 1, 1], **kwargs)
+        finally:
+            cm.ControlSerial = orig
+
+    def _run(self, stage):
+        for i in range(30):
+            stage.move(1 + i % 3, -(i % 2), 0)
+        stage.flush()
+        stage.link.run_until_idle()
+        return stage.link
+
+    def test_batching_sends_a_third_of_the_frames(self):
+        plain = self._run(self._stage())
+        batched = self._run(self._stage(batch=True))
+
+        self.assertEqual(len(plain.commands), 30)
+        self.assertEqual(len(batched.commands), 10)
+        self.assertTrue(all(c.startswith("B[") for c in batched.commands))
+        self.assertEqual(batched.counters, plain.counters)
+        self.assertEqual(batched.now_ms, plain.now_ms)
+
+    def test_blocks_wait_for_other_commands(self):
+        stage = self._stage(batch=True)
+        stage.move(10, 0, 0)
+        self.assertEqual(stage.link.commands, [])
+        stage.handle_pause()
+        self.assertEqual(stage.link.commands,
+                         ["B[10,10,0,0,0,0,0,0,0,0,0,0]", "p"])
+
+    def test_refused_blocks_are_sent_again(self):
+        stage = self._stage(batch=True)
+        model = stage.link
+        for _ in range(BLOCK_BUFFER_CAPACITY - 1):
+            model.send_command("M[1000,0,0,0]")
+        model.speedup = 100.0
+        for _ in range(3):
+            stage.move(5, 0, 0)
+
+        batches = [c for c in model.commands if c.startswith("B[")]
+        self.assertGreater(len(batches), 1)
+        model.speedup = None
+        model.run_until_idle()
+        self.assertEqual(model.counters[0], 15)
+
+    def test_handle_move_batch_returns_accepted_count(self):
+        stage = self._stage()
+        self.assertEqual(stage.handle_move_batch([(10, 1, 2, 3)]), 1)
+        self.assertEqual(stage.link.commands[-1],
+                         "B[10,1,2,3,0,0,0,0,0,0,0,0]")
+        with self.assertRaises(ValueError):
+            stage.handle_move_batch([(10, 1, 0, 0)] * 4)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
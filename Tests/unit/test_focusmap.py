@@ -0,0 +1,142 @@
+"""Unit tests for the focus surface map (no hardware required).
+
+The stage runs on the firmware model (fakes.ModelStage); the fake
+autofocus moves Z to the surface under the XY position the motors
+have reached.
+"""
+
+from __future__ import annotations
+
+import unittest
+
+import numpy as np
+
+from ControlMotors.focusmap import (  # type: ignore
+    FocusMap, measure_anchors, scan)
+from fakes import ModelStage  # type: ignore
+
+
+def tilted(x, y):
+    return 0.02 * x - 0.01 * y + 300
+
+
+def warped(x, y):
+    return 300 + 40 * np.sin(x / 3000.0) * np.cos(y / 2000.0)
+
+
+class FakeAutofocus:
+    def __init__(self, stage, surface):
+        self.stage = stage
+        self.surface = surface
+        self.runs = 0
+
+    def run(self, span, center=None):
+        self.runs += 1
+        self.stage.wait_idle()
+        x, y, _ = self.stage.reached
+        z = int(round(self.surface(x, y)))
+        self.stage.moveto(z=z)
+        self.stage.wait_idle()
+
+        class Result:
+            pass
+        result = Result()
+        result.z = z
+        return result
+
+
+class TestFocusMap(unittest.TestCase):
+    def test_plane_fits_a_tilted_slide(self):
+        fmap = FocusMap()
+        for x, y in [(0, 0), (10000, 0), (0, 8000), (10000, 8000), (5000, 4000)]:
+            fmap.add(x, y, tilted(x, y))
+
+        xs, ys = np.meshgrid(np.linspace(0, 10000, 7), np.linspace(0, 8000, 5))
+        np.testing.assert_allclose(fmap.z_at(xs, ys), tilted(xs, ys))
+        self.assertAlmostEqual(fmap.z_at(2500, 1000), tilted(2500, 1000))
+        np.testing.assert_allclose(fmap.residuals(), 0, atol=1e-9)
+
+    def test_few_anchors_give_a_flat_map(self):
+        fmap = FocusMap()
+        with self.assertRaises(ValueError):
+            fmap.z_at(0, 0)
+        fmap.add(0, 0, 100)
+        fmap.add(10, 0, 110)
+        self.assertEqual(fmap.z_at(1000, 1000), 105)
+
+    def test_spline_follows_a_warped_sample(self):
+        anchors = [(x, y) for x in np.linspace(0, 12000, 5)
+                   for y in np.linspace(0, 9000, 4)]
+        spline = FocusMap("spline")
+        plane = FocusMap("plane")
+        for x, y in anchors:
+            spline.add(x, y, warped(x, y))
+            plane.add(x, y, warped(x, y))
+
+        np.testing.assert_allclose(spline.residuals(), 0, atol=1e-6)
+        xs, ys = np.meshgrid(np.linspace(500, 11500, 12),
+                             np.linspace(500, 8500, 9))
+        spline_error = np.abs(spline.z_at(xs, ys) - warped(xs, ys)).max()
+        plane_error = np.abs(plane.z_at(xs, ys) - warped(xs, ys)).max()
+        self.assertLess(spline_error, plane_error / 3)
+
+    def test_incremental_refit_matches_a_full_fit(self):
+        rng = np.random.default_rng(3)
+        points = rng.random((12, 2)) * 10000
+        incremental = FocusMap("spline", smoothing=0.5)
+        for i, (x, y) in enumerate(points):
+            incremental.add(x, y, warped(x, y))
+            if i >= 6:
+                # Query between additions: forces intermediate solves
+                incremental.z_at(5000, 5000)
+
+        full = FocusMap("spline", smoothing=0.5)
+        for x, y in points:
+            full.add(x, y, warped(x, y))
+        self.assertAlmostEqual(incremental.z_at(1234, 4321),
+                               full.z_at(1234, 4321))
+
+
+class TestScan(unittest.TestCase):
+    def _tiles(self):
+        return [(x, y) for y in range(0, 5000, 500) for x in range(0, 10000, 500)]
+
+    def test_scan_autofocuses_one_tile_in_twenty(self):
+        stage = ModelStage()
+        autofocus = FakeAutofocus(stage, tilted)
+        fmap = measure_anchors(stage, autofocus,
+                               [(0, 0), (9500, 0), (0, 4500), (9500, 4500)],
+                               FocusMap(), span=100)
+        pictures = []
+
+        visited = scan(stage, self._tiles(), fmap, autofocus=autofocus,
+                       visit=lambda x, y, z: pictures.append((x, y, z)))
+
+        self.assertEqual(len(visited), 200)
+        self.assertEqual(visited, pictures)
+        self.assertEqual(autofocus.runs, 4 + 10)
+        self.assertEqual(len(fmap), 14)
+        for x, y, z in visited:
+            self.assertLessEqual(abs(z - tilted(x, y)), 1)
+
+    def test_scan_refocuses_until_the_plane_is_determined(self):
+        stage = ModelStage()
+        autofocus = FakeAutofocus(stage, tilted)
+
+        visited = scan(stage, self._tiles(), FocusMap(), autofocus=autofocus)
+
+        # The whole first row and the first tile of the second one,
+        # then one tile in twenty
+        self.assertEqual(autofocus.runs, 21 + 8)
+        for x, y, z in visited:
+            self.assertLessEqual(abs(z - tilted(x, y)), 1)
+        # One coordinated XY+Z move per tile, plus the autofocus moves
+        self.assertEqual(len(stage.moves), 200 + autofocus.runs)
+
+    def test_scan_without_anchors_needs_an_autofocus(self):
+        with self.assertRaises(ValueError):
+            scan(ModelStage(), [(0, 0)], FocusMap())
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Import-time budget for the ControlMotors core (no hardware required).
+
+Headless scan workers import ControlMotors for every short-lived job,
+so the core package must not drag in NumPy, Tk or the pyserial
+port-listing tools. Each check runs in a fresh interpreter so that
+modules already imported by the test runner do not hide regressions.
+"""
+
+from __future__ import annotations
+
+import json
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Generous enough for a cold Windows CI runner, tight enough to catch
+# NumPy (or Tk) sneaking back into the core import.
+IMPORT_BUDGET_S = 0.5
+
+HEAVY_MODULES = ["numpy", "tkinter", "serial.tools.list_ports"]
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import ControlMotors
+elapsed = time.perf_counter() - t0
+print(json.dumps({
+    "elapsed": elapsed,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def _probe() -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", _PROBE],
+        cwd=str(ROOT),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+class TestImportTime(unittest.TestCase):
+    def test_core_import_skips_heavy_modules(self):
+        result = _probe()
+        self.assertEqual(result["loaded"], [])
+
+    def test_core_import_within_budget(self):
+        # Take the best of a few runs to smooth out disk-cache noise.
+        elapsed = min(_probe()["elapsed"] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_BUDGET_S)
+
+    def test_interface_motors_still_exported(self):
+        code = (
+            "import sys\n"
+            "from ControlMotors import interface_motors\n"
+            "assert callable(interface_motors)\n"
+            "assert 'tkinter' not in sys.modules\n"
+        )
+        subprocess.run([sys.executable, "-c", code], cwd=str(ROOT), check=True)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Unit tests for well plate layouts and cached focus (no hardware
+required).
+
+The stage runs on the firmware model (fakes.ModelStage); the fake
+autofocus finds the focus of the sample under the motors.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.labware import (FocusCache, Layout,  # type: ignore
+                                   visit_wells)
+from fakes import ModelStage  # type: ignore
+
+
+def tilted(x, y):
+    return 0.002 * x - 0.001 * y + 300
+
+
+class FakeAutofocus:
+    """Samples 5 positions of the range; the score peaks at the focus
+    of the sample under the stage."""
+
+    def __init__(self, stage, surface):
+        self.stage = stage
+        self.surface = surface
+        self.spans = []
+
+    def run(self, span, center=None):
+        self.spans.append(span)
+        self.stage.wait_idle()
+        focus = self.surface(*self.stage.reached[:2])
+        zs = [int(round(center - span / 2 + i * span / 4)) for i in range(5)]
+        samples = [(z, -abs(z - focus)) for z in zs]
+        best = max(zs, key=lambda z: -abs(z - focus))
+        if zs[0] < focus < zs[-1]:
+            best = int(round(focus))
+            samples.append((best, 0.0))
+        self.stage.moveto(z=best)
+        self.stage.wait_idle()
+
+        class Result:
+            pass
+        result = Result()
+        result.z = best
+        result.score = dict(samples)[best]
+        result.samples = sorted(samples)
+        return result
+
+
+class TestLayout(unittest.TestCase):
+    def test_plate_positions(self):
+        plate = Layout.plate(96, 100, origin=(1000, 2000))
+
+        self.assertEqual(len(plate), 96)
+        self.assertEqual(plate.position("A1"), (1000, 2000))
+        self.assertEqual(plate.position("a2"), (1900, 2000))
+        self.assertEqual(plate.position("H12"), (1000 + 11 * 900,
+                                                 2000 + 7 * 900))
+        self.assertEqual(plate.position((1, 0)), plate.position("B1"))
+        np.testing.assert_array_equal(plate.lookup(["A1", "B1"]),
+                                      [(1000, 2000), (1000, 2900)])
+        with self.assertRaises(KeyError):
+            plate.index("I1")
+        with self.assertRaises(KeyError):
+            plate.index((0, 12))
+        self.assertEqual(Layout.plate(1536, 10).wells[-1], "AF48")
+
+    def test_rotation(self):
+        layout = Layout(2, 3, (100, 50), origin=(0, 0), rotation=90)
+        self.assertEqual(layout.position("A3"), (0, 200))
+        self.assertEqual(layout.position("B1"), (-50, 0))
+
+    def test_from_corners(self):
+        truth = Layout(8, 12, (900, 905), origin=(500, 700), rotation=1.5)
+        layout = Layout.from_corners(8, 12, truth.position("A1"),
+                                     truth.position("A12"),
+                                     truth.position("H1"))
+        self.assertLessEqual(np.abs(layout.positions
+                                    - truth.positions).max(), 1)
+
+        copy = Layout.from_dict(layout.to_dict())
+        np.testing.assert_array_equal(copy.positions, layout.positions)
+
+
+class TestFocusCache(unittest.TestCase):
+    def test_prediction_and_file(self):
+        plate = Layout.plate(24, 100)
+        tmp = tempfile.mkdtemp()
+        try:
+            cache = FocusCache(plate, os.path.join(tmp, "focus.json"))
+            self.assertIsNone(cache.predict("B2"))
+            for well in ("A1", "A6", "D1"):
+                cache.set(well, tilted(*plate.position(well)))
+            self.assertEqual(cache.get("A6"), tilted(*plate.position("A6")))
+            self.assertAlmostEqual(cache.predict("D6"),
+                                   tilted(*plate.position("D6")))
+            cache.save()
+
+            again = FocusCache(plate, cache.path)
+            self.assertEqual(len(again), 3)
+            self.assertEqual(again.get("D1"), cache.get("D1"))
+            again.forget("D1")
+            self.assertIsNone(again.get("D1"))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestVisitWells(unittest.TestCase):
+    def setUp(self):
+        self.stage = ModelStage(profiles=[AxisProfile(1000)] * 3)
+        self.stage.moveto(z=300)
+        self.stage.wait_idle()
+        self.autofocus = FakeAutofocus(self.stage, tilted)
+        self.plate = Layout.plate(24, 100, origin=(1000, 1000))
+
+    def test_one_full_search_then_narrow_ones(self):
+        cache = FocusCache(self.plate)
+        visited = visit_wells(self.stage, self.plate,
+                              autofocus=self.autofocus, cache=cache)
+
+        self.assertEqual(sorted(w for w, _, _, _ in visited),
+                         sorted(self.plate.wells))
+        for well, x, y, z in visited:
+            self.assertEqual(z, round(tilted(x, y)))
+        self.assertEqual(self.autofocus.spans.count(400), 1)
+        self.assertEqual(len(cache), 24)
+        # Each move goes to a neighbouring well
+        steps = np.abs(np.diff([(x, y) for _, x, y, _ in visited],
+                               axis=0)).max(axis=1)
+        self.assertTrue(np.all(steps == 1930))
+
+        # Second run: only narrow searches around the cached Z
+        self.autofocus.spans = []
+        visit_wells(self.stage, self.plate, ["D6", "A1"],
+                    autofocus=self.autofocus, cache=cache)
+        self.assertEqual(self.autofocus.spans, [40, 40])
+
+    def test_narrow_search_falls_back(self):
+        cache = FocusCache(self.plate)
+        cache.set("B2", 0)
+        visited = visit_wells(self.stage, self.plate, ["B2"],
+                              autofocus=self.autofocus, cache=cache)
+
+        self.assertEqual(self.autofocus.spans, [40, 400])
+        self.assertEqual(visited[0][3], round(tilted(*self.plate.position(
+            "B2"))))
+        self.assertEqual(cache.get("B2"), visited[0][3])
+
+    def test_without_autofocus(self):
+        visits = []
+        visit_wells(self.stage, self.plate, ["C3", "A1"],
+                    visit=lambda *args: visits.append(args))
+        self.assertEqual([v[0] for v in visits], ["C3", "A1"])
+        self.assertEqual(self.stage.reached[:2], self.plate.position("A1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Unit tests for the lookahead move merger (no hardware required)."""
+
+from __future__ import annotations
+
+import importlib
+import unittest
+
+from ControlMotors.lookahead import Lookahead  # type: ignore
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+
+    def send_command(self, s: str):
+        self.commands.append(s)
+        if s == "I":
+            return [0, 1, "r"]
+        return [0]
+
+
+def _run(lookahead, moves):
+    out = []
+    for move in moves:
+        out.extend(lookahead.push(*move))
+    segment = lookahead.flush()
+    if segment is not None:
+        out.append(segment)
+    return out
+
+
+class TestLookahead(unittest.TestCase):
+    def test_collinear_moves_merge(self):
+        self.assertEqual(_run(Lookahead(), [(1, 2, 0)] * 50), [(50, 100, 0)])
+
+    def test_direction_changes_split(self):
+        moves = [(1, 0, 0)] * 3 + [(0, 1, 0)] * 2 + [(-1, 0, 0)]
+        self.assertEqual(_run(Lookahead(), moves),
+                         [(3, 0, 0), (0, 2, 0), (-1, 0, 0)])
+
+    def test_reversal_is_never_merged(self):
+        self.assertEqual(_run(Lookahead(tolerance=10), [(5, 0, 0), (-5, 0, 0)]),
+                         [(5, 0, 0), (-5, 0, 0)])
+
+    def test_tolerance_allows_small_deviations(self):
+        moves = [(10, 0, 0), (10, 1, 0), (10, 0, 0)]
+        self.assertEqual(_run(Lookahead(tolerance=1), moves), [(30, 1, 0)])
+        self.assertEqual(len(_run(Lookahead(tolerance=0.1), moves)), 3)
+
+    def test_segments_fit_in_a_frame(self):
+        segments = _run(Lookahead(window=1000), [(0, 0, 1000)] * 40)
+        self.assertEqual(segments, [(0, 0, 32000), (0, 0, 8000)])
+
+    def test_window_limits_merging(self):
+        self.assertEqual(_run(Lookahead(window=4), [(1, 0, 0)] * 10),
+                         [(4, 0, 0), (4, 0, 0), (2, 0, 0)])
+
+    def test_zero_moves_are_dropped(self):
+        self.assertEqual(_run(Lookahead(), [(0, 0, 0), (1, 0, 0), (0, 0, 0)]),
+                         [(1, 0, 0)])
+
+
+class TestStageLookahead(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+        self.stage = ControlStage("FAKE_PORT", [2, 1, 1], lookahead=Lookahead())
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def test_dense_path_becomes_one_block(self):
+        for _ in range(50):
+            self.stage.move_dx(1)
+        self.assertEqual(self.stage.link.commands, [])
+        self.assertEqual(self.stage.x, 50)
+
+        self.stage.flush()
+
+        # One 100 ms block instead of 50 blocks of 10 ms.
+        self.assertEqual(self.stage.link.commands, ["M[100,100,0,0]"])
+
+    def test_other_commands_send_pending_moves_first(self):
+        self.stage.move_dy(3)
+        self.stage.move_dy(3)
+        self.assertEqual(self.stage.send_idle(), 1)
+        self.stage.move_dz(5, dt=100)
+
+        self.assertEqual(self.stage.link.commands,
+                         ["M[10,0,6,0]", "I", "M[100,0,0,5]"])
+
+    def test_direction_change_sends_previous_segment(self):
+        self.stage.move_dx(1)
+        self.stage.move_dy(1)
+        self.assertEqual(self.stage.link.commands, ["M[10,2,0,0]"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,159 @@
+"""Unit tests for the hybrid stepper + piezo Z axis (no hardware
+required).
+
+The stage runs on the firmware model (fakes.ModelStage) and the clock
+is simulated: stepper moves take time in proportion to their length,
+piezo moves only their settling time.
+"""
+
+from __future__ import annotations
+
+import threading
+import unittest
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.piezo import HybridZ, SimulatedPiezo  # type: ignore
+from fakes import ModelStage  # type: ignore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+class TestHybridZ(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        # 200 steps/s on Z, starting at Z = 100
+        self.stage = ModelStage(profiles=[AxisProfile(200)] * 3,
+                                sleep=self.clock.sleep)
+        self.stage.moveto(z=100)
+        self.stage.wait_idle()
+        self.stage.moves.clear()
+        self.clock.now = 0.0
+        self.piezo = SimulatedPiezo((0.0, 20.0), settle_time=0.002)
+        self.axis = HybridZ(self.stage, self.piezo, um_per_step=0.5,
+                            settle=0.05, sleep=self.clock.sleep)
+
+    def z_moves(self):
+        return [z for _, _, z in self.stage.moves]
+
+    def test_small_moves_use_the_piezo(self):
+        self.assertEqual(self.axis.z, 50.0)
+        self.axis.move_to(53.25)
+        self.axis.move_by(-0.1)
+
+        self.assertEqual(self.z_moves(), [])
+        self.assertAlmostEqual(self.axis.z, 53.15)
+        self.assertAlmostEqual(self.piezo.position, 13.15)
+        self.assertEqual(self.axis.fine_moves, 2)
+
+    def test_piezo_moves_wait_for_the_settle_time(self):
+        self.axis.move_to(53.25)
+        self.assertAlmostEqual(self.clock.now, 0.002)
+
+        # Stepper move, its settle pause, then the piezo and its own
+        self.axis.move_to(250.3)
+        self.assertAlmostEqual(self.clock.now,
+                               0.002 + 401 / 200.0 + 0.05 + 0.002)
+
+        self.clock.now = 0.0
+        self.axis.recenter_after = False
+        self.axis.zstack(250.0, 251.0, 0.25, lambda z: None)
+        self.assertAlmostEqual(self.clock.now, 5 * 0.002)
+
+    def test_large_moves_use_the_stepper(self):
+        self.axis.move_to(250.3)
+
+        self.assertEqual(self.z_moves(), [501])
+        self.assertEqual(self.stage.reached[2], 501)
+        self.assertAlmostEqual(self.axis.z, 250.3)
+        self.assertAlmostEqual(self.axis.offset, -0.2)
+        self.assertEqual(self.axis.coarse_moves, 1)
+
+    def test_recenter_keeps_z(self):
+        self.axis.move_to(58.0)
+        self.assertTrue(self.axis.recenter(wait=True))
+        self.assertEqual(self.z_moves(), [116])
+        self.assertAlmostEqual(self.axis.z, 58.0)
+        self.assertAlmostEqual(self.axis.offset, 0.0)
+        # Already centred: nothing to do
+        self.assertFalse(self.axis.recenter())
+
+    def test_background_recenter_then_move(self):
+        self.axis.move_to(58.0)
+        self.assertTrue(self.axis.recenter())
+        self.axis.move_to(58.5)
+
+        self.assertEqual(self.axis.recenters, 1)
+        self.assertEqual(self.z_moves(), [116])
+        self.assertAlmostEqual(self.axis.z, 58.5)
+
+    def test_recenter_while_xy_moves(self):
+        self.axis.move_to(58.0)
+        self.assertTrue(self.axis.recenter())
+        self.stage.moveto(x=500, y=300)
+        self.axis.wait()
+        self.stage.wait_idle()
+
+        # The XY move is kept whichever of the two went first
+        self.assertEqual(self.stage.reached, (500, 300, 116))
+        self.assertEqual((self.stage.x, self.stage.y, self.stage.z),
+                         (500, 300, 116))
+        self.assertAlmostEqual(self.axis.z, 58.0)
+
+    def test_zstack_ends_with_a_recenter(self):
+        self.axis.zstack(50.0, 58.0, 0.5, lambda z: None)
+        self.axis.wait()
+
+        self.assertEqual(self.axis.recenters, 1)
+        self.assertAlmostEqual(self.axis.z, 58.0)
+        self.assertLessEqual(abs(self.axis.offset), 0.25)
+
+    def test_zstack_is_faster_than_stepping(self):
+        planes = []
+
+        def visit(z):
+            planes.append((z, self.axis.z))
+
+        self.axis.zstack(60.0, 70.0, 0.25, visit)
+        hybrid = self.clock.now
+
+        self.assertEqual(len(planes), 41)
+        for z, actual in planes:
+            self.assertAlmostEqual(z, actual)
+        self.assertEqual(self.axis.coarse_moves, 1)
+        self.axis.wait()
+        self.assertAlmostEqual(self.axis.z, 70.0)
+
+        # The same stack with the stepper alone, at its 0.5 um resolution
+        self.stage.moveto(z=100)
+        self.stage.wait_idle()
+        self.clock.now = 0.0
+        for k in range(21):
+            self.stage.moveto(z=120 + k)
+            self.stage.wait_idle()
+            self.clock.sleep(0.05)
+        self.assertLess(hybrid, self.clock.now / 4)
+
+    def test_long_zstack_in_parts(self):
+        seen = []
+        self.axis.zstack(0.0, 40.0, 1.0, seen.append)
+
+        self.assertEqual(seen, [float(z) for z in range(41)])
+        self.assertEqual(self.axis.coarse_moves, 3)
+
+    def test_step_must_fit_in_the_piezo(self):
+        with self.assertRaises(ValueError):
+            HybridZ(self.stage, self.piezo, um_per_step=25.0)
+        with self.assertRaises(ValueError):
+            self.piezo.move_to(21.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Unit tests for the pipelined acquisition loop (no hardware required).
+
+The stage runs on the firmware model (fakes.ModelStage) and the fake
+camera checks that the motors have reached the tile; both sleep to
+stand for the move and the exposure. The processing functions are
+module-level so that the process pool can pickle them.
+"""
+
+from __future__ import annotations
+
+import sys
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ControlMotors.pipeline import Pipeline  # type: ignore
+from fakes import ModelStage  # type: ignore
+
+MOVE_S = 0.05
+CAPTURE_S = 0.02
+PROCESS_S = 0.08
+
+
+class FakeCamera:
+    def __init__(self, stage, fail_at=None):
+        self.stage = stage
+        self.fail_at = fail_at
+        self.captures = 0
+
+    def __call__(self, tile):
+        x, y = self.stage.reached[:2]
+        if tuple(tile) != (x, y):
+            raise AssertionError("Captured while the stage was elsewhere")
+        if self.captures == self.fail_at:
+            raise IOError("camera disconnected")
+        self.captures += 1
+        time.sleep(CAPTURE_S)
+        return np.full((120, 160), x * 100 + y, dtype=np.uint16)
+
+
+def slow_mean(frame, tile):
+    time.sleep(PROCESS_S)
+    return float(frame.mean()), tile
+
+
+def mean(frame, tile):
+    return float(frame.mean())
+
+
+def model_stage():
+    # Every move takes MOVE_S of wall clock
+    return ModelStage(sleep=lambda seconds: time.sleep(MOVE_S))
+
+
+def grid(n):
+    return [(x, y) for y in range(2) for x in range(n // 2)]
+
+
+@unittest.skipIf(sys.version_info < (3, 8),
+                 "multiprocessing.shared_memory needs Python 3.8")
+class TestPipeline(unittest.TestCase):
+    def test_results_come_back_in_order(self):
+        stage = model_stage()
+        tiles = grid(8)
+
+        results = Pipeline(stage, FakeCamera(stage), slow_mean).run(tiles)
+
+        self.assertEqual(results,
+                         [(x * 100.0 + y, (x, y)) for x, y in tiles])
+        self.assertEqual([m[:2] for m in stage.moves], tiles)
+
+    def test_motion_overlaps_processing(self):
+        stage = model_stage()
+        tiles = grid(12)
+        pipeline = Pipeline(stage, FakeCamera(stage), slow_mean, workers=2)
+
+        start = time.perf_counter()
+        pipeline.run(tiles)
+        elapsed = time.perf_counter() - start
+
+        sequential = len(tiles) * (MOVE_S + CAPTURE_S + PROCESS_S)
+        self.assertLess(elapsed, 0.75 * sequential)
+
+    def test_slow_processing_holds_the_capture_back(self):
+        stage = model_stage()
+        camera = FakeCamera(stage)
+        go = threading.Event()
+
+        def blocked(frame, tile):
+            go.wait()
+            return float(frame.mean())
+
+        pipeline = Pipeline(stage, camera, blocked, workers=0, depth=2)
+        runner = threading.Thread(target=pipeline.run, args=(grid(10),))
+        runner.start()
+        time.sleep(10 * (MOVE_S + CAPTURE_S))
+        # Two frames in the slots, one waiting for a slot
+        self.assertEqual(camera.captures, 3)
+        go.set()
+        runner.join()
+        self.assertEqual(camera.captures, 10)
+
+    def test_errors_stop_the_scan(self):
+        stage = model_stage()
+
+        with self.assertRaises(IOError):
+            Pipeline(stage, FakeCamera(stage, fail_at=3), mean).run(grid(10))
+        self.assertLessEqual(len(stage.moves), 5)
+        self.assertNotIn("pipeline-motion",
+                         [t.name for t in threading.enumerate()])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Unit tests for the host-side motion planner (no hardware required)."""
+
+from __future__ import annotations
+
+import importlib
+import unittest
+
+from ControlMotors.planner import MotionPlanner, MAX_BLOCK_DT, MAX_BLOCK_STEPS
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+
+    def send_command(self, s: str):
+        self.commands.append(s)
+        return [0]
+
+
+def _totals(blocks):
+    return [sum(b[i] for b in blocks) for i in range(4)]
+
+
+class TestMotionPlanner(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rates = [5000, 4000, 1000]
+        self.accels = [20000, 10000, 5000]
+
+    def test_blocks_add_up_to_the_move(self):
+        for profile in ("trapezoid", "scurve"):
+            planner = MotionPlanner(self.rates, self.accels, profile)
+            for move in [(20000, 0, 0), (123, -4567, 89), (0, 0, -3), (1, 1, 1)]:
+                blocks = planner.plan(*move)
+                self.assertEqual(_totals(blocks)[1:], list(move))
+                self.assertTrue(all(b[0] >= 1 for b in blocks))
+                self.assertTrue(all(b[1:] != (0, 0, 0) for b in blocks))
+
+    def test_speed_limits_hold_for_every_block(self):
+        planner = MotionPlanner(self.rates, self.accels, segment_ms=10)
+        for dt, *steps in planner.plan(30000, -20000, 1000):
+            for axis, n in enumerate(steps):
+                # Allow one step of rounding per block.
+                self.assertLessEqual(abs(n) - 1, self.rates[axis] * dt / 1000.0)
+
+    def test_ramps_accelerate_then_decelerate(self):
+        for profile in ("trapezoid", "scurve"):
+            planner = MotionPlanner(self.rates, self.accels, profile)
+            speeds = [b[1] / b[0] for b in planner.plan(20000, 0, 0)]
+            peak = speeds.index(max(speeds))
+            self.assertLess(speeds[0], 0.2 * max(speeds))
+            self.assertLess(speeds[-1], 0.2 * max(speeds))
+            self.assertGreater(peak, 0)
+            self.assertLess(peak, len(speeds) - 1)
+
+    def test_long_moves_are_faster_than_one_step_per_ms(self):
+        planner = MotionPlanner(self.rates, self.accels)
+        self.assertLess(planner.duration(20000, 0, 0), 20000 / 4)
+
+    def test_blocks_fit_in_int16_frames(self):
+        planner = MotionPlanner([1e6] * 3, [1e5] * 3)
+        blocks = MotionPlanner([100] * 3, [1e6] * 3).plan(32767 * 2, 0, 0)
+        blocks += planner.plan(100000, -70000, 5)
+        for block in blocks:
+            self.assertLessEqual(block[0], MAX_BLOCK_DT)
+            self.assertTrue(all(abs(n) <= MAX_BLOCK_STEPS for n in block[1:]))
+
+    def test_rejects_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            MotionPlanner(self.rates, self.accels, "cubic")
+
+
+class TestControlStagePlanner(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def test_stage_sends_planned_blocks_in_motor_steps(self):
+        from ControlMotors import ControlStage  # type: ignore
+        planner = MotionPlanner([5000] * 3, [20000] * 3)
+        stage = ControlStage("FAKE_PORT", [2, 3, 4], planner=planner)
+
+        stage.move_dx(5000)
+
+        commands = stage.link.commands
+        self.assertGreater(len(commands), 1)
+        self.assertEqual(len(commands), len(planner.plan(10000, 0, 0)))
+        sent = sum(int(c[2:-1].split(",")[1]) for c in commands)
+        self.assertEqual(sent, 10000)
+        self.assertEqual(stage.x, 5000)
+
+    def test_explicit_dt_bypasses_the_planner(self):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("FAKE_PORT", [1, 1, 1],
+                             planner=MotionPlanner([5000] * 3, [20000] * 3))
+
+        stage.move_dz(100, dt=500)
+
+        self.assertEqual(stage.link.commands, ["M[500,0,0,100]"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Unit tests for the visiting order of stage positions (no hardware
+required)."""
+
+from __future__ import annotations
+
+import random
+import unittest
+
+import numpy as np
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.routing import plan_route, travel_times  # type: ignore
+
+
+def path_travel(travel, order):
+    stops = [0] + [j + 1 for j in order]
+    return sum(travel[a, b] for a, b in zip(stops, stops[1:]))
+
+
+class TestTravelTimes(unittest.TestCase):
+    def test_longest_axis_at_lowest_moving_rate(self):
+        profiles = [AxisProfile(1000), AxisProfile(500), AxisProfile(100)]
+        points = [(0, 0, 0), (1000, 100, 0), (0, 0, 10)]
+        times = travel_times(points, [2, 1, 1], profiles, overhead=0.1)
+
+        # X moves 2000 motor steps, Y 100: both at 500 steps/s
+        self.assertAlmostEqual(times[0, 1], 4.1)
+        self.assertAlmostEqual(times[1, 0], 4.1)
+        # Only Z moves
+        self.assertAlmostEqual(times[0, 2], 0.2)
+        self.assertEqual(times[1, 1], 0.0)
+
+    def test_two_columns(self):
+        times = travel_times([(0, 0), (300, 400)], [1, 1, 1],
+                             [AxisProfile(100)] * 3)
+        self.assertAlmostEqual(times[0, 1], 4.0)
+
+
+class TestPlanRoute(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.points = [(0, 0)] + [(rng.randrange(10000), rng.randrange(10000))
+                                  for _ in range(12)]
+        self.travel = travel_times(self.points, [1, 1, 1],
+                                   [AxisProfile(1000)] * 3)
+
+    def test_shorter_than_the_given_order(self):
+        n = len(self.points) - 1
+        route = plan_route(self.travel, [1e9] * n, [1.0] * n)
+
+        self.assertEqual(sorted(route.order), list(range(n)))
+        self.assertEqual(route.lateness, 0.0)
+        self.assertAlmostEqual(route.travel,
+                               path_travel(self.travel, route.order))
+        self.assertLess(route.travel,
+                        0.7 * path_travel(self.travel, range(n)))
+
+    def test_deadlines_come_first(self):
+        n = len(self.points) - 1
+        # The farthest position must be visited first
+        far = int(np.argmax(self.travel[0, 1:]))
+        deadlines = [1e9] * n
+        deadlines[far] = self.travel[0, far + 1]
+        route = plan_route(self.travel, deadlines, [1.0] * n)
+
+        self.assertEqual(route.order[0], far)
+        self.assertEqual(route.lateness, 0.0)
+
+    def test_release_times(self):
+        travel = travel_times([(0, 0), (1000, 0), (2000, 0)], [1, 1, 1],
+                              [AxisProfile(1000)] * 3)
+        # The near position is not due before t = 10
+        route = plan_route(travel, [20.0, 5.0], [1.0, 1.0],
+                           releases=[10.0, 0.0])
+
+        self.assertEqual(route.order, [1, 0])
+        self.assertEqual(route.starts, [2.0, 10.0])
+        self.assertEqual(route.lateness, 0.0)
+
+    def test_empty(self):
+        self.assertEqual(plan_route(np.zeros((1, 1)), [], []).order, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
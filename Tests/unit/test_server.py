@@ -0,0 +1,147 @@
+"""Unit tests for the local stage daemon (no hardware required).
+
+The server runs in a thread on an ephemeral TCP port and owns a
+ControlStage whose ControlSerial connection is replaced by a fake.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import importlib
+import io
+import json
+import socket
+import threading
+import unittest
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+
+    def send_command(self, s: str):
+        self.commands.append(s)
+        if s == "I":
+            return [0, 1, "r"]
+        if s.startswith("E[9"):
+            raise RuntimeError("Invalid state")
+        return [0]
+
+
+class TestStageServer(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+        from ControlMotors.server import StageServer  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+
+        self.stage = ControlStage("FAKE_PORT", [2, 3, 4])
+        self.server = StageServer(self.stage, ("127.0.0.1", 0))
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self._cm.ControlSerial = self._orig_cs
+
+    def _client(self):
+        from ControlMotors.server import StageClient  # type: ignore
+        client = StageClient(self.address, timeout=5)
+        self.clients.append(client)
+        return client
+
+    def test_client_forwards_commands_to_shared_stage(self):
+        client = self._client()
+        self.assertEqual(client.gears, [2, 3, 4])
+
+        client.move_dx(10)
+
+        self.assertEqual(self.stage.link.commands[-1], "M[20,20,0,0]")
+        self.assertEqual((client.x, client.y, client.z), (10, 0, 0))
+        self.assertEqual(client.send_idle(), 1)
+
+    def test_subscribers_see_moves_from_other_clients(self):
+        a = self._client()
+        b = self._client()
+        received = threading.Event()
+        events = []
+
+        def on_event(event):
+            events.append(event)
+            received.set()
+
+        b.subscribe(on_event)
+        a.move_dy(5)
+
+        self.assertTrue(received.wait(5))
+        self.assertEqual(events[0]["op"], "move_dy")
+        self.assertEqual((b.x, b.y, b.z), (0, 5, 0))
+
+    def test_a_failing_subscriber_does_not_stop_the_client(self):
+        a = self._client()
+        b = self._client()
+        received = threading.Event()
+
+        def broken(event):
+            raise KeyError("no such field")
+
+        b.subscribe(broken)
+        b.listeners.append(lambda event: received.set())
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            a.move_dy(5)
+            self.assertTrue(received.wait(5))
+            # Replies still reach b
+            self.assertEqual(b.send_idle(), 1)
+        self.assertIn("KeyError", stderr.getvalue())
+
+    def test_errors_are_raised_in_the_client(self):
+        client = self._client()
+        with self.assertRaises(RuntimeError):
+            client.handle_enable(9)
+
+    def test_clients_cannot_close_the_shared_port(self):
+        client = self._client()
+        for op in ("close", "reset", "reconnect", "execute", "save_config"):
+            self.assertNotIn(op, client._operations)
+        with self.assertRaises(AttributeError):
+            client.handle_unknown
+
+    def test_malformed_requests_get_an_error_reply(self):
+        with socket.create_connection(self.address, timeout=5) as sock:
+            replies = sock.makefile("rb")
+            sock.sendall(b"not json\n[1, 2]\n"
+                         b'{"id": 7, "op": "send_idle"}\n')
+            for _ in range(2):
+                reply = json.loads(replies.readline())
+                self.assertFalse(reply["ok"])
+                self.assertIn("Invalid request", reply["error"])
+            # The connection is still served
+            reply = json.loads(replies.readline())
+            self.assertEqual((reply["id"], reply["result"]), (7, 1))
+
+    def test_calls_fail_once_the_connection_is_lost(self):
+        client = self._client()
+        client.sock.shutdown(socket.SHUT_RD)
+        client._reader.join(5)
+
+        with self.assertRaises(ConnectionError):
+            client.send_idle()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
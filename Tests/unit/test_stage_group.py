@@ -0,0 +1,178 @@
+"""Unit tests for StageGroup (no hardware required).
+
+Each fake serial link sleeps for a short round trip and records when
+each command was sent and answered: commands dispatched concurrently
+are in flight at the same time, those of a serial loop over the stages
+never are. The tests check that overlap rather than wall-clock limits,
+which a loaded machine can exceed.
+"""
+
+from __future__ import annotations
+
+import importlib
+import threading
+import time
+import unittest
+
+ROUND_TRIP_S = 0.05
+
+
+class FakeDriver:
+    def close(self) -> None:  # pragma: no cover - trivial
+        pass
+
+
+class FakeControlSerial:
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.driver = FakeDriver()
+        self.commands: list[str] = []
+        # time.perf_counter() at which each command was sent and answered
+        self.sent: list[float] = []
+        self.answered: list[float] = []
+        self.busy_polls = 2
+        self.lock = threading.Lock()
+
+    def send_command(self, s: str):
+        sent = time.perf_counter()
+        time.sleep(ROUND_TRIP_S)
+        with self.lock:
+            self.commands.append(s)
+            self.sent.append(sent)
+            self.answered.append(time.perf_counter())
+        if s == "I":
+            self.busy_polls -= 1
+            return [0, int(self.busy_polls <= 0), "r"]
+        if s.startswith("B"):
+            # All the blocks fit in the buffer; dt 0 ends the list
+            dts = [int(v) for v in s[2:-1].split(",")[::4]]
+            return [0, (dts + [0]).index(0)]
+        return [0]
+
+
+class TestStageGroup(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = FakeControlSerial
+
+        from ControlMotors import StageGroup  # type: ignore
+        self.group = StageGroup.open(["A", "B", "C"], [2, 1, 1])
+
+    def tearDown(self) -> None:
+        self.group.close()
+        self._cm.ControlSerial = self._orig_cs
+
+    def _in_flight_together(self, stages, command):
+        # The first `command` of every stage was sent before any of them
+        # was answered
+        sent, answered = [], []
+        for stage in stages:
+            i = stage.link.commands.index(command)
+            sent.append(stage.link.sent[i])
+            answered.append(stage.link.answered[i])
+        self.assertLess(max(sent), min(answered), command)
+
+    def test_open_shares_gears(self):
+        self.assertEqual([s.arduino_port for s in self.group], ["A", "B", "C"])
+        self.assertTrue(all(s.gears == [2, 1, 1] for s in self.group))
+
+    def test_moves_are_dispatched_concurrently(self):
+        self.group.move([(10, 0, 0), (0, 5, 0), None])
+
+        self.assertLess(max(s.link.sent[0] for s in self.group[:2]),
+                        min(s.link.answered[0] for s in self.group[:2]))
+        self.assertEqual(self.group[0].link.commands, ["M[20,20,0,0]"])
+        self.assertEqual(self.group[1].link.commands, ["M[10,0,5,0]"])
+        self.assertEqual(self.group[2].link.commands, [])
+        self.assertEqual(self.group[0].x, 10)
+
+    def test_synchronized_start_prefills_while_paused(self):
+        skew = self.group.synchronized_start([
+            [(1, 0, 0), (2, 0, 0)],
+            [(0, 1, 0)],
+            lambda stage: stage.handle_move(100, 0, 0, 7),
+        ])
+
+        self.assertEqual(self.group[0].link.commands,
+                         ["p", "M[10,2,0,0]", "M[10,4,0,0]", "c"])
+        self.assertEqual(self.group[2].link.commands,
+                         ["p", "M[100,0,0,7]", "c"])
+        self.assertEqual(len(self.group.start_times), 3)
+        self.assertGreaterEqual(skew, 0.0)
+        self._in_flight_together(self.group, "c")
+
+    def _motion_sent_before_start(self, group):
+        # Every motion frame must be in the firmware before the first c
+        first_start = min(group.start_times)
+        for stage in group:
+            for command, t in zip(stage.link.commands, stage.link.answered):
+                if command[0] in "MB":
+                    self.assertLess(t, first_start, command)
+
+    def test_synchronized_start_sends_batched_blocks_first(self):
+        from ControlMotors import ControlStage, StageGroup  # type: ignore
+        group = StageGroup([ControlStage("D", [1, 1, 1], batch=True),
+                            ControlStage("E", [1, 1, 1])])
+        try:
+            group.synchronized_start([[(1, 0, 0), (0, 1, 0)], [(0, 0, 1)]])
+
+            self.assertEqual(group[0].link.commands,
+                             ["p", "B[10,1,0,0,10,0,1,0,0,0,0,0]", "c"])
+            self._motion_sent_before_start(group)
+        finally:
+            group.close()
+
+    def test_synchronized_start_sends_lookahead_moves_first(self):
+        from ControlMotors import ControlStage, StageGroup  # type: ignore
+        group = StageGroup([
+            ControlStage("D", [1, 1, 1], lookahead=True),
+            ControlStage("E", [1, 1, 1], lookahead=True, batch=True),
+            ControlStage("F", [1, 1, 1])])
+        try:
+            skew = group.synchronized_start([[(1, 0, 0), (2, 0, 0)],
+                                             [(0, 3, 0), (0, 0, 1)],
+                                             [(0, 0, 1)]])
+
+            # The collinear moves are merged into one block
+            self.assertEqual(group[0].link.commands,
+                             ["p", "M[10,3,0,0]", "c"])
+            self.assertEqual(group[1].link.commands,
+                             ["p", "B[10,0,3,0,10,0,0,1,0,0,0,0]", "c"])
+            self._motion_sent_before_start(group)
+            self.assertGreaterEqual(skew, 0.0)
+            self._in_flight_together(group, "c")
+        finally:
+            group.close()
+
+    def test_wait_idle_waits_for_every_stage(self):
+        self.group.wait_idle(timeout=5, interval=0)
+
+        for stage in self.group:
+            self.assertEqual(stage.link.commands, ["I", "I"])
+        self._in_flight_together(self.group, "I")
+
+    def test_home_runs_on_every_stage_at_once(self):
+        self.group.home("zx", timeout=5)
+
+        for stage in self.group:
+            self.assertTrue(stage.link.commands[0].startswith("h[2,0,-1,"))
+            self.assertEqual(stage.link.commands[1:], ["H", "I", "I"])
+        self._in_flight_together(self.group, "H")
+
+    def test_errors_are_raised_after_all_stages_finish(self):
+        def fail_on_b(stage):
+            if stage.arduino_port == "B":
+                raise RuntimeError("Again")
+            stage.handle_pause()
+
+        with self.assertRaises(RuntimeError):
+            self.group.map(fail_on_b)
+        self.assertEqual(self.group[2].link.commands, ["p"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
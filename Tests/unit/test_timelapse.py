@@ -0,0 +1,119 @@
+"""Unit tests for the time-lapse scheduler (no hardware required).
+
+The stage runs on the firmware model (fakes.ModelStage); its moves and
+the visits only advance a fake clock.
+"""
+
+from __future__ import annotations
+
+import unittest
+
+from ControlMotors import AxisProfile  # type: ignore
+from ControlMotors.timelapse import TimeLapse  # type: ignore
+from fakes import ModelStage  # type: ignore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+class TestTimeLapse(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stage = ModelStage(profiles=[AxisProfile(1000)] * 3,
+                                sleep=self.clock.sleep)
+        self.seen = []
+
+    def visit(self, duration):
+        def visit(index, position):
+            self.seen.append((index, self.clock.now))
+            self.clock.now += duration
+        return visit
+
+    def timelapse(self, positions, intervals, duration=1.0, **kwargs):
+        return TimeLapse(self.stage, positions, intervals,
+                         self.visit(duration), visit_time=duration,
+                         clock=self.clock, sleep=self.clock.sleep,
+                         overhead=0.0, **kwargs)
+
+    def test_rounds_follow_a_short_route(self):
+        positions = [(5000, 0, 0), (1000, 0, 0), (4000, 0, 0),
+                     (2000, 0, 0), (3000, 0, 0)]
+        lapse = self.timelapse(positions, 60.0)
+        lapse.run(visits=10)
+
+        order = [i for i, _ in self.seen]
+        self.assertEqual(order[:5], [1, 3, 4, 2, 0])
+        # Each position keeps its own 60 s interval
+        self.assertEqual(order[5:], order[:5])
+        self.assertEqual(lapse.stats()["late"], 0)
+
+    def test_no_drift(self):
+        lapse = self.timelapse([(0, 0, 0), (2000, 0, 0)], 10.0,
+                               duration=3.0, tolerance=1.0)
+        lapse.run(duration=100.0)
+
+        for index in (0, 1):
+            starts = [t for i, t in self.seen if i == index]
+            self.assertGreaterEqual(len(starts), 10)
+            dues = [v.due for v in lapse.visits if v.index == index]
+            self.assertEqual(dues, [dues[0] + 10.0 * k
+                                    for k in range(len(dues))])
+            # Never early
+            for t, due in zip(starts, dues):
+                self.assertGreaterEqual(t, due)
+        stats = lapse.stats()
+        self.assertEqual(stats["missed"], 0)
+        self.assertEqual(stats["late"], 0)
+        self.assertEqual(stats["on_time"], 1.0)
+        self.assertGreaterEqual(stats["min_slack"], 0.0)
+
+    def test_urgent_position_first(self):
+        # Position 2 comes back every 8 s; the others every 60 s
+        positions = [(0, 0, 0), (3000, 0, 0), (1500, 0, 0), (4500, 0, 0)]
+        lapse = self.timelapse(positions, [60.0, 60.0, 8.0, 60.0],
+                               duration=1.0, tolerance=2.0)
+        lapse.run(duration=120.0)
+
+        starts = [t for i, t in self.seen if i == 2]
+        self.assertGreaterEqual(len(starts), 14)
+        # The 8 s position is served on time, the others wait
+        self.assertEqual([v.lateness for v in lapse.visits if v.index == 2],
+                         [0.0] * len(starts))
+        self.assertLessEqual(lapse.stats()["max_lateness"], 2.0)
+        self.assertLess(lapse.utilization(), 1.0)
+
+    def test_overload_is_reported(self):
+        lapse = self.timelapse([(0, 0, 0), (5000, 0, 0), (10000, 0, 0)],
+                               5.0, duration=4.0)
+        lapse.run(visits=15)
+
+        stats = lapse.stats()
+        self.assertGreater(lapse.utilization(), 1.0)
+        self.assertGreater(stats["missed"], 0)
+        self.assertGreater(stats["max_lateness"], 0.0)
+        self.assertLess(stats["min_slack"], 0.0)
+
+    def test_visit_durations_are_learnt(self):
+        lapse = TimeLapse(self.stage, [(0, 0, 0)], 10.0, self.visit(2.0),
+                          visit_time=0.5, clock=self.clock,
+                          sleep=self.clock.sleep)
+        lapse.run(visits=10)
+        self.assertAlmostEqual(lapse.durations[0], 2.0, delta=0.1)
+
+    def test_rejects_bad_intervals(self):
+        with self.assertRaises(ValueError):
+            self.timelapse([(0, 0, 0), (1, 0, 0)], [1.0])
+        with self.assertRaises(ValueError):
+            self.timelapse([(0, 0, 0)], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""Unit tests for the trajectory reconstruction (no hardware required).
+
+The frames are replayed on the Python model of the Oquam firmware in
+simulated time, and the trajectory is fed the same frames with the
+model's clock, so the two must agree to the step at every interrupt.
+"""
+
+from __future__ import annotations
+
+import importlib
+import time
+import unittest
+
+import numpy as np
+
+from ControlMotors.firmware_model import OquamModel  # type: ignore
+from ControlMotors.firmware_model import (  # type: ignore
+    bresenham_steps as scalar_bresenham_steps)
+from ControlMotors.trajectory import (  # type: ignore
+    Trajectory, bresenham_steps)
+
+
+class Replay:
+    """Send frames to the model and to the trajectory at model time."""
+
+    def __init__(self, trajectory=None):
+        self.model = OquamModel()
+        self.trajectory = trajectory or Trajectory()
+        self.samples = []
+
+    def send(self, command):
+        reply = self.model.send_command(command)
+        t = self.model.now_ms / 1000.0
+        self.trajectory(command, reply, t, t)
+        return reply
+
+    def run(self, ms):
+        # One sample per interrupt
+        for _ in range(int(ms * 10)):
+            self.model.advance(0.1)
+            self.samples.append((self.model.now_ms / 1000.0,
+                                 list(self.model.counters)))
+
+    def check(self):
+        times = np.array([t for t, _ in self.samples])
+        expected = np.array([c for _, c in self.samples])
+        np.testing.assert_array_equal(
+            self.trajectory.position_at(times), expected)
+
+
+class TestBresenham(unittest.TestCase):
+    def test_matches_the_firmware_model(self):
+        for dt in (1, 3, 7):
+            for delta in range(0, 10 * dt + 1):
+                k = np.arange(0, 10 * dt + 2)
+                expected = [scalar_bresenham_steps(delta, dt, i) for i in k]
+                np.testing.assert_array_equal(
+                    bresenham_steps(delta, 10 * dt, k), expected)
+
+
+class TestTrajectory(unittest.TestCase):
+    def test_blocks_match_the_firmware_at_every_interrupt(self):
+        replay = Replay()
+        replay.send("M[20,37,-150,3]")
+        replay.send("m[1000,0,-40,0]")
+        replay.run(5)
+        replay.send("B[10,5,5,5,4,-9,0,1,0,0,0,0]")
+        replay.run(120)
+        replay.check()
+
+    def test_idle_gap_and_late_blocks(self):
+        replay = Replay(Trajectory(origin=(0, 0, 0)))
+        replay.send("M[5,13,0,0]")
+        replay.run(12)
+        replay.send("M[8,-3,21,7]")
+        replay.run(20)
+        replay.check()
+
+    def test_pause_continue_and_reset(self):
+        replay = Replay()
+        replay.send("M[30,100,50,0]")
+        replay.send("M[30,-100,0,10]")
+        replay.run(12.3)
+        replay.send("p")
+        replay.run(7)
+        replay.send("M[10,0,0,-10]")
+        replay.run(3)
+        replay.send("c")
+        replay.run(40.5)
+        replay.send("r")
+        replay.run(10)
+        replay.send("M[10,1,2,3]")
+        replay.run(15)
+        replay.check()
+
+    def test_zero_and_moveto_after_it(self):
+        replay = Replay()
+        replay.send("M[10,42,17,0]")
+        replay.run(15)
+        # Not at the time of the last sample, which was taken before it
+        replay.model.advance(0.1)
+        replay.send("z")
+        replay.send("m[2000,10,0,0]")
+        replay.run(20)
+        replay.check()
+
+    def test_position_read_corrects_the_timing(self):
+        replay = Replay()
+        replay.send("M[100,1000,0,0]")
+        # Pretend the block was acknowledged 4 ms after it started
+        replay.trajectory._rows[0][0] += 0.004
+        replay.trajectory._rows[0][1] += 0.004
+        replay.run(30)
+        replay.send("P")
+        replay.run(80)
+        times = np.array([t for t, _ in replay.samples[300:]])
+        expected = np.array([c for _, c in replay.samples[300:]])
+        error = np.abs(replay.trajectory.position_at(times) - expected)
+        self.assertLessEqual(error.max(), 1)
+
+    def test_position_read_corrects_lost_steps(self):
+        replay = Replay()
+        replay.send("M[10,50,0,0]")
+        replay.run(15)
+        replay.model.counters[0] -= 7
+        replay.send("P")
+        replay.send("M[10,0,20,0]")
+        replay.run(15)
+        np.testing.assert_array_equal(
+            replay.trajectory.position_at(replay.model.now_ms / 1000.0),
+            [43, 20, 0])
+        # Earlier timestamps keep the earlier estimate
+        np.testing.assert_array_equal(
+            replay.trajectory.position_at(0.012), [50, 0, 0])
+
+
+class TestTrajectoryOnStage(unittest.TestCase):
+    def setUp(self) -> None:
+        from ControlMotors import ControlStage  # type: ignore
+
+        cm = importlib.import_module(ControlStage.__module__)
+        self._cm = cm
+        self._orig_cs = cm.ControlSerial
+        cm.ControlSerial = lambda port: OquamModel(speedup=1)
+
+    def tearDown(self) -> None:
+        self._cm.ControlSerial = self._orig_cs
+
+    def test_follows_the_stage_in_real_time(self):
+        from ControlMotors import ControlStage  # type: ignore
+        stage = ControlStage("MODEL", [2, 1, 1])
+        stage.link.counters = [10, 20, 30]
+        stage.invalidate_position()
+        stage.get_position(exact=True)
+        trajectory = Trajectory()
+        trajectory.attach(stage)
+
+        stage.move(100, -50, 0, dt=200)
+        stage.moveto(x=20, speed=500)
+        errors = []
+        for _ in range(8):
+            time.sleep(0.05)
+            now = time.monotonic()
+            stage.link._sync()
+            errors.append(np.abs(trajectory.position_at(now)
+                                 - stage.link.counters).max())
+        # A few milliseconds of scheduling jitter at 1000 steps/s
+        self.assertLessEqual(max(errors), 8)
+        np.testing.assert_allclose(
+            trajectory.stage_position_at(trajectory.end_time()),
+            [20, -30, 30])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()
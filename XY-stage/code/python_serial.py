@@ -90,8 +90,9 @@ def send_idle(link):
 
 def handle_set_homing(link, a, b, c):
     """configure the homing order. x:0, y:1, z:2, skip:-1. 
-    Example: set y, then x: handle_set_homing(link, 1, 0, -1)"""
-    send_command(link, "h[%d,%d,%d]" % (a,b,c))
+    Example: set y, then x: handle_set_homing(link, 1, 0, -1)
+    The homing speeds are left as they are (0 keeps the current value)."""
+    send_command(link, "h[%d,%d,%d,0,0,0,0,0,0,0,0,0]" % (a,b,c))
 
 
 def handle_homing(link):
@@ -16,6 +16,12 @@ setup(
     author_email="peter@hanappe.com",
     packages=find_packages(),
     install_requires=install_requires,
+    entry_points={
+        "console_scripts": [
+            "controlmotors=ControlMotors.cli:main",
+            "controlmotors-server=ControlMotors.server:main",
+        ],
+    },
     python_requires=">=3.7",
     license="GPLv3",
 )
\ No newline at end of file